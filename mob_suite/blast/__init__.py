@@ -1,11 +1,16 @@
 from datetime import datetime
 import logging
 import shutil
+import tempfile
 
 from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
 import os
+import threading
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 from pandas.io.common import EmptyDataError
 import re
 
@@ -30,105 +35,392 @@ bitscore
 '''.strip().split('\n')
 
 
+# Dtypes used while parsing, wide enough that filtering on them matches filtering the inferred table
+BLAST_TABLE_PARSE_DTYPES = {
+    'qseqid': str,
+    'sseqid': str,
+    'qlen': 'int64',
+    'slen': 'int64',
+    'qstart': 'int64',
+    'qend': 'int64',
+    'sstart': 'int64',
+    'send': 'int64',
+    'length': 'int64',
+    'mismatch': 'int64',
+    'pident': 'float64',
+    'qcovhsp': 'float64',
+    'qcovs': 'float64',
+    'sstrand': str,
+    'evalue': 'float64',
+    'bitscore': 'float64',
+}
+
+# Dtypes the filtered hits are stored with, coordinates are narrowed to int32 while scores stay float64 so
+# the values written to the reports are those BLAST printed and evalues do not underflow
+BLAST_TABLE_COMPACT_DTYPES = {
+    'qlen': 'int32',
+    'slen': 'int32',
+    'qstart': 'int32',
+    'qend': 'int32',
+    'sstart': 'int32',
+    'send': 'int32',
+    'length': 'int32',
+    'mismatch': 'int32',
+    'pident': 'float64',
+    'qcovhsp': 'float64',
+    'qcovs': 'float64',
+    'evalue': 'float64',
+    'bitscore': 'float64',
+}
+
+BLAST_TABLE_CATEGORICAL_COLS = ['qseqid', 'sseqid', 'sstrand']
+
+
+def filter_blast_chunk(chunk, min_values=None, max_values=None):
+    if min_values is not None:
+        for col in min_values:
+            chunk = chunk.loc[chunk[col] >= min_values[col]]
+    if max_values is not None:
+        for col in max_values:
+            chunk = chunk.loc[chunk[col] <= max_values[col]]
+    return chunk
+
+
+def read_blast_table(source, min_values=None, max_values=None, chunksize=100000):
+    """Stream a BLAST outfmt 6 table in chunks, filtering while reading.
+    Each chunk is parsed, filtered on the minimum and maximum column values given and then
+    converted to compact dtypes, so peak memory is bounded by the number of hits passing the
+    filters plus one chunk rather than by the size of the raw output.
+    Args:
+        source (str or file): `blastn` output file path or open handle in BLAST_TABLE_COLS format
+        min_values (dict): column name to minimum value to keep, e.g. {'pident': 80}
+        max_values (dict): column name to maximum value to keep
+        chunksize (int): number of lines parsed per chunk
+    Returns:
+        DataFrame: filtered hits with categorical ids, int32 coordinates and float64 scores
+    Raises:
+        EmptyDataError: No data could be parsed from the `blastn` output
+    """
+    frames = list()
+    for chunk in pd.read_csv(source, sep='\t', header=None, names=BLAST_TABLE_COLS, dtype=BLAST_TABLE_PARSE_DTYPES,
+                             chunksize=chunksize):
+        chunk = filter_blast_chunk(chunk, min_values, max_values)
+        if len(chunk) == 0:
+            continue
+        chunk = chunk.astype(BLAST_TABLE_COMPACT_DTYPES)
+        for col in BLAST_TABLE_CATEGORICAL_COLS:
+            chunk[col] = chunk[col].astype('category')
+        frames.append(chunk)
+
+    return concat_blast_tables(frames)
+
+
+def read_blast_file(blast_outfile, min_values=None, max_values=None):
+    """read_blast_table for a file which may be empty, returning an empty table in that case"""
+    if os.path.getsize(blast_outfile) == 0:
+        return empty_blast_table()
+    try:
+        return read_blast_table(blast_outfile, min_values=min_values, max_values=max_values)
+    except EmptyDataError:
+        return empty_blast_table()
+
+
+def empty_blast_table():
+    df = pd.DataFrame({col: pd.Series([], dtype=BLAST_TABLE_COMPACT_DTYPES.get(col, 'category'))
+                       for col in BLAST_TABLE_COLS})
+    return df[BLAST_TABLE_COLS]
+
+
+def concat_blast_tables(frames):
+    """Concatenate compact BLAST tables in order, merging the categories of their id columns"""
+    frames = [frame for frame in frames if len(frame) > 0]
+    if len(frames) == 0:
+        return empty_blast_table()
+
+    categoricals = dict()
+    for col in BLAST_TABLE_CATEGORICAL_COLS:
+        categoricals[col] = union_categoricals([frame[col] for frame in frames], sort_categories=True)
+    df = pd.concat([frame.drop(BLAST_TABLE_CATEGORICAL_COLS, axis=1) for frame in frames], ignore_index=True)
+    for col in BLAST_TABLE_CATEGORICAL_COLS:
+        df[col] = categoricals[col]
+    return df[BLAST_TABLE_COLS]
+
+
+def header_field(ids, index, sep='|'):
+    """Field of each id of a column of accession|type style sequence ids"""
+    return ids.astype(str).str.split(sep).str[index]
+
+
+def select_hits(keys, scores=None, keep='first'):
+    """Select one hit of each key of a hit table column in a single sort.
+    Args:
+        keys (array): key of each hit
+        scores (array): when given the hit with the lowest score is selected, ties going to the earliest hit
+        keep (str): the 'first' or 'last' hit of each key when no scores are given
+    Returns:
+        ndarray: positions of the selected hits, ordered by the first appearance of their keys
+    """
+    codes = pd.factorize(np.asarray(keys))[0]
+    positions = np.arange(len(codes))
+    if scores is not None:
+        order = np.lexsort((positions, np.asarray(scores), codes))
+    elif keep == 'last':
+        order = np.lexsort((-positions, codes))
+    else:
+        order = np.lexsort((positions, codes))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = codes[order][1:] != codes[order][:-1]
+    return order[first]
+
+
 class BlastRunner:
 
     def __init__(self, fasta_path, tmp_work_dir):
         self.fasta_path = fasta_path
 
-    def makeblastdb(self,fasta_path,dbtype):
-        p = Popen(['makeblastdb',
-                  '-in', fasta_path,
-                  '-dbtype',dbtype],
+    def makeblastdb(self,fasta_path,dbtype,out_path=None,extra_args=()):
+        cmd = ['makeblastdb',
+               '-in', fasta_path,
+               '-dbtype',dbtype]
+        if out_path is not None:
+            cmd += ['-out', out_path]
+        cmd += [str(arg) for arg in extra_args]
+        p = Popen(cmd,
                   stdout=PIPE,
                   stderr=PIPE)
-        p.wait()
-        stdout = p.stdout.read()
-        stderr = p.stderr.read()
+        (stdout, stderr) = p.communicate()
+        if p.returncode != 0:
+            ex_msg = 'makeblastdb on {} failed with return code {}: {}'.format(fasta_path, p.returncode, stderr)
+            logging.error(ex_msg)
+            raise Exception(ex_msg)
+        return fasta_path if out_path is None else out_path
 
 
 
-    def run_tblastn(self, query_fasta_path, blast_task, db_path, db_type, min_cov, min_ident, evalue,blast_outfile,num_threads=1):
+    def tblastn_command(self, query_fasta_path, db_path, evalue, num_threads=1, blast_outfile=None):
+        cmd = ['tblastn',
+               '-query', query_fasta_path,
+               '-num_threads','{}'.format(num_threads),
+               '-db', '{}'.format(db_path),
+               '-evalue', '{}'.format(evalue)]
+        if blast_outfile is not None:
+            cmd += ['-out', blast_outfile]
+        cmd += ['-outfmt', '6 {}'.format(' '.join(BLAST_TABLE_COLS))]
+        return cmd
+
+    def blastn_command(self, query_fasta_path, blast_task, db_path, evalue, min_ident, num_threads=1,
+                       blast_outfile=None):
+        cmd = ['blastn',
+               '-task', blast_task,
+               '-query', query_fasta_path,
+               '-db', '{}'.format(db_path),
+               '-num_threads','{}'.format(num_threads),
+               '-evalue', '{}'.format(evalue),
+               '-dust', 'yes',
+               '-perc_identity', '{}'.format(min_ident)]
+        if blast_outfile is not None:
+            cmd += ['-out', blast_outfile]
+        cmd += ['-outfmt', '6 {}'.format(' '.join(BLAST_TABLE_COLS))]
+        return cmd
 
-        p = Popen(['tblastn',
-                   '-query', query_fasta_path,
-                   '-num_threads','{}'.format(num_threads),
-                   '-db', '{}'.format(db_path),
-                   '-evalue', '{}'.format(evalue),
-                   '-out', blast_outfile,
-                   '-outfmt', '6 {}'.format(' '.join(BLAST_TABLE_COLS))],
+    def run_command(self, cmd, query_fasta_path, db_path, blast_outfile):
+        program = cmd[0]
+        p = Popen(cmd,
                   stdout=PIPE,
                   stderr=PIPE)
 
-        p.wait()
-        stdout = p.stdout.read()
-        stderr = p.stderr.read()
+        (stdout, stderr) = p.communicate()
         if stdout is not None and stdout != '':
-            logging.debug('blastn on db {} and query {} STDOUT: {}'.format(query_fasta_path, db_path, stdout))
+            logging.debug('{} on db {} and query {} STDOUT: {}'.format(program, query_fasta_path, db_path, stdout))
 
         if stderr is not None and stderr != '':
-            logging.debug('blastn on db {} and query {} STDERR: {}'.format(query_fasta_path, db_path, stderr))
+            logging.debug('{} on db {} and query {} STDERR: {}'.format(program, query_fasta_path, db_path, stderr))
             if os.path.exists(blast_outfile):
                 return blast_outfile
             else:
-                ex_msg = 'tblastn on db {} and query {} did not produce expected output file at {}'.format(
+                ex_msg = '{} on db {} and query {} did not produce expected output file at {}'.format(
+                    program,
                     query_fasta_path,
                     db_path,
                     blast_outfile)
                 logging.error(ex_msg)
                 raise Exception(ex_msg)
 
-    def run_blast(self, query_fasta_path, blast_task, db_path, db_type, min_cov, min_ident, evalue,blast_outfile,num_threads=1,word_size=11):
-
-        p = Popen(['blastn',
-                   '-task', blast_task,
-                   '-query', query_fasta_path,
-                   '-db', '{}'.format(db_path),
-                   '-num_threads','{}'.format(num_threads),
-                   '-evalue', '{}'.format(evalue),
-                   '-dust', 'yes',
-                   '-perc_identity', '{}'.format(min_ident),
-                   '-out', blast_outfile,
-                   '-outfmt', '6 {}'.format(' '.join(BLAST_TABLE_COLS))],
+    def stream_command(self, cmd, query_fasta_path, db_path, min_values=None, max_values=None):
+        """Run a BLAST command writing its table to stdout and parse the hits as they arrive.
+        The table is filtered chunk by chunk with read_blast_table so no output file is written
+        and only the hits passing the filters are held in memory.
+        Returns:
+            DataFrame: filtered hits in compact dtypes
+        """
+        program = cmd[0]
+        p = Popen(cmd,
                   stdout=PIPE,
                   stderr=PIPE)
+        # stderr is drained on its own thread so a chatty BLAST can not block on a full pipe
+        stderr_data = list()
+        stderr_reader = threading.Thread(target=lambda: stderr_data.append(p.stderr.read()))
+        stderr_reader.start()
+        try:
+            df = read_blast_table(p.stdout, min_values=min_values, max_values=max_values)
+        except EmptyDataError:
+            df = empty_blast_table()
+        except Exception:
+            p.kill()
+            raise
+        finally:
+            p.stdout.close()
+            p.wait()
+            stderr_reader.join()
 
-        p.wait()
-        stdout = p.stdout.read()
-        stderr = p.stderr.read()
-        if stdout is not None and stdout != '':
-            logging.debug('blastn on db {} and query {} STDOUT: {}'.format(query_fasta_path, db_path, stdout))
+        stderr = b''.join(stderr_data)
+        if stderr != b'':
+            logging.debug('{} on db {} and query {} STDERR: {}'.format(program, query_fasta_path, db_path, stderr))
+        if p.returncode != 0:
+            ex_msg = '{} on db {} and query {} failed with return code {}'.format(program, query_fasta_path, db_path,
+                                                                                 p.returncode)
+            logging.error(ex_msg)
+            raise Exception(ex_msg)
+        return df
 
-        if stderr is not None and stderr != '':
-            logging.debug('blastn on db {} and query {} STDERR: {}'.format(query_fasta_path, db_path, stderr))
-            if os.path.exists(blast_outfile):
-                return blast_outfile
-            else:
-                ex_msg = 'blastn on db {} and query {} did not produce expected output file at {}'.format(
-                    query_fasta_path,
-                    db_path,
-                    blast_outfile)
-                logging.error(ex_msg)
-                raise Exception(ex_msg)
+    def run_tblastn(self, query_fasta_path, blast_task, db_path, db_type, min_cov, min_ident, evalue,blast_outfile,num_threads=1):
+        cmd = self.tblastn_command(query_fasta_path, db_path, evalue, num_threads, blast_outfile)
+        return self.run_command(cmd, query_fasta_path, db_path, blast_outfile)
+
+    def run_tblastn_stream(self, query_fasta_path, blast_task, db_path, db_type, min_cov, min_ident, evalue,
+                           blast_outfile=None, num_threads=1, min_values=None, max_values=None):
+        """Run tblastn and return the filtered hits, only writing blast_outfile when one is given for debugging"""
+        if blast_outfile is not None:
+            self.run_tblastn(query_fasta_path, blast_task, db_path, db_type, min_cov, min_ident, evalue,
+                             blast_outfile, num_threads=num_threads)
+            return read_blast_file(blast_outfile, min_values, max_values)
+        cmd = self.tblastn_command(query_fasta_path, db_path, evalue, num_threads)
+        return self.stream_command(cmd, query_fasta_path, db_path, min_values, max_values)
+
+    def split_fasta(self, fasta_path, out_prefix, num_chunks):
+        """Split a FASTA file into at most num_chunks files of consecutive records with balanced sequence length.
+        Records are copied verbatim and keep their original order, so concatenating per chunk
+        search results in chunk order reproduces the ordering of a search on the whole file.
+        Returns:
+            list: paths of the chunk files
+        """
+        records = list()
+        with open(fasta_path, 'r') as fh:
+            for line in fh:
+                if line.startswith('>'):
+                    records.append([line, 0])
+                elif len(records) > 0:
+                    records[-1][0] += line
+                    records[-1][1] += len(line.strip())
+
+        num_chunks = max(1, min(num_chunks, len(records)))
+        total_length = sum(length for text, length in records)
+        chunk_files = list()
+        chunk_fh = None
+        cumulative_length = 0
+        for text, length in records:
+            if chunk_fh is None or (len(chunk_files) < num_chunks and
+                                    cumulative_length >= total_length * len(chunk_files) / num_chunks):
+                if chunk_fh is not None:
+                    chunk_fh.close()
+                chunk_files.append('{}.{}.fasta'.format(out_prefix, len(chunk_files)))
+                chunk_fh = open(chunk_files[-1], 'w')
+            chunk_fh.write(text)
+            cumulative_length += length
+        if chunk_fh is not None:
+            chunk_fh.close()
+        return chunk_files
+
+    def run_tblastn_sharded(self, query_fasta_path, blast_task, db_path, db_type, min_cov, min_ident, evalue,
+                            blast_outfile=None, num_threads=1, work_dir=None, min_values=None, max_values=None):
+        """Run tblastn with the query proteins split into num_threads shards searched in parallel.
+        Each shard is searched by its own single threaded tblastn process against the same database,
+        so hit statistics are unchanged, and the shard results are concatenated in query order to give
+        the same table as a single run. The raw table is only written when blast_outfile is given.
+        Returns:
+            DataFrame: filtered hits in compact dtypes
+        """
+        if num_threads <= 1:
+            return self.run_tblastn_stream(query_fasta_path, blast_task, db_path, db_type, min_cov, min_ident,
+                                           evalue, blast_outfile, 1, min_values, max_values)
+        # shards go in a private directory unless the caller gives one, the query FASTA may be in a
+        # directory shared between concurrent runs
+        shard_dir = None
+        if work_dir is None:
+            shard_dir = tempfile.mkdtemp(prefix=os.path.basename(query_fasta_path) + '.', suffix='.shards')
+            work_dir = shard_dir
+        shard_prefix = os.path.join(work_dir, os.path.basename(query_fasta_path) + '.shard')
+        try:
+            shards = self.split_fasta(query_fasta_path, shard_prefix, num_threads)
+
+            with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+                futures = list()
+                for shard in shards:
+                    shard_outfile = None
+                    if blast_outfile is not None:
+                        shard_outfile = shard + '.out'
+                    futures.append(executor.submit(self.run_tblastn_stream, shard, blast_task, db_path, db_type,
+                                                   min_cov, min_ident, evalue, shard_outfile, 1, min_values,
+                                                   max_values))
+                frames = [future.result() for future in futures]
+
+            if blast_outfile is not None:
+                with open(blast_outfile, 'w') as out:
+                    for shard in shards:
+                        shard_results = shard + '.out'
+                        if os.path.isfile(shard_results):
+                            with open(shard_results, 'r') as fh:
+                                shutil.copyfileobj(fh, out)
+                            os.remove(shard_results)
+            for shard in shards:
+                os.remove(shard)
+        finally:
+            if shard_dir is not None:
+                shutil.rmtree(shard_dir, ignore_errors=True)
+        return concat_blast_tables(frames)
+
+    def run_blast(self, query_fasta_path, blast_task, db_path, db_type, min_cov, min_ident, evalue,blast_outfile,num_threads=1,word_size=11):
+        cmd = self.blastn_command(query_fasta_path, blast_task, db_path, evalue, min_ident, num_threads, blast_outfile)
+        return self.run_command(cmd, query_fasta_path, db_path, blast_outfile)
+
+    def run_blast_stream(self, query_fasta_path, blast_task, db_path, db_type, min_cov, min_ident, evalue,
+                         blast_outfile=None, num_threads=1, word_size=11, min_values=None, max_values=None):
+        """Run blastn and return the filtered hits, only writing blast_outfile when one is given for debugging"""
+        if blast_outfile is not None:
+            self.run_blast(query_fasta_path, blast_task, db_path, db_type, min_cov, min_ident, evalue,
+                           blast_outfile, num_threads=num_threads, word_size=word_size)
+            return read_blast_file(blast_outfile, min_values, max_values)
+        cmd = self.blastn_command(query_fasta_path, blast_task, db_path, evalue, min_ident, num_threads)
+        return self.stream_command(cmd, query_fasta_path, db_path, min_values, max_values)
 
 
 class BlastReader:
     df = None
 
 
-    def __init__(self, blast_outfile):
+    def __init__(self, blast_outfile, streaming=False, min_values=None, max_values=None, chunksize=100000):
         """Read BLASTN output file into a pandas DataFrame
         Sort the DataFrame by BLAST bitscore.
         If there are no BLASTN results, then no results can be returned.
+        In streaming mode the file is read in chunks with the min_values/max_values filters
+        applied while reading, see read_blast_table.
         Args:
             blast_outfile (str): `blastn` output file path
+            streaming (bool): read in filtered chunks with compact dtypes
+            min_values (dict): streaming mode column minimums
+            max_values (dict): streaming mode column maximums
+            chunksize (int): streaming mode lines per chunk
         Raises:
             EmptyDataError: No data could be parsed from the `blastn` output file
         """
         self.blast_outfile = blast_outfile
         try:
-
-            self.df = pd.read_table(self.blast_outfile, header=None)
-            self.df.columns = BLAST_TABLE_COLS
+            if streaming:
+                self.df = read_blast_table(self.blast_outfile, min_values=min_values, max_values=max_values,
+                                           chunksize=chunksize)
+            else:
+                self.df = pd.read_table(self.blast_outfile, header=None)
+                self.df.columns = BLAST_TABLE_COLS
 
             logging.debug(self.df.head())
             self.is_missing = False
@@ -142,4 +434,3 @@ class BlastReader:
     def df_dict(self):
         if not self.is_missing:
             return self.df.to_dict()
-
@@ -0,0 +1,335 @@
+import errno
+import fcntl
+import glob
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from mob_suite.blast import BlastRunner
+
+DEFAULT_REGISTRY_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                    'databases', 'blastdb_registry')
+
+BLASTDB_INDEX_EXTENSIONS = {
+    'nucl': ('.nin', '.nhr', '.nsq'),
+    'prot': ('.pin', '.phr', '.psq'),
+}
+
+BLASTDB_ALIAS_EXTENSIONS = {
+    'nucl': '.nal',
+    'prot': '.pal',
+}
+
+VOLUME_SUFFIX = '.vol'
+DEFAULT_MAX_VOLUMES = 8
+
+# digests of the reference, sample and marker files of a run, evicted least recently used first
+DIGEST_MEMO_SIZE = 256
+
+_digest_memo = OrderedDict()
+_digest_lock = threading.Lock()
+
+
+def file_digest(path, block_size=1 << 20):
+    """Return the sha256 hex digest of a file's contents.
+    Digests are memoized per process on (path, size, mtime) so repeated lookups of an
+    unchanged reference file only pay for hashing once, keeping the DIGEST_MEMO_SIZE most
+    recently used.
+    Args:
+        path (str): file to hash
+        block_size (int): number of bytes read per iteration
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    memo_key = (path, stat.st_size, stat.st_mtime_ns)
+    with _digest_lock:
+        if memo_key in _digest_memo:
+            _digest_memo.move_to_end(memo_key)
+            return _digest_memo[memo_key]
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(block_size), b''):
+            sha.update(block)
+    digest = sha.hexdigest()
+    with _digest_lock:
+        _digest_memo[memo_key] = digest
+        while len(_digest_memo) > DIGEST_MEMO_SIZE:
+            _digest_memo.popitem(last=False)
+    return digest
+
+
+def blastdb_is_valid(db_path, dbtype):
+    """Check that a BLAST database prefix has non-empty index files.
+    Single volume databases are recognised by their index triplet, multi volume
+    databases by their alias file.
+    """
+    alias = db_path + BLASTDB_ALIAS_EXTENSIONS[dbtype]
+    if os.path.isfile(alias) and os.path.getsize(alias) > 0:
+        return True
+    for ext in BLASTDB_INDEX_EXTENSIONS[dbtype]:
+        index_file = db_path + ext
+        if not os.path.isfile(index_file) or os.path.getsize(index_file) == 0:
+            return False
+    return True
+
+
+def blastdb_is_current(db_path, fasta_path, dbtype):
+    """Check that a database built from fasta_path, such as those written by mob_init, is valid and not older than it"""
+    if not blastdb_is_valid(db_path, dbtype):
+        return False
+    index_file = db_path + BLASTDB_ALIAS_EXTENSIONS[dbtype]
+    if not os.path.isfile(index_file):
+        index_file = db_path + BLASTDB_INDEX_EXTENSIONS[dbtype][0]
+    return os.path.getmtime(index_file) >= os.path.getmtime(fasta_path)
+
+
+def dir_is_writable(path):
+    """Check that a directory can be written to, or created under its closest existing parent"""
+    path = os.path.abspath(path)
+    while not os.path.isdir(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+    return os.access(path, os.W_OK | os.X_OK)
+
+
+def blastdb_digest(db_path, dbtype='nucl'):
+    """Return a digest identifying the contents of a BLAST database.
+    The alias or index file records the volumes, sequence count, total length and build date of
+    the database, so hashing it is enough to tell builds apart without reading the sequences.
+    """
+    alias = db_path + BLASTDB_ALIAS_EXTENSIONS[dbtype]
+    index_file = db_path + BLASTDB_INDEX_EXTENSIONS[dbtype][0]
+    for path in (alias, index_file):
+        if os.path.isfile(path):
+            return file_digest(path)
+    return file_digest(db_path)
+
+
+class BlastDbRegistry:
+    """Content addressed store of BLAST databases built by makeblastdb.
+
+    Each database lives in its own directory of the registry named after a hash of the
+    source FASTA contents and the build parameters, so a database is only built once per
+    distinct input no matter how many runs or processes request it. Builds are serialised
+    per key with an exclusive file lock and written to a scratch directory that is renamed
+    into place once complete, so readers never observe partially written index files.
+    """
+
+    def __init__(self, registry_dir=DEFAULT_REGISTRY_DIR):
+        self.registry_dir = registry_dir
+        if not os.path.isdir(self.registry_dir):
+            try:
+                os.makedirs(self.registry_dir, 0o755)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+
+    def db_key(self, fasta_path, dbtype, build_args=()):
+        key = hashlib.sha256()
+        key.update(file_digest(fasta_path).encode('utf-8'))
+        key.update(dbtype.encode('utf-8'))
+        for arg in build_args:
+            key.update(b'\0')
+            key.update(str(arg).encode('utf-8'))
+        return key.hexdigest()
+
+    def db_path(self, key):
+        return os.path.join(self.registry_dir, key, 'db')
+
+    def lookup(self, fasta_path, dbtype, build_args=()):
+        """Return the database prefix for fasta_path if it has already been built, otherwise None"""
+        db_path = self.db_path(self.db_key(fasta_path, dbtype, build_args))
+        if blastdb_is_valid(db_path, dbtype):
+            return db_path
+        return None
+
+    def get_db(self, fasta_path, dbtype, build_args=()):
+        """Return the prefix of a valid BLAST database built from fasta_path, building it if needed.
+        Args:
+            fasta_path (str): source FASTA file
+            dbtype (str): makeblastdb database type, 'nucl' or 'prot'
+            build_args (tuple): additional makeblastdb arguments, these form part of the key
+        Returns:
+            str: database prefix suitable for the -db argument of the BLAST programs
+        """
+        key = self.db_key(fasta_path, dbtype, build_args)
+        db_dir = os.path.join(self.registry_dir, key)
+        db_path = self.db_path(key)
+
+        if blastdb_is_valid(db_path, dbtype):
+            logging.debug('Reusing BLAST database {} for {}'.format(db_path, fasta_path))
+            return db_path
+
+        lock_file = os.path.join(self.registry_dir, key + '.lock')
+        with open(lock_file, 'w') as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            try:
+                # Another process may have finished the build while we waited for the lock
+                if blastdb_is_valid(db_path, dbtype):
+                    return db_path
+                if os.path.isdir(db_dir):
+                    shutil.rmtree(db_dir)
+
+                logging.info('Building BLAST database for {} in {}'.format(fasta_path, db_dir))
+                build_dir = tempfile.mkdtemp(prefix=key + '.', suffix='.build', dir=self.registry_dir)
+                try:
+                    BlastRunner(fasta_path, build_dir).makeblastdb(fasta_path, dbtype,
+                                                                   out_path=os.path.join(build_dir, 'db'),
+                                                                   extra_args=build_args)
+                    os.chmod(build_dir, 0o755)
+                    os.rename(build_dir, db_dir)
+                except Exception:
+                    shutil.rmtree(build_dir, ignore_errors=True)
+                    raise
+            finally:
+                fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+        return db_path
+
+
+def reference_blastdb(fasta_path, dbtype, fallback_dir, registry_dir=DEFAULT_REGISTRY_DIR):
+    """Return the prefix of a BLAST database of a reference FASTA.
+    The database mob_init built on the FASTA is used while it is current. Otherwise one is built in the
+    registry, or in a registry under fallback_dir when the registry can not be written to, as happens with
+    read only installs.
+    Args:
+        fasta_path (str): reference FASTA
+        dbtype (str): makeblastdb database type, 'nucl' or 'prot'
+        fallback_dir (str): directory to keep the registry in when registry_dir is read only
+        registry_dir (str): registry directory
+    Returns:
+        str: database prefix suitable for the -db argument of the BLAST programs
+    """
+    if blastdb_is_current(fasta_path, fasta_path, dbtype):
+        return fasta_path
+    if not dir_is_writable(registry_dir):
+        logging.info('BLAST database registry {} is read only, using {}'.format(registry_dir, fallback_dir))
+        registry_dir = fallback_dir
+    return BlastDbRegistry(registry_dir).get_db(fasta_path, dbtype)
+
+
+class SampleBlastDb:
+    """Handle on the BLAST database built from the sample being processed.
+
+    The marker searches use the input assembly as the database, so the handle is created
+    once per run, passed to every search stage and removed with cleanup() at the end.
+    """
+
+    def __init__(self, fasta_path, work_dir, dbtype='nucl'):
+        self.fasta_path = fasta_path
+        self.dbtype = dbtype
+        self.db_dir = os.path.join(work_dir, 'sample_blastdb')
+        if os.path.isdir(self.db_dir):
+            shutil.rmtree(self.db_dir)
+        os.mkdir(self.db_dir, 0o755)
+        logging.info('Building sample BLAST database for {}'.format(fasta_path))
+        self.db_path = BlastRunner(fasta_path, work_dir).makeblastdb(fasta_path, dbtype,
+                                                                     out_path=os.path.join(self.db_dir, 'sample'))
+
+    def cleanup(self):
+        if os.path.isdir(self.db_dir):
+            shutil.rmtree(self.db_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cleanup()
+
+
+class IncrementalBlastDb:
+    """BLAST database of a growing reference FASTA, kept as volumes listed by an alias file.
+
+    Sequences appended to the reference are indexed on their own as a new volume and the alias
+    file named after the FASTA is rewritten to list it, so adding a few sequences does not rebuild
+    the index of the whole reference. The BLAST programs search the alias like any other database.
+    Once more than max_volumes volumes have accumulated they are compacted back into a single
+    volume built from the whole FASTA. Volumes are named <fasta>.vol<N> with N increasing, so a
+    compacted volume never replaces the files of one the alias may still list.
+    """
+
+    def __init__(self, fasta_path, dbtype='nucl', max_volumes=DEFAULT_MAX_VOLUMES):
+        # volumes are read back from the alias as absolute paths, so the FASTA path must be absolute too
+        self.fasta_path = os.path.abspath(fasta_path)
+        self.dbtype = dbtype
+        self.max_volumes = max_volumes
+        self.alias_path = self.fasta_path + BLASTDB_ALIAS_EXTENSIONS[dbtype]
+        self.blast_runner = BlastRunner(self.fasta_path, os.path.dirname(self.fasta_path))
+
+    def volumes(self):
+        """Volume prefixes listed by the alias file, or None when the database is a single index"""
+        if not os.path.isfile(self.alias_path):
+            return None
+        db_dir = os.path.dirname(os.path.abspath(self.alias_path))
+        with open(self.alias_path, 'r') as fh:
+            for line in fh:
+                if line.startswith('DBLIST'):
+                    return [os.path.join(db_dir, name.strip('"')) for name in line.split()[1:]]
+        return list()
+
+    def volume_number(self, volume):
+        return int(volume[len(self.fasta_path + VOLUME_SUFFIX):])
+
+    def next_volume(self, volumes):
+        number = 1
+        if volumes:
+            number = max(self.volume_number(volume) for volume in volumes) + 1
+        return '{}{}{}'.format(self.fasta_path, VOLUME_SUFFIX, number)
+
+    def write_alias(self, volumes):
+        tmp_path = self.alias_path + '.tmp'
+        with open(tmp_path, 'w') as out:
+            out.write("#\n# Alias file of the volumes of {}\n#\n".format(os.path.basename(self.fasta_path)))
+            out.write("TITLE {}\n".format(os.path.basename(self.fasta_path)))
+            out.write("DBLIST {}\n".format(" ".join(os.path.basename(volume) for volume in volumes)))
+        os.replace(tmp_path, self.alias_path)
+
+    def remove_volume(self, volume):
+        for path in glob.glob(glob.escape(volume) + '.*'):
+            os.remove(path)
+
+    def remove_single_index(self):
+        # an index built directly on the FASTA would compete with the alias of the same name
+        for path in glob.glob(glob.escape(self.fasta_path) + '.{}??'.format(self.dbtype[0])):
+            if path != self.alias_path:
+                os.remove(path)
+
+    def append(self, delta_fasta):
+        """Index the sequences of delta_fasta, already appended to the reference FASTA, as a new volume.
+        A reference still indexed as a single database is first converted to a volume built from the
+        whole FASTA, which already includes the new sequences.
+        Returns:
+            str: database prefix suitable for the -db argument of the BLAST programs
+        """
+        volumes = self.volumes()
+        if volumes is None:
+            return self.compact()
+
+        volume = self.next_volume(volumes)
+        logging.info('Indexing the sequences of {} as BLAST volume {}'.format(delta_fasta, volume))
+        self.blast_runner.makeblastdb(delta_fasta, self.dbtype, out_path=volume)
+        volumes.append(volume)
+        self.write_alias(volumes)
+
+        if len(volumes) > self.max_volumes:
+            return self.compact()
+        return self.fasta_path
+
+    def compact(self):
+        """Replace every volume with a single volume built from the whole reference FASTA"""
+        volumes = self.volumes() or list()
+        volume = self.next_volume(volumes)
+        logging.info('Compacting the BLAST database of {} into volume {}'.format(self.fasta_path, volume))
+        self.blast_runner.makeblastdb(self.fasta_path, self.dbtype, out_path=volume)
+        self.write_alias([volume])
+        for old_volume in volumes:
+            self.remove_volume(old_volume)
+        self.remove_single_index()
+        return self.fasta_path
@@ -0,0 +1,210 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from subprocess import Popen, PIPE
+from contextlib import contextmanager
+
+import numpy as np
+
+from mob_suite.blast import BLAST_TABLE_COLS, concat_blast_tables, empty_blast_table, read_blast_table
+from mob_suite.blast.db_registry import blastdb_digest
+from mob_suite.blast.kmer_index import read_fasta_records
+
+DEFAULT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hits (
+    key TEXT PRIMARY KEY,
+    db_digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    hits BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS hits_db_digest ON hits (db_digest);
+CREATE INDEX IF NOT EXISTS hits_last_used ON hits (last_used);
+'''
+
+
+_blast_version_memo = dict()
+
+
+def blast_version(program):
+    """Version line reported by `<program> -version`, part of the cache key so hits are not reused across BLAST+ releases"""
+    if program not in _blast_version_memo:
+        p = Popen([program, '-version'],
+                  stdout=PIPE,
+                  stderr=PIPE)
+        (stdout, stderr) = p.communicate()
+        if p.returncode != 0:
+            ex_msg = '{} -version failed with return code {}: {}'.format(program, p.returncode, stderr)
+            logging.error(ex_msg)
+            raise Exception(ex_msg)
+        _blast_version_memo[program] = stdout.decode('utf-8').strip().split('\n')[0]
+    return _blast_version_memo[program]
+
+
+def sequence_id(record_text):
+    return record_text.split()[0][1:]
+
+
+class BlastHitCache:
+    """On disk cache of the BLAST hits of individual query sequences.
+
+    Entries are keyed on the digest of the query sequence, the digest of the database searched
+    and the search parameters, and hold the filtered hits of that sequence without its id, so a
+    contig seen in an earlier run is not searched again whatever it is called now. Sequences
+    without hits are cached too. The cache is a SQLite file shared between processes, and once
+    it grows beyond max_bytes the least recently used entries are evicted. The file uses the default
+    rollback journal so the cache can be kept on network file systems.
+    """
+
+    def __init__(self, cache_path, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        cache_dir = os.path.dirname(os.path.abspath(cache_path))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o755)
+        with self.connect() as conn:
+            conn.executescript(CACHE_SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        # connections are opened per operation as searches using the cache run on several threads
+        conn = sqlite3.connect(self.cache_path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def entry_key(self, seq_digest, db_digest, params):
+        key = hashlib.sha256()
+        for part in (seq_digest, db_digest, params):
+            key.update(part.encode('utf-8'))
+            key.update(b'\0')
+        return key.hexdigest()
+
+    def get(self, keys):
+        """Return the cached hit blobs of the keys present, marking them as recently used"""
+        found = dict()
+        now = time.time()
+        with self.connect() as conn:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                query = 'SELECT key, hits FROM hits WHERE key IN ({})'.format(','.join('?' * len(batch)))
+                for key, hits in conn.execute(query, batch):
+                    found[key] = hits
+            conn.executemany('UPDATE hits SET last_used = ? WHERE key = ?', [(now, key) for key in found])
+        return found
+
+    def put(self, entries, db_digest):
+        """Store (key, hit blob) entries for a database and evict the least recently used entries over the size limit"""
+        now = time.time()
+        with self.connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO hits (key, db_digest, size, last_used, hits) VALUES (?, ?, ?, ?, ?)',
+                             [(key, db_digest, len(hits), now, hits) for key, hits in entries])
+            self.evict(conn)
+
+    def evict(self, conn):
+        total = conn.execute('SELECT COALESCE(SUM(size + length(key)), 0) FROM hits').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in conn.execute('SELECT key, size + length(key) FROM hits ORDER BY last_used').fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute('DELETE FROM hits WHERE key = ?', (key,))
+            total -= size
+            evicted += 1
+        logging.info('Evicted {} entries from BLAST hit cache {}'.format(evicted, self.cache_path))
+
+    def invalidate(self, db_path, dbtype='nucl'):
+        """Remove every entry for the current build of a BLAST database, returning the number removed"""
+        db_digest = blastdb_digest(db_path, dbtype)
+        with self.connect() as conn:
+            removed = conn.execute('DELETE FROM hits WHERE db_digest = ?', (db_digest,)).rowcount
+        logging.info('Removed {} entries for {} from BLAST hit cache {}'.format(removed, db_path, self.cache_path))
+        return removed
+
+    def clear(self):
+        with self.connect() as conn:
+            conn.execute('DELETE FROM hits')
+
+    def run_blast_stream(self, blast_runner, query_fasta_path, blast_task, db_path, db_type, min_cov, min_ident,
+                         evalue, work_dir, num_threads=1, word_size=11, min_values=None, max_values=None):
+        """BlastRunner.run_blast_stream answering the query sequences seen before from the cache.
+        Only the uncached sequences are searched and the cached hits are merged back in query
+        order, giving the same table as searching every sequence.
+        Returns:
+            DataFrame: filtered hits in compact dtypes
+        """
+        db_digest = blastdb_digest(db_path)
+        params = json.dumps({'program': 'blastn', 'version': blast_version('blastn'), 'task': blast_task, 'evalue': str(evalue),
+                             'min_ident': str(min_ident), 'word_size': word_size,
+                             'min_values': sorted((min_values or dict()).items()),
+                             'max_values': sorted((max_values or dict()).items())})
+        records = read_fasta_records(query_fasta_path)
+        ids = [sequence_id(text) for text, seq in records]
+        keys = [self.entry_key(hashlib.sha256(seq).hexdigest(), db_digest, params) for text, seq in records]
+        cached = self.get(keys)
+        logging.info('BLAST hit cache answered {} of {} sequences of {}'.format(len(cached), len(records),
+                                                                                query_fasta_path))
+
+        cached_lines = list()
+        for seq_id, key in zip(ids, keys):
+            if key in cached and len(cached[key]) > 0:
+                cached_lines.extend('{}\t{}'.format(seq_id, line)
+                                    for line in cached[key].decode('utf-8').rstrip('\n').split('\n'))
+        cached_df = empty_blast_table()
+        if len(cached_lines) > 0:
+            cached_df = read_blast_table(io.StringIO('\n'.join(cached_lines) + '\n'))
+
+        uncached = [i for i, key in enumerate(keys) if key not in cached]
+        searched_df = empty_blast_table()
+        if len(uncached) > 0:
+            search_fasta = query_fasta_path
+            if len(uncached) < len(records):
+                fd, search_fasta = tempfile.mkstemp(prefix=os.path.basename(query_fasta_path) + '.',
+                                                    suffix='.uncached.fasta', dir=work_dir)
+                with os.fdopen(fd, 'w') as out:
+                    for i in uncached:
+                        out.write(records[i][0])
+            searched_df = blast_runner.run_blast_stream(search_fasta, blast_task, db_path, db_type, min_cov,
+                                                        min_ident, evalue, num_threads=num_threads,
+                                                        word_size=word_size, min_values=min_values,
+                                                        max_values=max_values)
+            if search_fasta != query_fasta_path:
+                os.remove(search_fasta)
+            self.store(searched_df, [ids[i] for i in uncached], [keys[i] for i in uncached], db_digest)
+
+        blast_df = concat_blast_tables([cached_df, searched_df])
+        if len(blast_df) == 0:
+            return blast_df
+        # BLAST reports queries in input order, cached and searched hits are put back in that order
+        order = {seq_id: i for i, seq_id in enumerate(ids)}
+        rank = blast_df['qseqid'].astype(str).map(order).values
+        return blast_df.iloc[np.argsort(rank, kind='mergesort')].reset_index(drop=True)
+
+    def store(self, blast_df, ids, keys, db_digest):
+        """Cache the hits of each searched sequence, including the sequences without hits"""
+        hit_ids = set(blast_df['qseqid'].astype(str).unique())
+        if not hit_ids.issubset(ids):
+            logging.warning('BLAST reported query ids not found in the query FASTA, not caching its hits')
+            return
+        lines = dict((seq_id, list()) for seq_id in ids)
+        if len(blast_df) > 0:
+            table = blast_df[BLAST_TABLE_COLS[1:]].to_csv(sep='\t', header=False, index=False)
+            for seq_id, line in zip(blast_df['qseqid'].astype(str), table.rstrip('\n').split('\n')):
+                lines[seq_id].append(line)
+        entries = list()
+        for seq_id, key in zip(ids, keys):
+            hits = ''
+            if len(lines[seq_id]) > 0:
+                hits = '\n'.join(lines[seq_id]) + '\n'
+            entries.append((key, hits.encode('utf-8')))
+        self.put(entries, db_digest)
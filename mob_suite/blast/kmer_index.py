@@ -0,0 +1,284 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from mob_suite.blast.db_registry import file_digest
+
+# Marker searches against the sample use megablast, which only reports alignments seeded by an
+# exact match of its 28 base word, so any hit shares at least one exact 21-mer with the sample
+NUCL_KMER_SIZE = 21
+# tblastn seeds on inexact words, for proteins the shared k-mers are bounded with the
+# identity and coverage thresholds instead, see MarkerKmerIndex.min_shared_kmers
+PROT_KMER_SIZE = 4
+
+KMER_INDEX_SUFFIX = '.kidx.npz'
+KMER_INDEX_VERSION = 1
+
+# Windows spanning ambiguity codes can not be looked up, they are stored as always present
+AMBIGUOUS_KMER = np.iinfo(np.uint64).max
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+# NCBI genetic code 1 with codons ordered TCAG
+STANDARD_CODE = 'FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG'
+
+INVALID = 255
+
+NUCL_CODES = np.full(256, INVALID, dtype=np.uint8)
+for i, base in enumerate('ACGT'):
+    NUCL_CODES[ord(base)] = i
+    NUCL_CODES[ord(base.lower())] = i
+
+AA_CODES = np.full(256, INVALID, dtype=np.uint8)
+for i, aa in enumerate(AMINO_ACIDS):
+    AA_CODES[ord(aa)] = i
+    AA_CODES[ord(aa.lower())] = i
+
+# Translation of codon index 16 * b1 + 4 * b2 + b3 with bases coded A0 C1 G2 T3
+TCAG_RANK = {'T': 0, 'C': 1, 'A': 2, 'G': 3}
+CODON_TABLE = np.full(64, INVALID, dtype=np.uint8)
+for b1 in 'ACGT':
+    for b2 in 'ACGT':
+        for b3 in 'ACGT':
+            aa = STANDARD_CODE[16 * TCAG_RANK[b1] + 4 * TCAG_RANK[b2] + TCAG_RANK[b3]]
+            if aa != '*':
+                CODON_TABLE[16 * 'ACGT'.index(b1) + 4 * 'ACGT'.index(b2) + 'ACGT'.index(b3)] = AMINO_ACIDS.index(aa)
+
+
+def index_path(fasta_path):
+    return fasta_path + KMER_INDEX_SUFFIX
+
+
+def read_fasta_records(fasta_path):
+    """Return the records of a FASTA file as (record text, sequence bytes) tuples in file order"""
+    records = list()
+    with open(fasta_path, 'r') as fh:
+        for line in fh:
+            if line.startswith('>'):
+                records.append([line, []])
+            elif len(records) > 0:
+                records[-1][0] += line
+                records[-1][1].append(line.strip())
+    return [(text, ''.join(seq).encode('ascii', 'replace')) for text, seq in records]
+
+
+def concatenate_sequences(seqs):
+    """Join sequences into a uint8 array with a separator byte so that no window spans two of them"""
+    return np.frombuffer(b'\x00'.join(seqs) + b'\x00', dtype=np.uint8)
+
+
+def window_codes(codes, k, alphabet_size):
+    """Encode every window of k symbols as an integer, windows with an invalid symbol are flagged.
+    Returns:
+        tuple: uint64 code of each window start and boolean mask of the valid windows
+    """
+    num_windows = len(codes) - k + 1
+    if num_windows <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+    invalid = codes == INVALID
+    invalid_count = np.concatenate([[0], np.cumsum(invalid)])
+    valid = (invalid_count[k:] - invalid_count[:num_windows]) == 0
+    values = np.where(invalid, 0, codes).astype(np.uint64)
+    window = np.zeros(num_windows, dtype=np.uint64)
+    for j in range(k):
+        window = window * np.uint64(alphabet_size) + values[j:j + num_windows]
+    return window, valid
+
+
+def canonical_nucl_kmers(seq_bytes, k):
+    """Canonical 2-bit codes of the k-mers of a sequence, the smaller of each k-mer and its reverse complement"""
+    codes = NUCL_CODES[seq_bytes]
+    forward, valid = window_codes(codes, k, 4)
+    complement = np.where(codes == INVALID, INVALID, 3 - codes).astype(np.uint8)
+    reverse, _ = window_codes(complement[::-1], k, 4)
+    return np.minimum(forward, reverse[::-1]), valid
+
+
+def translate_frames(seq_bytes):
+    """Translate a nucleotide sequence in all six frames with genetic code 1.
+    Stop codons and codons with ambiguity codes translate to the invalid symbol.
+    Returns:
+        list: uint8 amino acid code arrays, one per frame
+    """
+    codes = NUCL_CODES[seq_bytes]
+    complement = np.where(codes == INVALID, INVALID, 3 - codes).astype(np.uint8)[::-1]
+    frames = list()
+    for strand in (codes, complement):
+        for offset in range(3):
+            num_codons = (len(strand) - offset) // 3
+            codons = strand[offset:offset + 3 * num_codons].reshape(num_codons, 3).astype(np.int64)
+            ambiguous = (codons == INVALID).any(axis=1)
+            index = np.where(ambiguous, 0, 16 * codons[:, 0] + 4 * codons[:, 1] + codons[:, 2])
+            frames.append(np.where(ambiguous, INVALID, CODON_TABLE[index]).astype(np.uint8))
+    return frames
+
+
+# a sample is screened for its nucleotide and protein markers, so a few entries cover the samples in flight
+SAMPLE_KMER_MEMO_SIZE = 4
+
+_sample_kmer_memo = OrderedDict()
+_sample_kmer_lock = threading.Lock()
+
+
+def sample_kmers(fasta_path, kind, k):
+    """Return the sorted distinct k-mer codes of a sample FASTA.
+    Nucleotide k-mers are canonical, protein k-mers are taken from the six frame translation.
+    Results are memoized on the file contents as several marker searches share one sample, only the
+    SAMPLE_KMER_MEMO_SIZE most recently used k-mer sets are kept so batch runs do not accumulate them.
+    """
+    memo_key = (file_digest(fasta_path), kind, k)
+    with _sample_kmer_lock:
+        if memo_key in _sample_kmer_memo:
+            _sample_kmer_memo.move_to_end(memo_key)
+            return _sample_kmer_memo[memo_key]
+
+    seqs = [seq for text, seq in read_fasta_records(fasta_path)]
+    sequence = concatenate_sequences(seqs)
+    if kind == 'nucl':
+        kmers, valid = canonical_nucl_kmers(sequence, k)
+        kmers = np.unique(kmers[valid])
+    else:
+        frames = list()
+        for frame in translate_frames(sequence):
+            window, valid = window_codes(frame, k, len(AMINO_ACIDS))
+            frames.append(window[valid])
+        kmers = np.unique(np.concatenate(frames))
+
+    with _sample_kmer_lock:
+        _sample_kmer_memo[memo_key] = kmers
+        while len(_sample_kmer_memo) > SAMPLE_KMER_MEMO_SIZE:
+            _sample_kmer_memo.popitem(last=False)
+    return kmers
+
+
+class MarkerKmerIndex:
+    """K-mer index over the sequences of a marker reference FASTA.
+
+    The code of every k-mer window of each reference is kept in reference order, nucleotide
+    windows as canonical k-mers and protein windows as amino acid k-mers, so a sample can be
+    screened by counting how many windows of each reference occur in the sample. The index is
+    built once by mob_init and stored next to the FASTA it was built from.
+    """
+
+    def __init__(self, kind, k, codes, offsets, lengths, digest):
+        self.kind = kind
+        self.k = k
+        self.codes = codes
+        self.offsets = offsets
+        self.lengths = lengths
+        self.digest = digest
+
+    @classmethod
+    def build(cls, fasta_path, kind):
+        """Build the index of a marker FASTA
+        Args:
+            fasta_path (str): marker reference FASTA
+            kind (str): 'nucl' for nucleotide markers, 'prot' for protein markers
+        """
+        k = NUCL_KMER_SIZE if kind == 'nucl' else PROT_KMER_SIZE
+        seqs = [seq for text, seq in read_fasta_records(fasta_path)]
+        codes = list()
+        offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        for i, seq in enumerate(seqs):
+            if kind == 'nucl':
+                window, valid = canonical_nucl_kmers(np.frombuffer(seq, dtype=np.uint8), k)
+            else:
+                window, valid = window_codes(AA_CODES[np.frombuffer(seq, dtype=np.uint8)], k, len(AMINO_ACIDS))
+            window[~valid] = AMBIGUOUS_KMER
+            codes.append(window)
+            offsets[i + 1] = offsets[i] + len(window)
+        if len(codes) > 0:
+            codes = np.concatenate(codes)
+        else:
+            codes = np.zeros(0, dtype=np.uint64)
+        lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+        return cls(kind, k, codes, offsets, lengths, file_digest(fasta_path))
+
+    def save(self, path):
+        np.savez(path, version=KMER_INDEX_VERSION, kind=self.kind, k=self.k, codes=self.codes, offsets=self.offsets,
+                 lengths=self.lengths, digest=self.digest)
+
+    @classmethod
+    def load(cls, fasta_path):
+        """Load the index of a marker FASTA, returning None when it is missing or out of date"""
+        path = index_path(fasta_path)
+        if not os.path.isfile(path):
+            return None
+        with np.load(path) as data:
+            if int(data['version']) != KMER_INDEX_VERSION or str(data['digest']) != file_digest(fasta_path):
+                logging.warning('K-mer index {} is out of date with {}, ignoring it'.format(path, fasta_path))
+                return None
+            return cls(str(data['kind']), int(data['k']), data['codes'], data['offsets'], data['lengths'],
+                       str(data['digest']))
+
+    def min_shared_kmers(self, min_ident, min_cov):
+        """Minimum number of windows of each reference which must occur in a sample for a hit to pass the filters.
+        A nucleotide hit contains the exact megablast seed, so one shared k-mer is needed. A protein hit
+        of L alignment columns with at most m non identical columns keeps at least L - k + 1 - k * m
+        exact windows, with L at least the covered query length and m at most (1 - identity) * L.
+        BLAST rounds pident and qcovhsp so both thresholds are loosened slightly.
+        Returns:
+            ndarray: the bound of each reference, references with a bound of zero are always searched
+        """
+        if self.kind == 'nucl':
+            return np.ones(len(self.lengths), dtype=np.int64)
+        mismatch_rate = 1 - (float(min_ident) - 0.01) / 100
+        min_columns = self.lengths * max(0.0, float(min_cov) - 1) / 100
+        bound = min_columns * (1 - self.k * mismatch_rate) - self.k + 1
+        return np.maximum(0, np.ceil(bound)).astype(np.int64)
+
+    def candidates(self, sample_fasta, min_ident, min_cov):
+        """Flag the references which may have a hit in the sample passing the identity and coverage thresholds"""
+        sample = sample_kmers(sample_fasta, self.kind, self.k)
+        present = self.codes == AMBIGUOUS_KMER
+        if len(sample) > 0:
+            position = np.minimum(np.searchsorted(sample, self.codes), len(sample) - 1)
+            present |= sample[position] == self.codes
+        # windows present before each offset, so references without windows count none of their neighbours'
+        cumulative = np.concatenate([[0], np.cumsum(present, dtype=np.int64)])
+        shared = cumulative[self.offsets[1:]] - cumulative[self.offsets[:-1]]
+        has_windows = self.offsets[1:] > self.offsets[:-1]
+        # references too short to hold a k-mer are always searched
+        return (shared >= self.min_shared_kmers(min_ident, min_cov)) | ~has_windows
+
+
+def build_marker_index(fasta_path, kind):
+    """Build and store the k-mer index of a marker FASTA, returning the index path"""
+    path = index_path(fasta_path)
+    index = MarkerKmerIndex.build(fasta_path, kind)
+    index.save(path)
+    return path
+
+
+def prescreen_markers(ref_fasta, sample_fasta, min_ident, min_cov, out_fasta):
+    """Write the marker references which can hit the sample to out_fasta.
+    Searching only these references gives the same hits as searching all of them, as BLAST scores
+    each query independently against the unchanged sample database.
+    Args:
+        ref_fasta (str): marker reference FASTA used as the BLAST query
+        sample_fasta (str): sample FASTA the BLAST database was built from
+        min_ident (float): minimum pident of a reported hit
+        min_cov (float): minimum qcovhsp of a reported hit
+        out_fasta (str): path to write the candidate references to
+    Returns:
+        str: FASTA to use as the query, ref_fasta itself when there is no index or nothing was screened
+            out, None when no reference can hit the sample
+    """
+    index = MarkerKmerIndex.load(ref_fasta)
+    if index is None:
+        logging.info('No k-mer index for {}, searching all references'.format(ref_fasta))
+        return ref_fasta
+    candidates = index.candidates(sample_fasta, min_ident, min_cov)
+    logging.info('K-mer prescreen kept {} of {} references in {}'.format(int(candidates.sum()), len(candidates),
+                                                                         ref_fasta))
+    if candidates.all():
+        return ref_fasta
+    if not candidates.any():
+        return None
+    with open(out_fasta, 'w') as out:
+        for keep, (text, seq) in zip(candidates, read_fasta_records(ref_fasta)):
+            if keep:
+                out.write(text)
+    return out_fasta
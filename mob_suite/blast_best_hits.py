@@ -2,6 +2,7 @@
 import logging, os, sys
 from argparse import (ArgumentParser, FileType)
 from mob_suite.blast import BlastReader
+from mob_suite.utils import fixStart, filter_overlaping_records
 
 
 def parse_args():
@@ -12,82 +13,6 @@ def parse_args():
     parser.add_argument('--min_overlap', type=str, required=False, help='Minimum bp overlap', default=5)
     return parser.parse_args()
 
-def filter_overlaping_records(blast_df, overlap_threshold,contig_id_col,contig_start_col,contig_end_col,bitscore_col):
-    prev_contig_id = ''
-    prev_index = -1
-    prev_contig_start = -1
-    prev_contig_end = -1
-    prev_score = -1
-    filter_indexes = list()
-    exclude_filter = dict()
-
-
-    for index, row in blast_df.iterrows():
-        contig_id = row['sseqid']
-        contig_start = row['sstart']
-        contig_end = row['send']
-        score = row['bitscore']
-
-        if prev_contig_id == '':
-            prev_index = index
-            prev_contig_id = contig_id
-            prev_contig_start = contig_start
-            prev_contig_end = contig_end
-            prev_score = score
-            continue
-
-        if contig_id != prev_contig_id:
-            prev_index = index
-            prev_contig_id = contig_id
-            prev_contig_start = contig_start
-            prev_contig_end = contig_end
-            prev_score = score
-            continue
-
-        if (contig_start >= prev_contig_start and contig_start <= prev_contig_end) or (contig_end >= prev_contig_start and contig_end <= prev_contig_end):
-            overlap = abs(contig_start - prev_contig_end)
-            if overlap > overlap_threshold:
-                if prev_score > score:
-                    filter_indexes.append(index)
-                else:
-                    filter_indexes.append(prev_index)
-
-
-        prev_index = index
-        prev_contig_id = contig_id
-        prev_contig_start = contig_start
-        prev_contig_end = contig_end
-        prev_score = score
-
-    for index in exclude_filter:
-        filter_indexes.append(index)
-    indexes = dict()
-    for i in blast_df.iterrows():
-        indexes[i[0]] = ''
-
-    blast_df.drop(filter_indexes, inplace=True)
-
-    return blast_df.reset_index(drop=True)
-
-
-def fixStart(blast_df):
-    for index, row in blast_df.iterrows():
-        sstart = blast_df.at[index, 'sstart']
-        send = blast_df.at[index, 'send']
-        # print "{}\t{}".format(sstart,send)
-        if send < sstart:
-            temp = sstart
-            blast_df.at[index, 'sstart'] = send
-            blast_df.at[index, 'send'] = temp
-        # print "====>{}\t{}".format(self.blast_df.at[index, 'sstart'], self.blast_df.at[index, 'send'])
-        qstart = blast_df.at[index, 'qstart']
-        qend = blast_df.at[index, 'qend']
-        if qend < qstart:
-            temp = qstart
-            blast_df.at[index, 'qstart'] = qend
-            blast_df.at[index, 'qend'] = temp
-    return blast_df
-
 def filter_blast(blast_results_file, min_ident, min_cov, evalue, overlap):
     if os.path.getsize(blast_results_file) == 0:
         return dict()
@@ -95,14 +20,7 @@ def filter_blast(blast_results_file, min_ident, min_cov, evalue, overlap):
     blast_df = blast_df.loc[blast_df['pident'] >= min_ident]
     blast_df = blast_df.loc[blast_df['qcovhsp'] >= min_cov]
     blast_df = fixStart(blast_df)
-    blast_df = blast_df.sort_values(['sseqid','sstart', 'send', 'bitscore'], ascending=[True, True, True, False])
-    blast_df = blast_df.reset_index(drop=True)
-    size = str(len(blast_df))
-    prev_size = 0
-    while size != prev_size:
-        blast_df = filter_overlaping_records(blast_df, overlap, 'sseqid', 'sstart', 'send', 'bitscore')
-        prev_size = size
-        size = str(len(blast_df))
+    blast_df = filter_overlaping_records(blast_df, overlap, 'sseqid', 'sstart', 'send', 'bitscore')
 
     return blast_df
 
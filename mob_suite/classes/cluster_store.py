@@ -0,0 +1,172 @@
+import logging
+import os
+import sqlite3
+from collections import OrderedDict
+from contextlib import contextmanager
+
+CLUSTER_STORE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS thresholds (
+    level INTEGER PRIMARY KEY,
+    distance TEXT NOT NULL,
+    next_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sequences (
+    seq_order INTEGER PRIMARY KEY AUTOINCREMENT,
+    accession TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS assignments (
+    accession TEXT NOT NULL,
+    level INTEGER NOT NULL,
+    cluster INTEGER NOT NULL,
+    PRIMARY KEY (accession, level)
+);
+CREATE INDEX IF NOT EXISTS assignments_cluster ON assignments (level, cluster);
+'''
+
+
+def cluster_store_path(cluster_file):
+    """Cluster stores are kept next to the cluster assignment file they were imported from"""
+    return os.path.splitext(cluster_file)[0] + '.sqlite'
+
+
+class ClusterStore:
+    """SQLite store of the cluster assignments of every sequence at each distance threshold.
+
+    Assignments are indexed by accession and by cluster, and the next free cluster number of each
+    threshold is kept with them, so neither has to be recomputed from every record. Records are
+    added in a single transaction and exported in the order they were added, in the tab delimited
+    format of clusters.txt which remains the exchange format.
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with self.connect() as conn:
+            conn.executescript(CLUSTER_STORE_SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.store_path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def thresholds(self):
+        """Distance thresholds as written in the cluster file header, by level"""
+        with self.connect() as conn:
+            return [distance for (distance,) in conn.execute('SELECT distance FROM thresholds ORDER BY level')]
+
+    def next_ids(self):
+        """First unused cluster number at each threshold"""
+        with self.connect() as conn:
+            return [next_id for (next_id,) in conn.execute('SELECT next_id FROM thresholds ORDER BY level')]
+
+    def __len__(self):
+        with self.connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM sequences').fetchone()[0]
+
+    def __contains__(self, accession):
+        return self.get(accession) is not None
+
+    def get(self, accession):
+        """Clusters of a sequence at each threshold, or None if it has not been assigned"""
+        with self.connect() as conn:
+            clusters = [cluster for (cluster,) in conn.execute(
+                'SELECT cluster FROM assignments WHERE accession = ? ORDER BY level', (accession,))]
+        if len(clusters) == 0:
+            return None
+        return clusters
+
+    def members(self, level, cluster):
+        """Accessions of the sequences in a cluster at the threshold of the given level, in the order they were added"""
+        with self.connect() as conn:
+            return [accession for (accession,) in conn.execute(
+                'SELECT a.accession FROM assignments a JOIN sequences s ON a.accession = s.accession '
+                'WHERE a.level = ? AND a.cluster = ? ORDER BY s.seq_order', (level, int(cluster)))]
+
+    def assignments(self):
+        """Clusters of every sequence in the order they were added"""
+        clusters = OrderedDict()
+        with self.connect() as conn:
+            for accession, cluster in conn.execute(
+                    'SELECT s.accession, a.cluster FROM sequences s JOIN assignments a ON s.accession = a.accession '
+                    'ORDER BY s.seq_order, a.level'):
+                if not accession in clusters:
+                    clusters[accession] = list()
+                clusters[accession].append(cluster)
+        return clusters
+
+    def add(self, cluster_assignments, thresholds=None):
+        """Add or replace the clusters of sequences in one transaction, advancing the next free cluster numbers.
+        Args:
+            cluster_assignments (dict): clusters at each threshold keyed by accession
+            thresholds (list): distance thresholds, required when the store is empty
+        """
+        with self.connect() as conn:
+            next_ids = [next_id for (next_id,) in conn.execute('SELECT next_id FROM thresholds ORDER BY level')]
+            if len(next_ids) == 0:
+                if thresholds is None:
+                    ex_msg = 'Error, cluster store {} has no distance thresholds'.format(self.store_path)
+                    logging.error(ex_msg)
+                    raise Exception(ex_msg)
+                conn.executemany('INSERT INTO thresholds (level, distance, next_id) VALUES (?, ?, 1)',
+                                 [(level, str(distance)) for level, distance in enumerate(thresholds)])
+                next_ids = [1] * len(thresholds)
+
+            rows = list()
+            for accession in cluster_assignments:
+                clusters = [int(cluster) for cluster in cluster_assignments[accession]]
+                if len(clusters) != len(next_ids):
+                    ex_msg = 'Error, {} has {} clusters but the store has {} thresholds'.format(
+                        accession, len(clusters), len(next_ids))
+                    logging.error(ex_msg)
+                    raise Exception(ex_msg)
+                for level, cluster in enumerate(clusters):
+                    rows.append((str(accession), level, cluster))
+                    next_ids[level] = max(next_ids[level], cluster + 1)
+
+            conn.executemany('INSERT OR IGNORE INTO sequences (accession) VALUES (?)',
+                             [(str(accession),) for accession in cluster_assignments])
+            conn.executemany('INSERT OR REPLACE INTO assignments (accession, level, cluster) VALUES (?, ?, ?)', rows)
+            conn.executemany('UPDATE thresholds SET next_id = ? WHERE level = ?',
+                             [(next_id, level) for level, next_id in enumerate(next_ids)])
+
+    def import_file(self, cluster_file):
+        """Add the assignments of a cluster file with a header of id followed by the thresholds"""
+        with open(cluster_file, 'r') as fh:
+            header = fh.readline().rstrip('\n').split('\t')
+            cluster_assignments = OrderedDict()
+            for line in fh:
+                row = line.rstrip('\n').split('\t')
+                if len(row) < 2:
+                    continue
+                cluster_assignments[row[0]] = row[1:]
+        self.add(cluster_assignments, header[1:])
+        logging.info('Imported {} cluster assignments from {} into {}'.format(len(cluster_assignments), cluster_file,
+                                                                              self.store_path))
+
+    def export_file(self, cluster_file, header):
+        """Write every assignment as a tab delimited cluster file"""
+        with open(cluster_file, 'w') as out:
+            out.write("\t".join(map(str, header)) + "\n")
+            clusters = self.assignments()
+            for id in clusters:
+                out.write("{}\t{}".format(id, "\t".join(map(str, clusters[id]))) + "\n")
+        # the store stays current with respect to the file exported from it
+        os.utime(self.store_path)
+
+
+def open_cluster_store(cluster_file, store_path=None):
+    """Open the cluster store of a cluster file, importing the file when the store is missing or older than it"""
+    if store_path is None:
+        store_path = cluster_store_path(cluster_file)
+    if os.path.isfile(store_path) and os.path.getmtime(store_path) >= os.path.getmtime(cluster_file):
+        return ClusterStore(store_path)
+    if os.path.isfile(store_path):
+        logging.info('Cluster store {} is older than {}, rebuilding it'.format(store_path, cluster_file))
+        os.remove(store_path)
+    store = ClusterStore(store_path)
+    if os.path.getsize(cluster_file) > 0:
+        store.import_file(cluster_file)
+    return store
@@ -1,84 +1,176 @@
 #!/usr/bin/env python
 
-from subprocess import Popen, PIPE
-import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
 
-class mcl:
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import scipy.sparse.csgraph
+
+# column of the query id, subject id and evalue in BLAST tabular output
+BLAST_ABC_COLS = [0, 1, 14]
+
+# -log10(evalue) of edges whose evalue is reported as 0
+MAX_NEG_LOG10 = 200
 
 
-    def __init__(self, blast_results_file, working_dir,inflation=1.5):
-        blast_abc = os.path.join(working_dir, 'seq.abc')
-        cols = [0,1,14]
-        self.prep_blast(blast_results_file, blast_abc, cols)
-        mci_outfile = os.path.join(working_dir, 'seq.mci')
-        tab_outfile = os.path.join(working_dir, 'seq.tab')
-        clust_outfile = os.path.join(working_dir, 'seq.clust')
-        self.mcxload(blast_abc,mci_outfile, tab_outfile)
-        self.run_mcl(mci_outfile,tab_outfile,clust_outfile,inflation,1)
-        self.clusters = self.parse_mcl(clust_outfile)
+class mcl:
+    """Markov clustering of the sequences of a BLAST result.
+
+    The hits form an undirected graph weighted by -log10(evalue), as loaded by
+    `mcxload --stream-mirror --stream-neg-log10`, that is clustered in process on a
+    scipy.sparse matrix. Each iteration expands the column stochastic matrix by squaring
+    it, inflates it by raising the entries to the inflation power and prunes the smallest
+    entries of every column, until the columns no longer change. Clusters are numbered
+    from 0 largest first as in the output of the mcl program.
+    """
+
+    def __init__(self, blast_results, inflation=1.5, num_threads=1, prune_threshold=1.0 / 4000,
+                 max_column_entries=500, max_iterations=100, tolerance=1e-4):
+        """
+        Args:
+            blast_results (str or DataFrame): BLAST tabular output file, or its table with qseqid, sseqid and evalue columns
+            inflation (float): inflation power, larger values give smaller clusters
+            num_threads (int): number of column blocks expanded concurrently
+            prune_threshold (float): entries below this value are removed from each column
+            max_column_entries (int): number of largest entries kept in each column
+            max_iterations (int): iterations run when the matrix does not converge
+            tolerance (float): largest column chaos of a converged matrix
+        """
+        self.inflation = inflation
+        self.num_threads = num_threads
+        self.prune_threshold = prune_threshold
+        self.max_column_entries = max_column_entries
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        labels, matrix = self.load_graph(blast_results)
+        self.clusters = self.cluster(labels, matrix)
 
     def getclusters(self):
         return self.clusters
 
-
-    def prep_blast(self,blast_results_file,outfile,col_numbers):
-        with open(blast_results_file) as f:
-            content = f.readlines()
-            content = [x.strip() for x in content]
-            f.close()
-
-        with open(outfile,'w') as f:
-            for line in content:
-                row = line.split("\t")
-                selection = list()
-                for col in col_numbers:
-                    selection.append(row[col])
-                f.write("\t".join(selection) + "\n")
-            f.close()
-
-
-
-    def  mcxload(self, blast_results_file,mci_outfile, tab_outfile):
-        p = Popen(['mcxload',
-                   '-abc', blast_results_file,
-                   '--stream-mirror',
-                   '--stream-neg-log10',
-                   '-o', mci_outfile,
-                   '-write-tab', tab_outfile,],
-                  stdout=PIPE,
-                  stderr=PIPE)
-
-
-        p.wait()
-        stdout = p.stdout.read()
-        print(stdout)
-        stderr = p.stderr.read()
-        print(stderr)
-
-    def run_mcl(self,mci_outfile,tab_outfile,cluster_outfile,inflation,num_threads):
-        p = Popen(['mcl',
-                   mci_outfile,
-                   '-I',str(inflation),
-                   '-use-tab', tab_outfile,
-                   '-o',cluster_outfile],
-                  stdout=PIPE,
-                  stderr=PIPE)
-
-        p.wait()
-        stdout = p.stdout.read()
-        stderr = p.stderr.read()
-
-    def parse_mcl(self,cluster_outfile):
-        with open(cluster_outfile) as f:
-            content = f.readlines()
-            content = [x.strip() for x in content]
-        f.close()
-        count = 0
+    def load_graph(self, blast_results):
+        """Read the edges of the BLAST hits into a symmetric sparse matrix.
+        Labels are numbered in the order they are first seen, mirrored and repeated edges keep
+        their largest weight and edges with a non-positive weight are dropped.
+        Returns:
+            tuple: array of labels and the csc_matrix of edge weights between them
+        """
+        if isinstance(blast_results, pd.DataFrame):
+            edges = blast_results[['qseqid', 'sseqid', 'evalue']]
+        else:
+            edges = pd.read_csv(blast_results, sep='\t', header=None, usecols=BLAST_ABC_COLS)
+        queries = edges.iloc[:, 0].astype(str).values
+        subjects = edges.iloc[:, 1].astype(str).values
+        with np.errstate(divide='ignore'):
+            weights = np.minimum(-np.log10(edges.iloc[:, 2].astype(float).values), MAX_NEG_LOG10)
+
+        codes, labels = pd.factorize(np.column_stack((queries, subjects)).ravel())
+        codes = codes.reshape(-1, 2)
+        num_nodes = len(labels)
+        keep = (weights > 0) & (codes[:, 0] != codes[:, 1])
+        rows = np.concatenate((codes[keep, 0], codes[keep, 1]))
+        cols = np.concatenate((codes[keep, 1], codes[keep, 0]))
+        weights = np.concatenate((weights[keep], weights[keep]))
+
+        edge_keys = rows.astype(np.int64) * num_nodes + cols
+        order = np.lexsort((-weights, edge_keys))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = edge_keys[order][1:] != edge_keys[order][:-1]
+        order = order[first]
+        matrix = scipy.sparse.csc_matrix((weights[order], (rows[order], cols[order])), shape=(num_nodes, num_nodes))
+        logging.info('Loaded {} nodes and {} edges for Markov clustering'.format(num_nodes, matrix.nnz // 2))
+        return np.asarray(labels, dtype=str), matrix
+
+    def add_loops(self, matrix):
+        """Give every node a loop weighted as its heaviest edge, or 1 when it has none"""
+        loops = matrix.max(axis=0).toarray().ravel()
+        loops[loops <= 0] = 1
+        return (matrix + scipy.sparse.diags(loops, format='csc')).tocsc()
+
+    def normalize(self, matrix):
+        """Scale every column to sum to one"""
+        sums = np.asarray(matrix.sum(axis=0)).ravel()
+        sums[sums == 0] = 1
+        return (matrix @ scipy.sparse.diags(1.0 / sums, format='csc')).tocsc()
+
+    def expand(self, matrix):
+        """Square the matrix, multiplying column blocks on separate threads"""
+        num_nodes = matrix.shape[1]
+        num_blocks = max(1, min(self.num_threads, num_nodes))
+        if num_blocks == 1:
+            return (matrix @ matrix).tocsc()
+        bounds = np.linspace(0, num_nodes, num_blocks + 1).astype(int)
+        with ThreadPoolExecutor(max_workers=num_blocks) as executor:
+            blocks = list(executor.map(lambda start, end: (matrix @ matrix[:, start:end]).tocsc(),
+                                       bounds[:-1], bounds[1:]))
+        return scipy.sparse.hstack(blocks, format='csc')
+
+    def inflate(self, matrix):
+        matrix = matrix.copy()
+        matrix.data = np.power(matrix.data, self.inflation)
+        return self.normalize(matrix)
+
+    def prune(self, matrix):
+        """Keep the largest max_column_entries entries of each column that are at least prune_threshold.
+        The largest entry of a column is always kept so no column is emptied."""
+        counts = np.diff(matrix.indptr)
+        cols = np.repeat(np.arange(matrix.shape[1]), counts)
+        maxima = np.zeros(matrix.shape[1])
+        filled = counts > 0
+        maxima[filled] = np.maximum.reduceat(matrix.data, matrix.indptr[:-1][filled])
+        keep = (matrix.data >= self.prune_threshold) | (matrix.data == maxima[cols])
+
+        # ranking is only needed in the columns with too many entries left
+        kept_counts = np.bincount(cols[keep], minlength=matrix.shape[1])
+        crowded = keep & (kept_counts[cols] > self.max_column_entries)
+        if crowded.any():
+            positions = np.nonzero(crowded)[0]
+            order = positions[np.lexsort((-matrix.data[positions], cols[positions]))]
+            starts = np.searchsorted(cols[order], cols[order], side='left')
+            keep[order[np.arange(len(order)) - starts >= self.max_column_entries]] = False
+
+        if keep.all():
+            return matrix
+        pruned = scipy.sparse.csc_matrix((matrix.data[keep], matrix.indices[keep],
+                                          np.concatenate(([0], np.cumsum(np.bincount(cols[keep], minlength=matrix.shape[1]))))),
+                                         shape=matrix.shape)
+        return self.normalize(pruned)
+
+    def chaos(self, matrix):
+        """Largest difference between the maximum of a column and its sum of squares relative to it,
+        zero once every column is spread evenly over its attractors"""
+        if matrix.nnz == 0:
+            return 0
+        squares = matrix.multiply(matrix)
+        sum_squares = np.asarray(squares.sum(axis=0)).ravel()
+        maxima = matrix.max(axis=0).toarray().ravel()
+        filled = sum_squares > 0
+        return float(np.max(maxima[filled] / sum_squares[filled] - 1))
+
+    def cluster(self, labels, matrix):
+        """Iterate to convergence and return the cluster number of each label"""
         clusters = dict()
-        for line in content:
-            members = line.split("\t")
-            for member in members:
-                clusters[member] = count
-            count+=1
+        if len(labels) == 0:
+            return clusters
+
+        matrix = self.normalize(self.add_loops(matrix))
+        for iteration in range(self.max_iterations):
+            matrix = self.prune(self.inflate(self.expand(matrix)))
+            if self.chaos(matrix) < self.tolerance:
+                logging.info('Markov clustering converged after {} iterations'.format(iteration + 1))
+                break
+        else:
+            logging.warning('Markov clustering did not converge after {} iterations'.format(self.max_iterations))
+
+        # nodes are clustered with the attractors their columns flow to
+        num_components, components = scipy.sparse.csgraph.connected_components(matrix, directed=False)
+        sizes = np.bincount(components, minlength=num_components)
+        first_member = np.full(num_components, len(labels))
+        np.minimum.at(first_member, components, np.arange(len(labels)))
+        ranks = np.empty(num_components, dtype=np.int64)
+        ranks[np.lexsort((first_member, -sizes))] = np.arange(num_components)
+        for label, component in zip(labels, components):
+            clusters[label] = int(ranks[component])
         return clusters
-
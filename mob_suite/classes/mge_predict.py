@@ -1,274 +1,202 @@
+import logging
+import os
 import pandas as pd
 import numpy as np
-from pandas.io.common import EmptyDataError
-from blast import BlastReader
-import sys
+from mob_suite.blast import BlastReader
+from mob_suite.utils import fixStart
 from collections import OrderedDict
 from operator import itemgetter
 
 
+def covered_bases(seq_ids, starts, ends):
+    """Number of bases of each sequence covered by the union of its hit intervals.
+    The intervals of every sequence are merged in one sort over the whole table, each sequence
+    being shifted past the coordinates of the one before it so a single running maximum of the
+    interval ends finds where the merged intervals of all sequences begin and end.
+    Args:
+        seq_ids (array): sequence id of each hit
+        starts (array): start of each hit, at most its end
+        ends (array): end of each hit, coordinates are inclusive
+    Returns:
+        OrderedDict: covered bases of each sequence in order of first appearance
+    """
+    covered = OrderedDict()
+    if len(seq_ids) == 0:
+        return covered
+    codes, uniques = pd.factorize(np.asarray(seq_ids))
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    offsets = codes.astype(np.int64) * (int(ends.max()) + 1)
+    order = np.lexsort((starts, codes))
+    starts = (starts + offsets)[order]
+    ends = (ends + offsets)[order]
+
+    reach = np.maximum.accumulate(ends)
+    block_starts = np.ones(len(order), dtype=bool)
+    block_starts[1:] = starts[1:] > reach[:-1]
+    first = np.nonzero(block_starts)[0]
+    last = np.append(first[1:], len(order)) - 1
+    lengths = reach[last] - starts[first] + 1
+    totals = np.bincount(codes[order][first], weights=lengths, minlength=len(uniques))
+    for seq_id, total in zip(uniques, totals):
+        covered[seq_id] = int(total)
+    return covered
 
 
 class mge_predict:
-    circular_contigs = list()
-    valid_clusters = dict()
-    cluster_scores = dict()
-    blast_df =  pd.DataFrame()
-    seq_sizes = dict()
-    seq_scores = dict()
-    contig_coverage = dict()
-    database_seq_coverage = dict()
-    mask_ref_contig_ids = dict()
-    mask_ref_cluster_ids = dict()
-    plasmid_contigs = dict()
-
-    def __init__(self,blast_results):
-        blast_reader = BlastReader(blast_results)
-        self.blast_df = blast_reader.df
-        self.filter_dataframe(1000,400000,60)
+    """Coverage based prediction of the plasmid contigs of an assembly.
+
+    Contigs are placed in the reference plasmid clusters whose sequences they cover best,
+    after removing the hits to references covered less than the minimum by the assembly.
+    All state is kept on the instance so predictions for many samples can run concurrently.
+    """
+
+    def __init__(self, blast_results, min_length=1000, max_length=400000, min_cov=60, min_ref_cov=60):
+        """
+        Args:
+            blast_results (DataFrame or str): hits of the contigs on the plasmid references or a BLAST table file of them
+            min_length (int): minimum contig length
+            max_length (int): maximum contig length
+            min_cov (float): minimum coverage of a contig by its hits
+            min_ref_cov (float): minimum coverage of a reference by the hits of the assembly
+        """
+        self.cluster_scores = dict()
+        self.seq_sizes = dict()
+        self.seq_scores = dict()
+        self.contig_coverage = dict()
+        self.database_seq_coverage = dict()
+        self.mask_ref_contig_ids = dict()
+        self.plasmid_contigs = dict()
+
+        if isinstance(blast_results, pd.DataFrame):
+            self.blast_df = blast_results.copy()
+        elif os.path.getsize(blast_results) == 0:
+            self.blast_df = pd.DataFrame()
+        else:
+            self.blast_df = BlastReader(blast_results).df
+        if len(self.blast_df) == 0:
+            return
 
+        self.filter_dataframe(min_length, max_length, min_cov)
+        if len(self.blast_df) == 0:
+            return
         self.fixStart()
+        self.blast_df['qseqid'] = self.blast_df['qseqid'].astype(str)
+        self.blast_df['sseqid'] = self.blast_df['sseqid'].astype(str)
+        self.blast_df = self.blast_df.sort_values(['qseqid', 'qstart', 'qend'], ascending=[True, True, True])
         self.blast_df = self.blast_df.reset_index(drop=True)
-        self.blast_df = self.blast_df.sort_values(['qseqid', 'qstart','qend'], ascending=[True, True, True])
-        #print self.blast_df
 
-        self.blast_df = self.blast_df.reset_index(drop=True)
         self.init_contig_info()
-        contig_covered_bases = self.calc_covered_seq_bases('qseqid', 'qstart', 'qend')
-        #print contig_covered_bases
-        #print contig_covered_bases
-        self.contig_coverage = self.calc_perc_coverage(contig_covered_bases)
-        self.blast_df = self.blast_df.sort_values(['sseqid', 'sstart', 'send'], ascending=[True, True, True])
-        self.blast_df = self.blast_df.reset_index(drop=True)
-        database_covered_bases = self.calc_covered_seq_bases('sseqid', 'sstart', 'send')
-        #print database_covered_bases
-        self.database_seq_coverage = self.calc_perc_coverage(database_covered_bases)
+        self.contig_coverage = self.calc_perc_coverage(self.calc_covered_seq_bases('qseqid', 'qstart', 'qend'))
+        self.database_seq_coverage = self.calc_perc_coverage(self.calc_covered_seq_bases('sseqid', 'sstart', 'send'))
 
-        self.filter_low_cov_hits(60)
+        self.filter_low_cov_hits(min_ref_cov)
+        self.blast_df = self.blast_df.loc[~self.blast_df['sseqid'].isin(list(self.mask_ref_contig_ids))]
         self.blast_df = self.blast_df.reset_index(drop=True)
-
         for id in self.mask_ref_contig_ids:
-            self.blast_df = self.blast_df[self.blast_df["sseqid"]  != id]
             if id in self.seq_sizes:
-                del(self.seq_sizes[id])
-                del(self.database_seq_coverage[id])
-        self.blast_df = self.blast_df.reset_index(drop=True)
-
-        for contig_id in self.seq_scores:
-            scores = dict()
-            for match_id in self.seq_scores[contig_id]:
-                if match_id in self.mask_ref_contig_ids:
-                    continue
-                scores[match_id] = self.seq_scores[contig_id][match_id]
-
-            self.seq_scores[contig_id] = OrderedDict(sorted(list(scores.items()), key=itemgetter(1), reverse=True))
-            top_match = -1
-            scores = dict()
-            for match_id in self.seq_scores[contig_id]:
-                if self.seq_scores[contig_id][match_id] > top_match:
-                    top_match = self.seq_scores[contig_id][match_id]
-                if self.seq_scores[contig_id][match_id] / top_match * 100 < 90:
-                    continue
-                scores[match_id] = self.seq_scores[contig_id][match_id]
-            self.seq_scores[contig_id] = OrderedDict(sorted(list(scores.items()), key=itemgetter(1), reverse=True))
-
-
-        temp = dict()
-        for contig_id in self.seq_scores:
-            if len(self.seq_scores[contig_id]) > 0:
-                temp[contig_id] = self.seq_scores[contig_id]
-                for match_id in self.seq_scores[contig_id]:
-                    score = self.seq_scores[contig_id][match_id]
-                    acs,cluster_id = match_id.split('|')
-                    if not cluster_id in self.cluster_scores:
-                        self.cluster_scores[cluster_id] = 0
-                    self.cluster_scores[cluster_id]+= score
-        self.seq_scores = temp
-
-        for contig_id in self.seq_scores:
-            if len(self.seq_scores[contig_id]) == 1:
-                continue
-            prev_cluster_id = -1
-            temp = dict()
-            for match_id in self.seq_scores[contig_id]:
-                acs, cluster_id = match_id.split('|')
-                score = self.cluster_scores[cluster_id]
-                if prev_cluster_id == -1:
-                    prev_cluster_id = cluster_id
-                    prev_cluster_score = score
-                    temp[match_id] = self.seq_scores[contig_id][match_id]
-
-                if float(score)/prev_cluster_score*100 < 90:
-                    continue
-
-                temp[match_id] = self.seq_scores[contig_id][match_id]
-            self.seq_scores[contig_id] = temp
-
-        for contig_id in self.seq_scores:
-            placement = 'single'
-            matches = self.seq_scores[contig_id]
+                del self.seq_sizes[id]
+                del self.database_seq_coverage[id]
 
+        self.select_top_matches(90)
+        self.select_top_clusters(90)
+        self.place_contigs()
 
-            clusters = dict()
-            match_ids = dict()
-            sizes = list()
-            for match_id in matches:
-                acs, cluster_id = match_id.split('|')
-                clusters[cluster_id] = acs
-                sizes.append(self.seq_sizes[match_id])
-
-            mininimum = min(sizes)
-            maximum = max(sizes)
-            if mininimum != maximum:
-                size = str(mininimum) +'-' + str(maximum)
-            else:
-                size = mininimum
-            cluster_ids = ','.join(list(clusters.keys()))
-            if len(clusters) > 1:
-                placement = 'multiple'
-            self.plasmid_contigs[contig_id] = {
-                'contig_length': self.seq_sizes[contig_id],
-                'plasmid_membership': placement,
-                'plasmid_cluster_ids': cluster_ids,
-                'contig_cov': self.contig_coverage[contig_id],
-                'cluster_size_range':size
-            }
-
-
-
-
-
-    def filter_dataframe(self, query_len_min, query_len_max,query_cov ):
-
+    def filter_dataframe(self, query_len_min, query_len_max, query_cov):
         self.blast_df = self.blast_df.loc[self.blast_df['qlen'] <= query_len_max]
         self.blast_df = self.blast_df.loc[self.blast_df['qlen'] >= query_len_min]
         self.blast_df = self.blast_df.loc[self.blast_df['qcovs'] >= query_cov]
         self.blast_df = self.blast_df.reset_index(drop=True)
 
-
     def fixStart(self):
-        for index, row in self.blast_df.iterrows():
-            sstart = self.blast_df.at[index, 'sstart']
-            send = self.blast_df.at[index, 'send']
-            #print "{}\t{}".format(sstart,send)
-            if send < sstart:
-                temp = sstart
-                self.blast_df.at[index, 'sstart'] = send
-                self.blast_df.at[index, 'send'] = temp
-            #print "====>{}\t{}".format(self.blast_df.at[index, 'sstart'], self.blast_df.at[index, 'send'])
-            qstart = self.blast_df.at[index, 'qstart']
-            qend = self.blast_df.at[index, 'qend']
-            if qend < qstart:
-                temp = qstart
-                self.blast_df.at[index, 'qstart'] = qend
-                self.blast_df.at[index, 'qend'] = temp
-
-    def get_seq_cov_ranges(self,id_col_name,start_col_name,end_col_name):
-        ranges = dict()
-
-        for index, row in self.blast_df.iterrows():
-            seq_id = row[id_col_name]
-            start = row[start_col_name]
-            end = row[end_col_name]
-            #print "{}\t{}\t{}".format(seq_id,start,end)
-
-            if not seq_id in ranges:
-                ranges[seq_id] = list()
-            ranges[seq_id].append((start,end))
-        #print ranges
-
-        return ranges
+        self.blast_df = fixStart(self.blast_df)
 
-    def summarize_ranges(self,ranges):
-        prev_start = -1
-        prev_end = -1
-        summary = list()
-
-        for start,end in ranges:
-            #print "{}\t{}\t{}\t{}".format(prev_start,prev_end,start,end)
-            if prev_start == -1 :
-                prev_start = start
-                prev_end = end
-                continue
-
-            if start >= prev_start and start <= prev_end:
-                if end > prev_end:
-                    prev_end = end
-                continue
-
-            if start > prev_end:
-                summary.append((prev_start,prev_end))
-                prev_start = -1
-                prev_end= -1
-                
-        if prev_start == -1:
-            summary.append((start, end))
-        else:
-        	summary.append((prev_start, prev_end))
-
-            
-
-        #print summary
-        #sys.exit()
-        return summary
-
-
-    def calc_covered_seq_bases(self,id_col_name,start_col_name,end_col_name):
-        covered_bases = dict()
-        ranges = self.get_seq_cov_ranges(id_col_name,start_col_name,end_col_name)
-        #print ranges
-
-        for seq_id in ranges:
-            summary = self.summarize_ranges(ranges[seq_id])
-            #print summary
-
-            sum = 0
-            for start,end in summary:
-                sum += end - start
-            covered_bases[seq_id] = sum+1
-        #sys.exit()
-        return covered_bases
+    def calc_covered_seq_bases(self, id_col_name, start_col_name, end_col_name):
+        return covered_bases(self.blast_df[id_col_name].values, self.blast_df[start_col_name].values,
+                             self.blast_df[end_col_name].values)
 
     def calc_perc_coverage(self, covered_bases):
         for seq_id in covered_bases:
             if seq_id in self.seq_sizes:
-
-                covered_bases[seq_id] = float(covered_bases[seq_id]) / self.seq_sizes[seq_id]*100
+                covered_bases[seq_id] = float(covered_bases[seq_id]) / self.seq_sizes[seq_id] * 100
             else:
                 covered_bases[seq_id] = -1
-
-
         return covered_bases
 
-    def filter_low_cov_hits(self,cov):
+    def filter_low_cov_hits(self, cov):
         for id in self.database_seq_coverage:
             if self.database_seq_coverage[id] < cov:
                 self.mask_ref_contig_ids[id] = 'Coverage Too Low'
 
-
-
-
     def init_contig_info(self):
+        """Best bitscore of each contig against each reference and the length of every sequence"""
+        pair_scores = self.blast_df.groupby(['qseqid', 'sseqid'], sort=False)['bitscore'].max()
         seq_scores = dict()
+        for (contig_id, match_id), score in zip(pair_scores.index.tolist(), pair_scores.tolist()):
+            if not contig_id in seq_scores:
+                seq_scores[contig_id] = dict()
+            seq_scores[contig_id][match_id] = max(score, 0)
+
+        # the last length reported for a sequence is kept
         seq_sizes = dict()
-        for index, row in self.blast_df.iterrows():
-            if not row['qseqid'] in seq_scores:
-                seq_scores[row['qseqid']] = dict()
+        for id_col, len_col in (('sseqid', 'slen'), ('qseqid', 'qlen')):
+            sizes = self.blast_df.drop_duplicates(id_col, keep='last')
+            seq_sizes.update(zip(sizes[id_col].tolist(), sizes[len_col].tolist()))
+        self.seq_sizes = seq_sizes
+        self.seq_scores = seq_scores
 
+    def select_top_matches(self, min_perc_top_score):
+        """Keep the unmasked references of each contig scoring within min_perc_top_score of its best"""
+        for contig_id in self.seq_scores:
+            scores = sorted([(match_id, score) for match_id, score in self.seq_scores[contig_id].items()
+                             if not match_id in self.mask_ref_contig_ids], key=itemgetter(1), reverse=True)
+            if len(scores) == 0:
+                self.seq_scores[contig_id] = OrderedDict()
+                continue
+            top_score = scores[0][1]
+            self.seq_scores[contig_id] = OrderedDict(
+                (match_id, score) for match_id, score in scores if top_score > 0 and score / top_score * 100 >= min_perc_top_score)
 
-            if not row['sseqid'] in seq_scores[row['qseqid']] :
-                seq_scores[row['qseqid']][row['sseqid']] = 0
+        self.seq_scores = dict((contig_id, matches) for contig_id, matches in self.seq_scores.items() if len(matches) > 0)
+        for contig_id in self.seq_scores:
+            for match_id in self.seq_scores[contig_id]:
+                acs, cluster_id = match_id.split('|')
+                if not cluster_id in self.cluster_scores:
+                    self.cluster_scores[cluster_id] = 0
+                self.cluster_scores[cluster_id] += self.seq_scores[contig_id][match_id]
 
-            if seq_scores[row['qseqid']][row['sseqid']] < row['bitscore']:
-                seq_scores[row['qseqid']][row['sseqid']] = row['bitscore']
+    def select_top_clusters(self, min_perc_top_score):
+        """Keep the references of each contig whose cluster scores within min_perc_top_score of the cluster of its best match"""
+        for contig_id in self.seq_scores:
+            matches = self.seq_scores[contig_id]
+            top_cluster_score = self.cluster_scores[next(iter(matches)).split('|')[1]]
+            self.seq_scores[contig_id] = OrderedDict(
+                (match_id, score) for match_id, score in matches.items()
+                if float(self.cluster_scores[match_id.split('|')[1]]) / top_cluster_score * 100 >= min_perc_top_score)
 
-            seq_sizes[row['sseqid']] = row['slen']
-            seq_sizes[row['qseqid']] = row['qlen']
-        self.seq_sizes = seq_sizes
-        self.seq_scores = seq_scores
+    def place_contigs(self):
+        for contig_id in self.seq_scores:
+            clusters = OrderedDict()
+            sizes = list()
+            for match_id in self.seq_scores[contig_id]:
+                acs, cluster_id = match_id.split('|')
+                clusters[cluster_id] = acs
+                sizes.append(self.seq_sizes[match_id])
+
+            size = min(sizes)
+            if min(sizes) != max(sizes):
+                size = '{}-{}'.format(min(sizes), max(sizes))
+            placement = 'single'
+            if len(clusters) > 1:
+                placement = 'multiple'
+            self.plasmid_contigs[contig_id] = {
+                'contig_length': self.seq_sizes[contig_id],
+                'plasmid_membership': placement,
+                'plasmid_cluster_ids': ','.join(clusters.keys()),
+                'contig_cov': self.contig_coverage[contig_id],
+                'cluster_size_range': size
+            }
+        logging.info('Predicted {} plasmid contigs'.format(len(self.plasmid_contigs)))
 
     def get_plasmid_contigs(self):
         return self.plasmid_contigs
-
-
-
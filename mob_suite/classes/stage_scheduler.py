@@ -0,0 +1,111 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ThreadBudget:
+    """Pool of thread tokens shared by concurrently running stages.
+
+    A stage asks for a number of threads and is granted as many as are free, at least one,
+    blocking until a token is returned when the pool is exhausted. The sum of granted
+    tokens therefore never exceeds the budget.
+    """
+
+    def __init__(self, num_threads):
+        self.total = max(1, int(num_threads))
+        self.available = self.total
+        self.condition = threading.Condition()
+
+    def acquire(self, wanted):
+        wanted = max(1, int(wanted))
+        with self.condition:
+            while self.available < 1:
+                self.condition.wait()
+            granted = min(wanted, self.available)
+            self.available -= granted
+            return granted
+
+    def release(self, granted):
+        with self.condition:
+            self.available += granted
+            self.condition.notify_all()
+
+
+class StageScheduler:
+    """Run independent pipeline stages concurrently under a shared thread budget.
+
+    Each stage is a callable accepting a num_threads keyword argument. Stages are started in
+    the order they were added and each one is offered a share of the budget proportional to
+    its weight, optionally capped with max_threads for stages which can not use more than a
+    fixed number of threads. With a budget of one thread the stages run one after another.
+    """
+
+    def __init__(self, num_threads):
+        self.budget = ThreadBudget(num_threads)
+        self.stages = OrderedDict()
+
+    def add_stage(self, name, func, *args, weight=1, max_threads=None, **kwargs):
+        if name in self.stages:
+            raise ValueError('Stage {} has already been added'.format(name))
+        self.stages[name] = {'func': func, 'args': args, 'kwargs': kwargs, 'weight': weight,
+                             'max_threads': max_threads}
+
+    def allocate_shares(self):
+        """Split the budget between stages in proportion to their weights.
+        Threads a capped stage can not use are redistributed to the remaining stages and
+        every stage is offered at least one thread.
+        """
+        shares = dict()
+        remaining = self.budget.total
+        uncapped = list(self.stages.keys())
+        changed = True
+        while changed and len(uncapped) > 0:
+            changed = False
+            total_weight = sum(self.stages[name]['weight'] for name in uncapped)
+            for name in list(uncapped):
+                max_threads = self.stages[name]['max_threads']
+                if max_threads is not None and max_threads <= remaining * self.stages[name]['weight'] / total_weight:
+                    shares[name] = max_threads
+                    remaining -= max_threads
+                    uncapped.remove(name)
+                    changed = True
+                    break
+
+        if len(uncapped) > 0:
+            total_weight = sum(self.stages[name]['weight'] for name in uncapped)
+            for name in uncapped:
+                shares[name] = int(remaining * self.stages[name]['weight'] / total_weight)
+            leftover = remaining - sum(shares[name] for name in uncapped)
+            for name in sorted(uncapped, key=lambda n: self.stages[n]['weight'], reverse=True)[0:leftover]:
+                shares[name] += 1
+
+        for name in shares:
+            shares[name] = max(1, shares[name])
+        return shares
+
+    def run_stage(self, name, share):
+        stage = self.stages[name]
+        granted = self.budget.acquire(share)
+        logging.info('Starting stage {} with {} thread(s)'.format(name, granted))
+        try:
+            return stage['func'](*stage['args'], num_threads=granted, **stage['kwargs'])
+        finally:
+            self.budget.release(granted)
+            logging.info('Finished stage {}'.format(name))
+
+    def run(self):
+        """Run all stages and return their results keyed by stage name.
+        Raises the exception of the first failed stage, in the order stages were added,
+        once every stage has finished.
+        """
+        results = OrderedDict()
+        if len(self.stages) == 0:
+            return results
+        shares = self.allocate_shares()
+        max_workers = min(len(self.stages), self.budget.total)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = OrderedDict((name, executor.submit(self.run_stage, name, shares[name])) for name in self.stages)
+            for name in futures:
+                results[name] = futures[name].result()
+        return results
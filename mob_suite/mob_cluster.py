@@ -4,15 +4,20 @@ import shutil
 import sys
 from argparse import (ArgumentParser)
 from mob_suite.version import __version__
-import pandas as pd
+import numpy as np
 import scipy
-import scipy.cluster.hierarchy as sch
+import scipy.cluster.hierarchy
+import scipy.sparse
+import scipy.sparse.csgraph
 from Bio import SeqIO
 from scipy.cluster.hierarchy import fcluster
-from mob_suite.blast import BlastRunner
+from collections import OrderedDict
+from mob_suite.blast.db_registry import IncrementalBlastDb
+from mob_suite.classes.cluster_store import ClusterStore, cluster_store_path, open_cluster_store
 from mob_suite.utils import \
     read_fasta_dict
 from mob_suite.wrappers import mash
+from mob_suite.wrappers.minhash import MashReference, build_sketch_store
 
 LOG_FORMAT = '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
 
@@ -26,7 +31,8 @@ def init_console_logger(lvl):
 def parse_args():
     "Parse the input arguments, use '-h' for help"
     parser = ArgumentParser(description='Mob-Suite: Generate and update existing plasmid clusters')
-    parser.add_argument('-m','--mode', type=str, required=True, help='Build: Create a new database from scratch, Update: Update an existing database with one or more sequences')
+    parser.add_argument('-m','--mode', type=str, required=True, help='Build: Create a new database from scratch, Update: Update an existing database with one or more sequences, '
+                                                                    'sequences with no reference or earlier new sequence within 0.05 are given new clusters')
     parser.add_argument('-o','--outdir', type=str, required=True, help='Output Directory to put results')
     parser.add_argument('-i','--infile', type=str, required=True, help='Input fasta file of one or more closed plasmids to process')
     parser.add_argument('--ref_cluster_file', type=str, required=False, help='Reference mob-cluster file')
@@ -34,21 +40,12 @@ def parse_args():
     parser.add_argument('--ref_mash_db', type=str, required=False, help='Reference mob-cluster mash sketch file')
     parser.add_argument('--num_threads', type=int, required=False, help='Number of threads to be used', default=1)
     parser.add_argument('-w','--overwrite',  required=False, help='Overwrite the MOB-suite databases with results', action='store_true')
+    parser.add_argument('--compact', required=False, help='Rebuild the reference BLAST database as a single volume when overwriting', action='store_true')
+    parser.add_argument('--exhaustive_search', required=False, help='Compare new sequences to every reference instead of the LSH candidates of the reference, slower on large '
+                                                                   'references but never misses a nearer reference outside the candidates when a candidate is within 0.05, '
+                                                                   'which can change the 0.0001 cluster assigned', action='store_true')
     return parser.parse_args()
 
-def read_cluster_assignments(file):
-    if os.path.getsize(file) == 0:
-        return dict()
-    data = pd.read_csv(file, sep='\t', header=0,index_col=0)
-    clusters = dict()
-    for index, row in data.iterrows():
-        record = list()
-        for r in row:
-            record.append(r)
-        clusters[index] = record
-
-    return clusters
-
 def calcDistances(input_fasta,ref_sketch_db,output_file):
     m = mash()
     mash_results = dict()
@@ -75,106 +72,164 @@ def write_clusters(file,cluster_assignments,header):
         outfile.close()
 
 
-def build_cluster_db(distance_matrix_file,distances):
-    data = pd.read_csv(distance_matrix_file, sep='\t', header=0,
-                       index_col=0)
-    distance_matrix = data.as_matrix()
-    condensed_matrix = scipy.spatial.distance.squareform(distance_matrix)
-    Z = scipy.cluster.hierarchy.linkage(condensed_matrix, method='complete')
-
-    clust_assignments = dict()
-
-    for dist in distances:
-        index = 0
-        clusters = fcluster(Z, dist, criterion='distance')
-        for id in data.columns.values:
-            if not id in clust_assignments:
-                clust_assignments[id] = list()
-            clust_assignments[id].append(str(clusters[index]))
-            index += 1
+def calcNeighborDistances(reference, max_distance, num_threads=1):
+    """Distances between the sequences of a sketch reference which are no more than max_distance apart
+    Returns:
+        tuple: first sequence index, second sequence index and distance of each close pair
+    """
+    neighbor_distances = reference.pairwise_distances(max_distance, num_threads=num_threads)
+    logging.info('Found {} pairs of sequences within a mash distance of {}'.format(len(neighbor_distances[2]),
+                                                                                  max_distance))
+    return neighbor_distances
+
+
+def build_cluster_db(ids,neighbor_distances,distances):
+    """Complete linkage clusters of the sequences at each distance threshold.
+    Every pair missing from neighbor_distances is further apart than all the thresholds, so no
+    cluster spans two connected components of the neighbor graph and each component is clustered
+    on its own. The linkage of a component is computed once and cut at every threshold, giving the
+    clusters of a linkage of all the sequences. Clusters are numbered from 1 in the order of their
+    first sequence in ids, so the numbers do not depend on how the sequences split into components.
+    The partition at each threshold is that of fcluster on the linkage of the full distance matrix,
+    but the numbers differ from the fcluster labels it was numbered with before.
+    Args:
+        ids (list): sequence ids
+        neighbor_distances (tuple): first index, second index and distance of the close pairs
+        distances (tuple): distance thresholds
+    Returns:
+        dict: cluster number as a string at each threshold for each id
+    """
+    num_seqs = len(ids)
+    rows, cols, pair_distances = neighbor_distances
+    graph = scipy.sparse.coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(num_seqs, num_seqs))
+    num_components, component = scipy.sparse.csgraph.connected_components(graph, directed=False)
+
+    # provisional labels are unique across components, components without pairs are singletons
+    labels = np.tile(np.arange(num_seqs, dtype=np.int64), (len(distances), 1))
+    members = np.argsort(component, kind='stable')
+    component_starts = np.searchsorted(component[members], np.arange(num_components + 1))
+    pair_order = np.argsort(component[rows], kind='stable')
+    rows, cols, pair_distances = rows[pair_order], cols[pair_order], pair_distances[pair_order]
+    pair_starts = np.searchsorted(component[rows], np.arange(num_components + 1))
+    local_index = np.zeros(num_seqs, dtype=np.int64)
+
+    for c in np.nonzero(np.diff(component_starts) > 1)[0]:
+        component_members = members[component_starts[c]:component_starts[c + 1]]
+        size = len(component_members)
+        local_index[component_members] = np.arange(size)
+        local_rows = local_index[rows[pair_starts[c]:pair_starts[c + 1]]]
+        local_cols = local_index[cols[pair_starts[c]:pair_starts[c + 1]]]
+        condensed_matrix = np.ones(size * (size - 1) // 2, dtype=np.float64)
+        condensed_matrix[size * local_rows - local_rows * (local_rows + 1) // 2 + local_cols - local_rows - 1] = \
+            pair_distances[pair_starts[c]:pair_starts[c + 1]]
+        Z = scipy.cluster.hierarchy.linkage(condensed_matrix, method='complete')
+        for i, dist in enumerate(distances):
+            labels[i, component_members] = component_members[fcluster(Z, dist, criterion='distance') - 1]
+
+    clust_assignments = dict((id, list()) for id in ids)
+    for i in range(len(distances)):
+        provisional, first_member, cluster_index = np.unique(labels[i], return_index=True, return_inverse=True)
+        cluster_numbers = np.argsort(np.argsort(first_member)) + 1
+        for id, number in zip(ids, cluster_numbers[cluster_index]):
+            clust_assignments[id].append(str(number))
 
     return clust_assignments
 
 
 
-def add_new_record(fasta_file,ref_mashdb,mash_results_file,ref_cluster_file,distances_thresholds,num_threads):
-
-    ref_clusters = read_cluster_assignments(ref_cluster_file)
-
-    cluster_pointers = list()
-    for id in ref_clusters:
-        for i in range(0,len(ref_clusters[id])):
-            if len(cluster_pointers) == 0:
-                cluster_pointers = list(ref_clusters[id])
-                continue
-            if ref_clusters[id][i] > cluster_pointers[i]:
-                cluster_pointers[i] = ref_clusters[id][i]
-
-    for i in range(0,len(cluster_pointers)):
-        cluster_pointers[i]+=1
-
+def find_nearest_neighbors(query_sketches,reference,max_thresh,num_threads=1,use_lsh=True):
+    """Nearest sequence within max_thresh of each query among the reference and the queries before it.
+    References are preferred over queries at the same distance, and earlier sequences over later
+    ones, matching the order the sequences are added in. With use_lsh the reference is searched
+    through its LSH index, falling back to every reference for queries without a close candidate,
+    so a nearer reference outside the candidates of a query is missed when one candidate is close.
+    Returns:
+        tuple: the (reference id, distance) of the nearest reference of each query, or None when no
+            reference is within max_thresh, and the (query index, distance) of the nearest earlier
+            query keyed by the index of each query with one
+    """
+    nearest = list()
+    for hit in reference.nearest_within(query_sketches, max_thresh, use_lsh):
+        if hit is not None:
+            nearest.append((str(reference.ids[hit[0]]), hit[1]))
+        else:
+            nearest.append(None)
+
+    queries = MashReference.from_sketches([str(i) for i in range(len(query_sketches))], query_sketches,
+                                          reference.kmer_size, reference.sketch_size, reference.seed)
+    earlier, later, distances = queries.pairwise_distances(max_thresh, num_threads=num_threads)
+    order = np.lexsort((earlier, distances, later))
+    earlier, later, distances = earlier[order], later[order], distances[order]
+    first = np.concatenate([[True], later[1:] != later[:-1]])
+    return nearest, dict((int(j), (int(i), float(d))) for i, j, d in zip(earlier[first], later[first], distances[first]))
+
+
+def add_new_records(sequences,reference,cluster_store,distances_thresholds,num_threads=1,use_lsh=True):
+    """Assign clusters to new sequences in one batch.
+    The new sequences are sketched together and compared to the reference in a single pass, and
+    with each other, then assigned in input order so that a sequence close to one added before it
+    joins its clusters. A sequence joins the clusters of its nearest neighbor at every threshold
+    its distance is within, and starts new clusters at the others, including at every threshold
+    when no sequence is within the largest one.
+    Args:
+        sequences (dict): new sequences keyed by id
+        reference (MashReference): sketches of the reference sequences
+        cluster_store (ClusterStore): clusters of the reference sequences at each threshold
+        distances_thresholds (tuple): distance thresholds, largest first
+    Returns:
+        dict: clusters of the new sequences, to be added to the store
+    """
+    cluster_pointers = cluster_store.next_ids()
+    if len(cluster_pointers) == 0:
+        cluster_pointers = [1] * len(distances_thresholds)
     max_thresh = max(distances_thresholds)
     min_thresh = min(distances_thresholds)
 
-    # Run mash to get distances to the reference
-    out_dir = os.path.dirname(fasta_file)
-    mashObj = mash()
-    mashObj.mashsketch(fasta_file, output_path=fasta_file, sketch_ind=True, num_threads=1, kmer_size=21, sketch_size=1000)
-    mashfile_handle = open(mash_results_file,'w')
-    mashObj.run_mash(ref_mashdb, fasta_file + '.msh', mashfile_handle,table=False,num_threads=num_threads)
-    mashfile_handle.close()
-
-    mashfile_handle = open(mash_results_file, 'r')
-    query_mash_distances = dict()
-
-    for line in mashfile_handle:
-        row = line.split('\t')
-        query_id = row[1]
-        ref_id = row[0].split('|')[0]
-        distance = float(row[2])
-
-        if distance > max_thresh:
-            continue
-        if not query_id in query_mash_distances:
-            query_mash_distances[query_id] = dict()
-
-        query_mash_distances[query_id][ref_id] = distance
+    query_ids = list(sequences.keys())
+    query_sketches = reference.sketch_each([sequences[id] for id in query_ids])
+    ref_nearest, query_nearest = find_nearest_neighbors(query_sketches, reference, max_thresh, num_threads, use_lsh)
+    new_clusters = OrderedDict()
 
+    for index, query_id in enumerate(query_ids):
+        nearest = ref_nearest[index]
+        if index in query_nearest and (nearest is None or query_nearest[index][1] < nearest[1]):
+            nearest = (query_ids[query_nearest[index][0]], query_nearest[index][1])
 
-    for query_id in query_mash_distances:
-
-        min_distance = min(query_mash_distances[query_id].values())
-        min_dist_key = min(query_mash_distances[query_id], key=query_mash_distances[query_id].get)
         clusters = list()
-        if float(min_distance) > float(max_thresh):
+        if nearest is None:
             for i in range(0,len(distances_thresholds)):
                 clusters.append(cluster_pointers[i])
                 cluster_pointers[i]+=1
+            new_clusters[query_id] = clusters
+            continue
 
-        elif float(min_distance) <= float(min_thresh):
+        min_dist_key, min_distance = nearest
+        if min_dist_key in new_clusters:
+            neighbor_clusters = new_clusters[min_dist_key]
+        else:
+            neighbor_clusters = cluster_store.get(min_dist_key)
+        if neighbor_clusters is None:
+            ex_msg = 'Error, reference sequence {} has no cluster assignment'.format(min_dist_key)
+            logging.error(ex_msg)
+            raise Exception(ex_msg)
+
+        if float(min_distance) <= float(min_thresh):
 
-            clusters = list(ref_clusters[min_dist_key])
+            clusters = list(neighbor_clusters)
 
         else:
 
-            clusters = list(ref_clusters[min_dist_key])
+            clusters = list(neighbor_clusters)
             for i in range(0, len(distances_thresholds)):
                 dist = distances_thresholds[i]
                 if float(min_distance) <= float(dist):
                     continue
                 clusters[i] = cluster_pointers[i]
                 cluster_pointers[i] += 1
-        ref_clusters[query_id] = clusters
-
-    return ref_clusters
+        new_clusters[query_id] = clusters
 
+    return new_clusters
 
-def writeClusterAssignments(output_file,header,cluster_assignmnets):
-    with open(output_file, 'w') as out:
-        out.write("\t".join(map(str,header)) + "\n")
-        for id in cluster_assignmnets:
-            out.write("{}\t{}".format(id,"\t".join(map(str,cluster_assignmnets[id]))) + "\n")
-        out.close()
 
 def updateFastaFile(in_fasta_file,out_fasta_file,cluster_assignments):
     out = open(out_fasta_file,'w')
@@ -198,26 +253,58 @@ def selectCluster(clust_assignments,column):
     return out
 
 
-def update_existing(input_fasta,tmp_dir,ref_mash_db,tmp_cluster_file,header,tmp_ref_fasta_file,update_fasta,num_threads=1):
+def update_existing(input_fasta,tmp_dir,ref_mash_db,tmp_cluster_file,header,tmp_ref_fasta_file,update_fasta,delta_fasta,
+                    num_threads=1,use_lsh=True):
     sequences = read_fasta_dict(input_fasta)
-
-    for id in sequences:
-        seq = sequences[id]
-        tmp_fasta = os.path.join(tmp_dir,id + '_tmp.fasta')
-        with open(tmp_fasta , "w") as fh:
-            fh.write("\n>{}\n{}\n".format(id,seq))
-            fh.close()
-        tmp_mash = os.path.join(tmp_dir,id + '_tmp.txt')
-        clust_assignments = add_new_record(tmp_fasta, ref_mash_db ,tmp_mash, tmp_cluster_file,(0.05, 0.0001),num_threads)
-
-        writeClusterAssignments(tmp_cluster_file , header, clust_assignments)
-        with open(tmp_ref_fasta_file , "a") as fh:
-            fh.write("\n>{}\n{}\n".format(id,seq))
-            fh.close()
+    reference = MashReference.load(ref_mash_db)
+    cluster_store = ClusterStore(cluster_store_path(tmp_cluster_file))
+
+    logging.info('Assigning clusters to {} new sequences'.format(len(sequences)))
+    cluster_store.add(add_new_records(sequences, reference, cluster_store, header[1:], num_threads, use_lsh), header[1:])
+    cluster_store.export_file(tmp_cluster_file, header)
+    clust_assignments = cluster_store.assignments()
+    with open(tmp_ref_fasta_file , "a") as fh:
+        for id in sequences:
+            fh.write("\n>{}\n{}\n".format(id,sequences[id]))
+        fh.close()
 
     clust_dict = selectCluster(clust_assignments, 1)
 
     updateFastaFile(tmp_ref_fasta_file ,update_fasta, clust_dict)
+    updateFastaFile(input_fasta, delta_fasta, clust_dict)
+
+def grow_reference_db(ref_fasta, ref_mash_db, delta_fasta, num_threads=1, compact=False):
+    """Add the new sequences, already appended to the reference fasta, to its BLAST database and Mash sketches.
+    The new sequences are indexed as an extra volume of the BLAST database and their sketches are pasted
+    onto the reference sketch file, so the existing references are neither indexed nor sketched again.
+    Args:
+        ref_fasta (str): reference fasta file including the new sequences
+        ref_mash_db (str): reference mash sketch file
+        delta_fasta (str): fasta file of the new sequences with id|cluster headers
+        num_threads (int): number of threads used to sketch the new sequences
+        compact (bool): rebuild the BLAST database as a single volume
+    """
+    # the sketches are updated first, so a failure leaves the BLAST database as it was
+    reference = MashReference.load(ref_mash_db)
+    delta_seqs = read_fasta_dict(delta_fasta)
+    delta_mash_db = "{}.msh".format(delta_fasta)
+    pasted_mash_db = "{}.pasted.msh".format(ref_mash_db)
+    if os.path.isfile(pasted_mash_db):
+        os.remove(pasted_mash_db)
+    mObj = mash()
+    mObj.mashsketch(delta_fasta, delta_mash_db, num_threads=num_threads, kmer_size=reference.kmer_size,
+                    sketch_size=reference.sketch_size, seed=reference.seed)
+    mObj.mashpaste(pasted_mash_db, [ref_mash_db, delta_mash_db])
+    extended = reference.extend(list(delta_seqs.keys()), reference.sketch_each(list(delta_seqs.values())))
+    os.replace(pasted_mash_db, ref_mash_db)
+    logging.info('Added {} sketches to {}'.format(len(delta_seqs), ref_mash_db))
+    build_sketch_store(ref_mash_db, reference=extended)
+
+    blast_db = IncrementalBlastDb(ref_fasta)
+    if compact:
+        blast_db.compact()
+    else:
+        blast_db.append(delta_fasta)
 
 def main():
     args = parse_args()
@@ -250,6 +337,7 @@ def main():
     tmp_cluster_file = os.path.join(out_dir, 'clusters.txt')
     tmp_ref_fasta_file = os.path.join(tmp_dir, 'references_tmp.fasta')
     update_fasta = os.path.join(out_dir, 'references_updated.fasta')
+    delta_fasta = os.path.join(tmp_dir, 'references_delta.fasta')
 
     if mode == 'update':
         if args.ref_cluster_file is None:
@@ -286,28 +374,37 @@ def main():
         logging.info('Running mob-cluster in update mode on reference fasta file: {}'.format(ref_fasta))
         logging.info('Reading previous cluster reference assignments from : {}'.format(ref_cluster_file))
 
-        shutil.copy(ref_cluster_file, tmp_cluster_file)
+        # the reference directory may be read only or shared, so its cluster store is only written when overwriting
+        if args.overwrite:
+            ref_cluster_store = open_cluster_store(ref_cluster_file)
+            shutil.copy(ref_cluster_store.store_path, cluster_store_path(tmp_cluster_file))
+        else:
+            if os.path.isfile(cluster_store_path(tmp_cluster_file)):
+                os.remove(cluster_store_path(tmp_cluster_file))
+            open_cluster_store(ref_cluster_file, cluster_store_path(tmp_cluster_file))
         shutil.copy(ref_fasta, tmp_ref_fasta_file)
-        update_existing(input_fasta, tmp_dir, ref_mash_db, tmp_cluster_file, header, tmp_ref_fasta_file, update_fasta)
+        update_existing(input_fasta, tmp_dir, ref_mash_db, tmp_cluster_file, header, tmp_ref_fasta_file, update_fasta,
+                        delta_fasta, num_threads, not args.exhaustive_search)
 
         if args.overwrite:
             shutil.move(update_fasta,ref_fasta)
             shutil.move(tmp_cluster_file,ref_cluster_file)
-            mash_db_file = "{}.msh".format(input_fasta)
-            mObj = mash()
-            mObj.mashsketch(input_fasta, mash_db_file, num_threads=num_threads)
-            blast_runner = BlastRunner(ref_fasta, '')
-            blast_runner.makeblastdb(ref_fasta, 'nucl')
+            shutil.move(cluster_store_path(tmp_cluster_file), ref_cluster_store.store_path)
+            os.utime(ref_cluster_store.store_path)
+            grow_reference_db(ref_fasta, ref_mash_db, delta_fasta, num_threads, args.compact)
     else:
         mashObj = mash()
         mashObj.mashsketch(input_fasta,input_fasta+".msh",num_threads=num_threads)
-        distance_matrix_file = os.path.join(tmp_dir,'mash_dist_matrix.txt')
-        mashfile_handle = open(distance_matrix_file,'w')
-
-        mashObj.run_mash(input_fasta+'.msh', input_fasta+'.msh', mashfile_handle,table=True,num_threads=num_threads)
-        clust_assignments = build_cluster_db(distance_matrix_file, (0.05, 0.0001))
-        writeClusterAssignments(tmp_cluster_file, header, clust_assignments)
+        reference = MashReference.from_msh(input_fasta+'.msh')
+        neighbor_distances = calcNeighborDistances(reference, max(header[1:]), num_threads)
+        clust_assignments = build_cluster_db(reference.names(), neighbor_distances, (0.05, 0.0001))
+        if os.path.isfile(cluster_store_path(tmp_cluster_file)):
+            os.remove(cluster_store_path(tmp_cluster_file))
+        cluster_store = ClusterStore(cluster_store_path(tmp_cluster_file))
+        cluster_store.add(clust_assignments, header[1:])
+        cluster_store.export_file(tmp_cluster_file, header)
         clust_dict = selectCluster(clust_assignments, 1)
+        build_sketch_store(input_fasta+'.msh', clust_dict, reference)
         shutil.copy(input_fasta, tmp_ref_fasta_file)
         updateFastaFile(tmp_ref_fasta_file ,update_fasta, clust_dict)
 
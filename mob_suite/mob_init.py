@@ -2,7 +2,9 @@
 from mob_suite.version import __version__
 import os, pycurl, tarfile, zipfile, gzip, multiprocessing, sys
 from mob_suite.blast import BlastRunner
+from mob_suite.blast.kmer_index import build_marker_index
 from mob_suite.wrappers import mash
+from mob_suite.wrappers.minhash import build_sketch_store
 from os import listdir
 from os.path import isfile, join
 import shutil
@@ -88,9 +90,16 @@ def main():
     logging.info('Building complete plasmid database')
     blast_runner = BlastRunner(plasmid_database_fasta_file, database_directory)
     blast_runner.makeblastdb(plasmid_database_fasta_file, 'nucl')
+    logging.info('Building marker k-mer prescreen indexes')
+    build_marker_index(os.path.join(database_directory,'rep.dna.fas'), 'nucl')
+    build_marker_index(os.path.join(database_directory,'orit.fas'), 'nucl')
+    build_marker_index(os.path.join(database_directory,'mob.proteins.faa'), 'prot')
+    build_marker_index(os.path.join(database_directory,'mpf.proteins.faa'), 'prot')
     logging.info('Sketching complete plasmid database')
     mObj = mash()
     mObj.mashsketch(plasmid_database_fasta_file,mash_db_file,num_threads=num_threads)
+    logging.info('Building complete plasmid sketch store')
+    build_sketch_store(mash_db_file)
     status_file = os.path.join(database_directory,'status.txt')
     with open(status_file, 'w') as f:
         f.write("Download date: {}".format(datetime.datetime.today().strftime('%Y-%m-%d')))
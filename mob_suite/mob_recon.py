@@ -3,12 +3,18 @@ from mob_suite.version import __version__
 from collections import OrderedDict
 import logging, os, shutil, sys, operator
 from subprocess import Popen, PIPE
+import numpy as np
+import pandas as pd
 from argparse import (ArgumentParser, FileType)
 from mob_suite.blast import BlastRunner
 from mob_suite.blast import BlastReader
+from mob_suite.blast import header_field
+from mob_suite.blast.db_registry import SampleBlastDb
+from mob_suite.blast.hit_cache import BlastHitCache
 from mob_suite.wrappers import circlator
-from mob_suite.wrappers import mash
+from mob_suite.wrappers.minhash import MashReference, mash_best_hit, format_mash_neighbors
 from mob_suite.classes.mcl import mcl
+from mob_suite.classes.stage_scheduler import StageScheduler
 from mob_suite.utils import \
     fixStart, \
     read_fasta_dict, \
@@ -19,7 +25,6 @@ from mob_suite.utils import \
     repetitive_blast, \
     getRepliconContigs, \
     fix_fasta_header, \
-    getMashBestHit, \
     verify_init, \
     check_dependencies
 
@@ -33,6 +38,13 @@ def parse_args():
             __version__))
     parser.add_argument('-o', '--outdir', type=str, required=True, help='Output Directory to put results')
     parser.add_argument('-i', '--infile', type=str, required=True, help='Input assembly fasta file to process')
+    add_search_arguments(parser)
+
+    return parser.parse_args()
+
+
+def add_search_arguments(parser):
+    "Add the search, threading and database arguments shared by mob_recon and mob_recon_batch"
     parser.add_argument('-n', '--num_threads', type=int, required=False, help='Number of threads to be used', default=1)
 
     parser.add_argument('--min_rep_evalue', type=str, required=False,
@@ -93,6 +105,15 @@ def parse_args():
                         action='store_true')
 
     parser.add_argument('--debug', required=False, help='Show debug information', action='store_true')
+    parser.add_argument('--num_mash_neighbors', type=int, required=False,
+                        help='Report this many nearest Mash neighbors with their clusters for each plasmid',
+                        default=0)
+
+    parser.add_argument('--hit_cache', type=str, required=False,
+                        help='SQLite file caching contig BLAST hits between runs on the same sequences, '
+                             'not used unless given')
+    parser.add_argument('--hit_cache_size', type=int, required=False,
+                        help='Maximum size of the BLAST hit cache in megabytes', default=1024)
 
     parser.add_argument('--plasmid_db', type=str, required=False, help='Reference Database of complete plasmids',
                         default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -113,8 +134,6 @@ def parse_args():
                         default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                              'databases/mob.proteins.faa'))
 
-    return parser.parse_args()
-
 
 def init_console_logger(lvl):
     logging_levels = [logging.ERROR, logging.WARN, logging.INFO, logging.DEBUG]
@@ -123,7 +142,12 @@ def init_console_logger(lvl):
     logging.basicConfig(format=LOG_FORMAT, level=report_lvl)
 
 
-def mcl_predict(blast_results_file, min_ident, min_cov, evalue, min_length, tmp_dir):
+def mcl_predict(blast_results_file, min_ident, min_cov, evalue, min_length, num_threads=1):
+    """Markov clusters of the contigs and the plasmid clusters they hit.
+    Not called by the reconstruction, which places contigs with contig_blast_group.
+    Returns:
+        dict: cluster number of each contig id and plasmid cluster id
+    """
     if os.path.getsize(blast_results_file) == 0:
         return dict()
 
@@ -134,24 +158,21 @@ def mcl_predict(blast_results_file, min_ident, min_cov, evalue, min_length, tmp_
     blast_df = blast_df.loc[blast_df['qcovs'] >= min_cov]
     blast_df = blast_df.loc[blast_df['qlen'] >= min_length]
     blast_df = blast_df.reset_index(drop=True)
-    for index, row in blast_df.iterrows():
-        (seqid, clust_id) = row[1].split('|')
-        blast_df.iloc[index, blast_df.columns.get_loc('sseqid')] = clust_id
+    blast_df['sseqid'] = header_field(blast_df['sseqid'], 1)
 
-    filtered_blast = os.path.join(tmp_dir, 'filtered_mcl_blast.txt')
-    blast_df.to_csv(filtered_blast, sep='\t', header=False, line_terminator='\n', index=False)
-    mcl_clusters = mcl(filtered_blast, tmp_dir).getclusters()
+    mcl_clusters = mcl(blast_df, num_threads=num_threads).getclusters()
 
     return mcl_clusters
 
 
-def run_mob_typer(fasta_path, outdir, num_threads=1):
+def run_mob_typer(fasta_path, outdir, num_threads=1, num_mash_neighbors=0):
     mob_typer_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'mob_typer.py')
     p = Popen(['python', mob_typer_path,
                '--infile', fasta_path,
                '--outdir', outdir,
                '--keep_tmp',
-               '--num_threads', str(num_threads)],
+               '--num_threads', str(num_threads),
+               '--num_mash_neighbors', str(num_mash_neighbors)],
               stdout=PIPE,
               stderr=PIPE)
     p.wait()
@@ -161,94 +182,74 @@ def run_mob_typer(fasta_path, outdir, num_threads=1):
     return stdout.decode("utf-8")
 
 
-def contig_blast(input_fasta, plasmid_db, min_ident, min_cov, evalue, min_length, tmp_dir, blast_results_file,
-                 num_threads=1, word_size=11):
-    blast_runner = None
-    filtered_blast = os.path.join(tmp_dir, 'filtered_blast.txt')
+def contig_blast(input_fasta, plasmid_db, min_ident, min_cov, evalue, min_length, tmp_dir, blast_results_file=None,
+                 num_threads=1, word_size=11, filtered_blast=None, hit_cache=None):
+    """Search the contigs against the plasmid database and return the filtered hits in memory.
+    The raw and filtered tables are only written when blast_results_file and filtered_blast are
+    given, which is done when debugging. Contigs already in hit_cache are not searched again.
+    """
     blast_runner = BlastRunner(input_fasta, tmp_dir)
-    blast_runner.run_blast(query_fasta_path=input_fasta, blast_task='megablast', db_path=plasmid_db,
-                           db_type='nucl', min_cov=min_cov, min_ident=min_ident, evalue=evalue,
-                           blast_outfile=blast_results_file, num_threads=num_threads, word_size=11)
-    if os.path.getsize(blast_results_file) == 0:
-        fh = open(filtered_blast, 'w')
-        fh.write('')
-        fh.close()
-        return dict()
-    blast_df = BlastReader(blast_results_file).df
-    blast_df = blast_df.loc[blast_df['length'] >= min_length]
-    blast_df = blast_df.loc[blast_df['qlen'] <= 400000]
-    blast_df = blast_df.loc[blast_df['qlen'] >= min_length]
-    blast_df = blast_df.loc[blast_df['qcovs'] >= min_cov]
-    blast_df = blast_df.loc[blast_df['qlen'] >= min_length]
-    blast_df = blast_df.reset_index(drop=True)
-    blast_df.to_csv(filtered_blast, sep='\t', header=False, line_terminator='\n', index=False)
-
-
-def contig_blast_group(blast_results_file, overlap_threshold):
-    if os.path.getsize(blast_results_file) == 0:
+    min_values = {'length': min_length, 'qlen': min_length, 'qcovs': min_cov}
+    max_values = {'qlen': 400000}
+    if hit_cache is not None and blast_results_file is None:
+        blast_df = hit_cache.run_blast_stream(blast_runner, input_fasta, 'megablast', plasmid_db, 'nucl', min_cov,
+                                              min_ident, evalue, tmp_dir, num_threads=num_threads, word_size=11,
+                                              min_values=min_values, max_values=max_values)
+    else:
+        blast_df = blast_runner.run_blast_stream(query_fasta_path=input_fasta, blast_task='megablast',
+                                                 db_path=plasmid_db, db_type='nucl', min_cov=min_cov,
+                                                 min_ident=min_ident, evalue=evalue, blast_outfile=blast_results_file,
+                                                 num_threads=num_threads, word_size=11, min_values=min_values,
+                                                 max_values=max_values)
+    if filtered_blast is not None:
+        blast_df.to_csv(filtered_blast, sep='\t', header=False, line_terminator='\n', index=False)
+    return blast_df
+
+
+def contig_blast_group(blast_results, overlap_threshold):
+    """Group contigs by their best scoring plasmid clusters
+    Args:
+        blast_results (DataFrame or str): hits from contig_blast or a BLAST table file of them
+        overlap_threshold (int): maximum overlap allowed between hits on a contig
+    """
+    if isinstance(blast_results, pd.DataFrame):
+        blast_df = blast_results
+    else:
+        if os.path.getsize(blast_results) == 0:
+            return dict()
+        blast_df = BlastReader(blast_results).df
+    if len(blast_df) == 0:
         return dict()
-    blast_df = BlastReader(blast_results_file).df
-    blast_df = blast_df.sort_values(['sseqid', 'sstart', 'send', 'bitscore'], ascending=[True, True, True, False])
-
     blast_df = filter_overlaping_records(blast_df, overlap_threshold, 'sseqid', 'sstart', 'send', 'bitscore')
-    size = str(len(blast_df))
-    prev_size = 0
-    while size != prev_size:
-        blast_df = filter_overlaping_records(blast_df, overlap_threshold, 'sseqid', 'sstart', 'send', 'bitscore')
-        prev_size = size
-        size = str(len(blast_df))
-
-    cluster_scores = dict()
-    groups = dict()
-    hits = dict()
-    contigs = dict()
-    for index, row in blast_df.iterrows():
-        query = row['qseqid']
-        pID, clust_id = row['sseqid'].split('|')
-        score = row['bitscore']
-        pLen = row['slen']
-        contig_id = row['qseqid']
-
-        if not pID in hits:
-            hits[pID] = {'score': 0, 'length': pLen, 'covered_bases': 0, 'clust_id': clust_id}
-
-        if not clust_id in cluster_scores:
-            cluster_scores[clust_id] = score
-        elif score > cluster_scores[clust_id]:
-            cluster_scores[clust_id] = score
-
-        if not clust_id in groups:
-            groups[clust_id] = dict()
-
-        if not query in groups[clust_id]:
-            groups[clust_id][query] = dict()
-
-        if not contig_id in contigs:
-            contigs[contig_id] = dict()
-
-        if not clust_id in contigs[contig_id]:
-            contigs[contig_id][clust_id] = 0
-
-        if contigs[contig_id][clust_id] < score:
-            contigs[contig_id][clust_id] = score
-
-        groups[clust_id][query][contig_id] = score
 
-        hits[pID]['score'] += score
-        hits[pID]['covered_bases'] += score
-
-    sorted_d = OrderedDict(sorted(iter(list(cluster_scores.items())), key=lambda x: x[1], reverse=True))
-
-    for clust_id in sorted_d:
-        score = sorted_d[clust_id]
-        for contig_id in contigs:
-            if clust_id in contigs[contig_id]:
-                contigs[contig_id] = {clust_id: contigs[contig_id][clust_id]}
+    contig_codes, contig_ids = pd.factorize(blast_df['qseqid'].astype(str).values)
+    clust_codes, clust_ids = pd.factorize(header_field(blast_df['sseqid'], 1).values)
+    scores = blast_df['bitscore'].values
+
+    # clusters are ranked by their best hit, ties in the order the clusters are first hit
+    cluster_scores = np.full(len(clust_ids), -np.inf)
+    np.maximum.at(cluster_scores, clust_codes, scores)
+    cluster_ranks = np.empty(len(clust_ids), dtype=np.int64)
+    cluster_ranks[np.lexsort((np.arange(len(clust_ids)), -cluster_scores))] = np.arange(len(clust_ids))
+
+    # each contig takes the highest ranked cluster it hits, scored by its best hit to that cluster
+    hit_ranks = cluster_ranks[clust_codes]
+    order = np.lexsort((hit_ranks, contig_codes))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = contig_codes[order][1:] != contig_codes[order][:-1]
+    contig_clusters = np.empty(len(contig_ids), dtype=np.int64)
+    contig_clusters[contig_codes[order[first]]] = clust_codes[order[first]]
+    selected = clust_codes == contig_clusters[contig_codes]
+    contig_scores = np.zeros(len(contig_ids), dtype=scores.dtype)
+    np.maximum.at(contig_scores, contig_codes[selected], scores[selected])
 
+    contigs = dict()
+    for contig_id, clust_code, score in zip(contig_ids, contig_clusters, contig_scores):
+        contigs[contig_id] = {clust_ids[clust_code]: score}
     return contigs
 
 
-def circularize(input_fasta, output_prefix):
+def circularize(input_fasta, output_prefix, num_threads=1):
     c = circlator()
     c.run_minimus(input_fasta, output_prefix)
     clist = c.parse_minimus(output_prefix + '.log')
@@ -258,228 +259,70 @@ def circularize(input_fasta, output_prefix):
     return cdict
 
 
-def main():
-
-    args = parse_args()
-
-    if args.debug:
-        init_console_logger(3)
-    logging.info("MOB-recon v. {} ".format(__version__))
-
-    if not args.outdir:
-        logging.error('Error, no output directory specified, please specify one')
-        sys.exit(-1)
-
-    if not args.infile:
-        logging.error('Error, no fasta specified, please specify one')
-        sys.exit(-1)
-
-    if not os.path.isfile(args.infile):
-        logging.error('Error, input fasta file does not exist: "{}"'.format(args.infile))
-        sys.exit(-1)
-
-    logging.info('Processing fasta file {}'.format(args.infile))
-    logging.info('Analysis directory {}'.format(args.outdir))
-
-    if not os.path.isdir(args.outdir):
-        os.mkdir(args.outdir, 0o755)
-
-    # Check that the needed databases have been initialized
-    verify_init(logging)
-    status_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'databases/status.txt')
-
-
-    if not os.path.isfile(status_file):
-        logging.error('Error needed databases have not been initialize please run mob_init and try again')
-        sys.exit(-1)
-
-    plasmid_files = dict()
-    input_fasta = args.infile
-    out_dir = args.outdir
-    num_threads = args.num_threads
-    tmp_dir = os.path.join(out_dir, '__tmp')
-    file_id = os.path.basename(input_fasta)
-    fixed_fasta = os.path.join(tmp_dir, 'fixed.input.fasta')
-    chromosome_file = os.path.join(out_dir, 'chromosome.fasta')
-    replicon_blast_results = os.path.join(tmp_dir, 'replicon_blast_results.txt')
-    mob_blast_results = os.path.join(tmp_dir, 'mobrecon_blast_results.txt')
-    repetitive_blast_results = os.path.join(tmp_dir, 'repetitive_blast_results.txt')
-    contig_blast_results = os.path.join(tmp_dir, 'contig_blast_results.txt')
-
-
-    # Input numeric params
-    min_rep_ident = float(args.min_rep_ident)
-    min_mob_ident = float(args.min_mob_ident)
-    min_con_ident = float(args.min_con_ident)
-    min_rpp_ident = float(args.min_rpp_ident)
-
-    idents = {'min_rep_ident': min_rep_ident, 'min_mob_ident': min_mob_ident, 'min_con_ident': min_con_ident,
-              'min_rpp_ident': min_rpp_ident}
-
-    for param in idents:
-        value = float(idents[param])
+def get_search_params(args):
+    """Validate the numeric search thresholds, exiting on invalid values
+    Returns:
+        dict: identity, coverage and evalue thresholds of each search with the minimum overlap and contig length
+    """
+    params = dict()
+    for param in ['min_rep_ident', 'min_mob_ident', 'min_con_ident', 'min_rpp_ident']:
+        value = float(getattr(args, param))
         if value < 60:
             logging.error("Error: {} is too low, please specify an integer between 70 - 100".format(param))
             sys.exit(-1)
         if value > 100:
             logging.error("Error: {} is too high, please specify an integer between 70 - 100".format(param))
             sys.exit(-1)
+        params[param] = value
 
-    min_rep_cov = float(args.min_rep_cov)
-    min_mob_cov = float(args.min_mob_cov)
-    min_con_cov = float(args.min_con_cov)
-    min_rpp_cov = float(args.min_rpp_cov)
-
-    covs = {'min_rep_cov': min_rep_cov, 'min_mob_cov': min_mob_cov, 'min_con_cov': min_con_cov,
-            'min_rpp_cov': min_rpp_cov}
-
-    for param in covs:
-        value = float(covs[param])
+    for param in ['min_rep_cov', 'min_mob_cov', 'min_con_cov', 'min_rpp_cov']:
+        value = float(getattr(args, param))
         if value < 60:
             logging.error("Error: {} is too low, please specify an integer between 50 - 100".format(param))
             sys.exit(-1)
         if value > 100:
             logging.error("Error: {} is too high, please specify an integer between 50 - 100".format(param))
             sys.exit(-1)
+        params[param] = value
 
-    min_rep_evalue = float(args.min_rep_evalue)
-    min_mob_evalue = float(args.min_mob_evalue)
-    min_con_evalue = float(args.min_con_evalue)
-    min_rpp_evalue = float(args.min_rpp_evalue)
-
-    evalues = {'min_rep_evalue': min_rep_evalue, 'min_mob_evalue': min_mob_evalue, 'min_con_evalue': min_con_evalue,
-               'min_rpp_evalue': min_rpp_evalue}
-
-    for param in evalues:
-        value = float(evalues[param])
+    for param in ['min_rep_evalue', 'min_mob_evalue', 'min_con_evalue', 'min_rpp_evalue']:
+        value = float(getattr(args, param))
         if value > 1:
             logging.error("Error: {} is too high, please specify an float evalue between 0 to 1".format(param))
             sys.exit(-1)
-
-    min_overlapp = int(args.min_overlap)
-
-    min_length = int(args.min_length)
-
-
-
-    # Input numeric params
-    min_rep_ident = float(args.min_rep_ident)
-    min_mob_ident = float(args.min_mob_ident)
-    min_con_ident = float(args.min_con_ident)
-    min_rpp_ident = float(args.min_rpp_ident)
-
-    idents = {'min_rep_ident': min_rep_ident, 'min_mob_ident': min_mob_ident, 'min_con_ident': min_con_ident,
-              'min_rpp_ident': min_rpp_ident}
-
-    for param in idents:
-        value = idents[param]
-        if value < 60:
-            logging.error("Error: {} is too low, please specify an integer between 70 - 100".format(param))
-            sys.exit(-1)
-        if value > 100:
-            logging.error("Error: {} is too high, please specify an integer between 70 - 100".format(param))
-            sys.exit(-1)
-
-    min_rep_cov = float(args.min_rep_cov)
-    min_mob_cov = float(args.min_mob_cov)
-    min_con_cov = float(args.min_con_cov)
-    min_rpp_cov = float(args.min_rpp_cov)
-
-    covs = {'min_rep_cov': min_rep_cov, 'min_mob_cov': min_mob_cov, 'min_con_cov': min_con_cov,
-            'min_rpp_cov': min_rpp_cov}
-
-    for param in covs:
-        value = covs[param]
-        if value < 60:
-            logging.error("Error: {} is too low, please specify an integer between 50 - 100".format(param))
-            sys.exit(-1)
-        if value > 100:
-            logging.error("Error: {} is too high, please specify an integer between 50 - 100".format(param))
-            sys.exit(-1)
-
-    min_rep_evalue = float(args.min_rep_evalue)
-    min_mob_evalue = float(args.min_mob_evalue)
-    min_con_evalue = float(args.min_con_evalue)
-    min_rpp_evalue = float(args.min_rpp_evalue)
-
-    evalues = {'min_rep_evalue': min_rep_evalue, 'min_mob_evalue': min_mob_evalue, 'min_con_evalue': min_con_evalue,
-               'min_rpp_evalue': min_rpp_evalue}
-
-    for param in evalues:
-        value = evalues[param]
-        if value > 1:
-            logging.error("Error: {} is too high, please specify an float evalue between 0 to 1".format(param))
-            sys.exit(-1)
-
-    min_overlapp = args.min_overlap
-
-    min_length = args.min_length
-
-    # Input Databases
-    plasmid_ref_db = args.plasmid_db
-    replicon_ref = args.plasmid_replicons
-    mob_ref = args.plasmid_mob
-    mash_db = args.plasmid_mash_db
-    repetitive_mask_file = args.repetitive_mask
-
-    check_dependencies(logging)
-
-    needed_dbs = [plasmid_ref_db, replicon_ref, mob_ref, mash_db, repetitive_mask_file,"{}.nin".format(repetitive_mask_file)]
-
-    for db in needed_dbs:
-        if (not os.path.isfile(db)):
-            logging.error('Error needed database missing "{}"'.format(db))
-            sys.exit(-1)
-
+        params[param] = value
+
+    params['min_overlap'] = args.min_overlap
+    params['min_length'] = int(args.min_length)
+    return params
+
+
+def reconstruct_plasmids(stage_results, contig_seqs, file_id, out_dir, tmp_dir, mash_db, min_overlapp,
+                         unicycler_contigs=False, run_typer=False, num_threads=1, num_mash_neighbors=0):
+    """Group the contigs of one assembly into plasmids from its search results and write the reports.
+    Args:
+        stage_results (dict): results of the 'replicon', 'relaxase', 'contig' and 'repetitive' searches,
+            and of 'circlator' when it was run
+        contig_seqs (dict): contig sequences keyed by their cleaned header
+        file_id (str): name of the input assembly reported in contig_report.txt
+        out_dir (str): directory to write the reports and plasmid FASTA files to
+        tmp_dir (str): working directory of the assembly
+        num_mash_neighbors (int): number of nearest Mash neighbors to list for each plasmid, none when 0
+    """
+    plasmid_files = dict()
+    chromosome_file = os.path.join(out_dir, 'chromosome.fasta')
     contig_report_file = os.path.join(out_dir, 'contig_report.txt')
-    minimus_prefix = os.path.join(tmp_dir, 'minimus')
-    filtered_blast = os.path.join(tmp_dir, 'filtered_blast.txt')
     repetitive_blast_report = os.path.join(out_dir, 'repetitive_blast_report.txt')
     mobtyper_results_file = os.path.join(out_dir, 'mobtyper_aggregate_report.txt')
-    keep_tmp = args.keep_tmp
-
-    run_circlator = args.run_circlator
-    unicycler_contigs = args.unicycler_contigs
-
-    if not isinstance(args.num_threads, int):
-        logging.info('Error number of threads must be an integer, you specified "{}"'.format(args.num_threads))
-
-    logging.info('Creating tmp working directory {}'.format(tmp_dir))
-
-    if not os.path.isdir(tmp_dir):
-        os.mkdir(tmp_dir, 0o755)
-
-    logging.info('Writing cleaned header input fasta file from {} to {}'.format(input_fasta, fixed_fasta))
-    fix_fasta_header(input_fasta, fixed_fasta)
-    contig_seqs = read_fasta_dict(fixed_fasta)
-
-    logging.info('Running replicon blast on {}'.format(replicon_ref))
-    replicon_contigs = getRepliconContigs(
-        replicon_blast(replicon_ref, fixed_fasta, min_rep_ident, min_rep_cov, min_rep_evalue, tmp_dir,
-                       replicon_blast_results,
-                       num_threads=num_threads))
 
-    logging.info('Running relaxase blast on {}'.format(mob_ref))
-    mob_contigs = getRepliconContigs(
-        mob_blast(mob_ref, fixed_fasta, min_mob_ident, min_mob_cov, min_mob_evalue, tmp_dir, mob_blast_results,
-                  num_threads=num_threads))
-
-    logging.info('Running contig blast on {}'.format(plasmid_ref_db))
-    contig_blast(fixed_fasta, plasmid_ref_db, min_con_ident, min_con_cov, min_con_evalue, min_length,
-                 tmp_dir, contig_blast_results)
-
-    pcl_clusters = contig_blast_group(filtered_blast, min_overlapp)
-
-    logging.info('Running repetitive contig masking blast on {}'.format(mob_ref))
-    repetitive_contigs = repetitive_blast(fixed_fasta, repetitive_mask_file, min_rpp_ident, min_rpp_cov, min_rpp_evalue,
-                                          min_length, tmp_dir,
-                                          repetitive_blast_results, num_threads=num_threads)
+    replicon_contigs = getRepliconContigs(stage_results['replicon'])
+    mob_contigs = getRepliconContigs(stage_results['relaxase'])
+    pcl_clusters = contig_blast_group(stage_results['contig'], min_overlapp)
+    repetitive_contigs = stage_results['repetitive']
 
     circular_contigs = dict()
-
-    logging.info('Running circlator minimus2 on {}'.format(fixed_fasta))
-    if run_circlator:
-        circular_contigs = circularize(fixed_fasta, minimus_prefix)
+    if 'circlator' in stage_results:
+        circular_contigs = stage_results['circlator']
 
     if unicycler_contigs:
         for seqid in contig_seqs:
@@ -507,26 +350,23 @@ def main():
 
     results_fh.close()
 
+    # contigs belong to the single cluster contig_blast_group chose for them, clusters are ordered by the
+    # bitscore of the last of their contigs with ties in reverse order of their first contig
     seq_clusters = dict()
+    cluster_members = dict()
     cluster_bitscores = dict()
     for seqid in pcl_clusters:
-        cluster_id = list(pcl_clusters[seqid].keys())[0]
-        bitscore = pcl_clusters[seqid][cluster_id]
+        cluster_id, bitscore = next(iter(pcl_clusters[seqid].items()))
         cluster_bitscores[cluster_id] = bitscore
+        if not cluster_id in cluster_members:
+            cluster_members[cluster_id] = dict()
+        if seqid in contig_seqs:
+            cluster_members[cluster_id][seqid] = contig_seqs[seqid]
 
     sorted_cluster_bitscores = sorted(list(cluster_bitscores.items()), key=operator.itemgetter(1))
     sorted_cluster_bitscores.reverse()
-    contigs_assigned = dict()
     for cluster_id, bitscore in sorted_cluster_bitscores:
-
-        if not cluster_id in seq_clusters:
-            seq_clusters[cluster_id] = dict()
-        for seqid in pcl_clusters:
-            if not cluster_id in pcl_clusters[seqid]:
-                continue
-            if seqid in contig_seqs and seqid not in contigs_assigned:
-                seq_clusters[cluster_id][seqid] = contig_seqs[seqid]
-                contigs_assigned[seqid] = cluster_id
+        seq_clusters[cluster_id] = cluster_members[cluster_id]
 
     # Add sequences with known replicons regardless of whether they belong to a mcl cluster
     clust_id = 0
@@ -592,15 +432,26 @@ def main():
 
     seq_clusters = refined_clusters
 
-    m = mash()
+    # each candidate contig is sketched once, cluster sketches are the merge of the sketches of their contigs
+    mash_ref = MashReference.load(mash_db)
+    cluster_contig_ids = list(OrderedDict.fromkeys(contig_id for id in seq_clusters for contig_id in seq_clusters[id]))
+    contig_sketches = dict(zip(cluster_contig_ids,
+                               mash_ref.sketch_each([contig_seqs[contig_id] for contig_id in cluster_contig_ids])))
+    plasmid_sketches = dict()
     mash_distances = dict()
     mash_top_dists = dict()
     contig_report = list()
 
+    # the list of nearest neighbors is an extra last column, only present when asked for
+    neighbors_header = ''
+    if num_mash_neighbors > 0:
+        neighbors_header = "\tmash_nearest_neighbors"
+
     results_fh = open(contig_report_file, 'w')
     results_fh.write("file_id\tcluster_id\tcontig_id\tcontig_length\tcircularity_status\trep_type\t" \
                      "rep_type_accession\trelaxase_type\trelaxase_type_accession\tmash_nearest_neighbor\t"
-                     " mash_neighbor_distance\trepetitive_dna_id\tmatch_type\tscore\tcontig_match_start\tcontig_match_end\n")
+                     " mash_neighbor_distance\trepetitive_dna_id\tmatch_type\tscore\tcontig_match_start\tcontig_match_end"
+                     "{}\n".format(neighbors_header))
 
     filter_list = dict()
     counter = 0
@@ -630,15 +481,9 @@ def main():
         for contig_id in temp:
             filter_list[contig_id] = ''
 
-        cluster_file = os.path.join(tmp_dir, 'clust_' + str(cluster) + '.fasta')
-        mash_file = os.path.join(tmp_dir, 'clust_' + str(cluster) + '.txt')
-        write_fasta_dict(clusters, cluster_file)
-
-        mashfile_handle = open(mash_file, 'w')
-        m.run_mash(mash_db, cluster_file, mashfile_handle)
-
-        mash_results = m.read_mash(mash_file)
-        mash_top_hit = getMashBestHit(mash_results)
+        cluster_sketch = mash_ref.merge([contig_sketches[contig_id] for contig_id in clusters])
+        mash_hits = mash_ref.nearest_hits(cluster_sketch, max(1, num_mash_neighbors))
+        mash_top_hit = mash_best_hit(mash_hits)
 
         # delete low scoring clusters
         if float(mash_top_hit['mash_hit_score']) > 0.05:
@@ -658,37 +503,32 @@ def main():
                     del (filter_list[contig_id])
                 continue
 
-        new_clust_file = None
-        if os.path.isfile(cluster_file):
-            if float(mash_top_hit['mash_hit_score']) < 0.05:
-                cluster = mash_top_hit['clustid']
-                new_clust_file = os.path.join(out_dir, 'plasmid_' + cluster + ".fasta")
-
-            else:
-                cluster = 'novel_' + str(counter)
-                new_clust_file = os.path.join(out_dir, 'plasmid_' + cluster + ".fasta")
-                counter += 1
+        if float(mash_top_hit['mash_hit_score']) < 0.05:
+            cluster = mash_top_hit['clustid']
+            new_clust_file = os.path.join(out_dir, 'plasmid_' + cluster + ".fasta")
 
-            if os.path.isfile(new_clust_file):
-                temp_fh = open(cluster_file, 'r')
+        else:
+            cluster = 'novel_' + str(counter)
+            new_clust_file = os.path.join(out_dir, 'plasmid_' + cluster + ".fasta")
+            counter += 1
 
-                data = temp_fh.read()
+        if os.path.isfile(new_clust_file):
+            write_fasta_dict(clusters, new_clust_file, mode='a')
+            if new_clust_file in plasmid_sketches:
+                # describe the plasmid with all the contigs written to its file
+                plasmid_sketches[new_clust_file] = mash_ref.merge([plasmid_sketches[new_clust_file], cluster_sketch])
+                mash_hits = mash_ref.nearest_hits(plasmid_sketches[new_clust_file], max(1, num_mash_neighbors))
+                mash_top_hit = mash_best_hit(mash_hits)
 
-                temp_fh.close()
-                temp_fh = open(new_clust_file, 'a')
-                temp_fh.write(data)
-                temp_fh.close()
-                mash_file = os.path.join(tmp_dir, 'clust_' + str(cluster) + '.txt')
-                mashfile_handle = open(mash_file, 'w')
-                m.run_mash(mash_db, cluster_file, mashfile_handle)
-                mash_results = m.read_mash(mash_file)
-                mash_top_hit = getMashBestHit(mash_results)
+        else:
+            write_fasta_dict(clusters, new_clust_file)
+            plasmid_sketches[new_clust_file] = cluster_sketch
 
-            else:
-                os.rename(cluster_file, new_clust_file)
+        plasmid_files[new_clust_file] = ''
 
-        if new_clust_file is not None:
-            plasmid_files[new_clust_file] = ''
+        neighbors_column = ''
+        if num_mash_neighbors > 0:
+            neighbors_column = "\t{}".format(format_mash_neighbors(mash_hits))
 
         for contig_id in clusters:
             found_replicon_string = ''
@@ -727,7 +567,7 @@ def main():
             if contig_id in repetitive_dna:
                 rep_dna_info = repetitive_dna[contig_id]
 
-            results_fh.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(file_id, cluster, contig_id,
+            results_fh.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}{}\n".format(file_id, cluster, contig_id,
                                                                                        len(clusters[contig_id]),
                                                                                        contig_status,
                                                                                        found_replicon_string,
@@ -736,8 +576,11 @@ def main():
                                                                                        found_mob_id_string,
                                                                                        mash_top_hit['top_hit'],
                                                                                        mash_top_hit['mash_hit_score'],
-                                                                                       rep_dna_info))
+                                                                                       rep_dna_info, neighbors_column))
     chr_contigs = dict()
+    neighbors_column = ''
+    if num_mash_neighbors > 0:
+        neighbors_column = "\t"
 
     for contig_id in contig_seqs:
         if contig_id not in filter_list:
@@ -748,26 +591,162 @@ def main():
             contig_status = 'Incomplete'
             if contig_id in circular_contigs:
                 contig_status = 'Circular'
-            results_fh.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(file_id, 'chromosome', contig_id,
+            results_fh.write("{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}{}\n".format(file_id, 'chromosome', contig_id,
                                                                                        len(contig_seqs[contig_id]),
                                                                                        contig_status, '', '', '', '',
-                                                                                       '', '', rep_dna_info))
+                                                                                       '', '', rep_dna_info,
+                                                                                       neighbors_column))
     results_fh.close()
     write_fasta_dict(chr_contigs, chromosome_file)
 
-    if args.run_typer:
+    if run_typer:
         mobtyper_results = "file_id\tnum_contigs\ttotal_length\tgc\t" \
                            "rep_type(s)\trep_type_accession(s)\t" \
                            "relaxase_type(s)\trelaxase_type_accession(s)\t" \
                            "mpf_type\tmpf_type_accession(s)\t" \
                            "orit_type(s)\torit_accession(s)\tPredictedMobility\t" \
-                           "mash_nearest_neighbor\tmash_neighbor_distance\tmash_neighbor_cluster\n"
+                           "mash_nearest_neighbor\tmash_neighbor_distance\tmash_neighbor_cluster" \
+                           "{}\n".format(neighbors_header)
         for file in plasmid_files:
-            mobtyper_results = mobtyper_results + "{}".format(run_mob_typer(file, out_dir, str(num_threads)))
+            mobtyper_results = mobtyper_results + "{}".format(run_mob_typer(file, out_dir, str(num_threads),
+                                                                            num_mash_neighbors))
         fh = open(mobtyper_results_file, 'w')
         fh.write(mobtyper_results)
         fh.close()
 
+
+def main():
+
+    args = parse_args()
+
+    if args.debug:
+        init_console_logger(3)
+    logging.info("MOB-recon v. {} ".format(__version__))
+
+    if not args.outdir:
+        logging.error('Error, no output directory specified, please specify one')
+        sys.exit(-1)
+
+    if not args.infile:
+        logging.error('Error, no fasta specified, please specify one')
+        sys.exit(-1)
+
+    if not os.path.isfile(args.infile):
+        logging.error('Error, input fasta file does not exist: "{}"'.format(args.infile))
+        sys.exit(-1)
+
+    logging.info('Processing fasta file {}'.format(args.infile))
+    logging.info('Analysis directory {}'.format(args.outdir))
+
+    if not os.path.isdir(args.outdir):
+        os.mkdir(args.outdir, 0o755)
+
+    # Check that the needed databases have been initialized
+    verify_init(logging)
+    status_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'databases/status.txt')
+
+
+    if not os.path.isfile(status_file):
+        logging.error('Error needed databases have not been initialize please run mob_init and try again')
+        sys.exit(-1)
+
+    input_fasta = args.infile
+    out_dir = args.outdir
+    num_threads = args.num_threads
+    tmp_dir = os.path.join(out_dir, '__tmp')
+    file_id = os.path.basename(input_fasta)
+    fixed_fasta = os.path.join(tmp_dir, 'fixed.input.fasta')
+    replicon_blast_results = os.path.join(tmp_dir, 'replicon_blast_results.txt')
+    mob_blast_results = os.path.join(tmp_dir, 'mobrecon_blast_results.txt')
+    repetitive_blast_results = os.path.join(tmp_dir, 'repetitive_blast_results.txt')
+    contig_blast_results = os.path.join(tmp_dir, 'contig_blast_results.txt')
+    filtered_blast = os.path.join(tmp_dir, 'filtered_blast.txt')
+    if not args.debug:
+        # BLAST output is parsed as it streams, the raw tables are only written when debugging
+        replicon_blast_results = None
+        mob_blast_results = None
+        repetitive_blast_results = None
+        contig_blast_results = None
+        filtered_blast = None
+
+
+    params = get_search_params(args)
+
+    # Input Databases
+    plasmid_ref_db = args.plasmid_db
+    replicon_ref = args.plasmid_replicons
+    mob_ref = args.plasmid_mob
+    mash_db = args.plasmid_mash_db
+    repetitive_mask_file = args.repetitive_mask
+
+    check_dependencies(logging)
+
+    needed_dbs = [plasmid_ref_db, replicon_ref, mob_ref, mash_db, repetitive_mask_file,"{}.nin".format(repetitive_mask_file)]
+
+    for db in needed_dbs:
+        if (not os.path.isfile(db)):
+            logging.error('Error needed database missing "{}"'.format(db))
+            sys.exit(-1)
+
+    minimus_prefix = os.path.join(tmp_dir, 'minimus')
+    keep_tmp = args.keep_tmp
+
+    run_circlator = args.run_circlator
+    unicycler_contigs = args.unicycler_contigs
+
+    if not isinstance(args.num_threads, int):
+        logging.info('Error number of threads must be an integer, you specified "{}"'.format(args.num_threads))
+
+    logging.info('Creating tmp working directory {}'.format(tmp_dir))
+
+    if not os.path.isdir(tmp_dir):
+        os.mkdir(tmp_dir, 0o755)
+
+    logging.info('Writing cleaned header input fasta file from {} to {}'.format(input_fasta, fixed_fasta))
+    fix_fasta_header(input_fasta, fixed_fasta)
+    contig_seqs = read_fasta_dict(fixed_fasta)
+    sample_db = SampleBlastDb(fixed_fasta, tmp_dir)
+
+    hit_cache = None
+    if args.hit_cache is not None:
+        hit_cache = BlastHitCache(args.hit_cache, max_bytes=args.hit_cache_size * 1024 * 1024)
+
+    # The marker, contig and repetitive searches and circlator are independent of each other so they
+    # are run concurrently, sharing the requested number of threads between them. The sample database
+    # is removed whether or not every stage succeeds
+    try:
+        scheduler = StageScheduler(num_threads)
+
+        logging.info('Running replicon blast on {}'.format(replicon_ref))
+        scheduler.add_stage('replicon', replicon_blast, replicon_ref, sample_db, params['min_rep_ident'],
+                            params['min_rep_cov'], params['min_rep_evalue'], tmp_dir, replicon_blast_results)
+
+        logging.info('Running relaxase blast on {}'.format(mob_ref))
+        scheduler.add_stage('relaxase', mob_blast, mob_ref, sample_db, params['min_mob_ident'], params['min_mob_cov'],
+                            params['min_mob_evalue'], tmp_dir, mob_blast_results)
+
+        logging.info('Running contig blast on {}'.format(plasmid_ref_db))
+        scheduler.add_stage('contig', contig_blast, fixed_fasta, plasmid_ref_db, params['min_con_ident'],
+                            params['min_con_cov'], params['min_con_evalue'], params['min_length'], tmp_dir,
+                            contig_blast_results, filtered_blast=filtered_blast, hit_cache=hit_cache, weight=2)
+
+        logging.info('Running repetitive contig masking blast on {}'.format(repetitive_mask_file))
+        scheduler.add_stage('repetitive', repetitive_blast, fixed_fasta, repetitive_mask_file, params['min_rpp_ident'],
+                            params['min_rpp_cov'], params['min_rpp_evalue'], params['min_length'], tmp_dir,
+                            repetitive_blast_results, hit_cache=hit_cache)
+
+        if run_circlator:
+            logging.info('Running circlator minimus2 on {}'.format(fixed_fasta))
+            scheduler.add_stage('circlator', circularize, fixed_fasta, minimus_prefix, max_threads=1)
+
+        stage_results = scheduler.run()
+    finally:
+        sample_db.cleanup()
+
+    reconstruct_plasmids(stage_results, contig_seqs, file_id, out_dir, tmp_dir, mash_db, params['min_overlap'],
+                         unicycler_contigs=unicycler_contigs, run_typer=args.run_typer, num_threads=num_threads,
+                         num_mash_neighbors=args.num_mash_neighbors)
+
     if not keep_tmp:
         shutil.rmtree(tmp_dir)
 
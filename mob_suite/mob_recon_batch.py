@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+from mob_suite.version import __version__
+from collections import OrderedDict
+import logging, os, shutil, sys
+from argparse import ArgumentParser
+from mob_suite.blast import empty_blast_table
+from mob_suite.blast.db_registry import SampleBlastDb
+from mob_suite.blast.hit_cache import BlastHitCache
+from mob_suite.classes.stage_scheduler import StageScheduler
+from mob_suite.mob_recon import \
+    add_search_arguments, \
+    get_search_params, \
+    init_console_logger, \
+    contig_blast, \
+    circularize, \
+    reconstruct_plasmids
+from mob_suite.utils import \
+    read_fasta_dict, \
+    replicon_blast, \
+    mob_blast, \
+    repetitive_blast, \
+    fix_fasta_header, \
+    verify_init, \
+    check_dependencies
+
+FASTA_EXTENSIONS = ('.fasta', '.fas', '.fa', '.fna', '.fsa')
+
+# Contig ids in the concatenated batch query are prefixed with the index of their sample
+NAMESPACE_FORMAT = 'sample{}__{}'
+
+
+def parse_args():
+    "Parse the input arguments, use '-h' for help"
+    parser = ArgumentParser(
+        description="Mob Suite: Batch reconstruction of plasmids from many draft and complete assemblies version: {}".format(
+            __version__))
+    parser.add_argument('-o', '--outdir', type=str, required=True,
+                        help='Output Directory to put results, each assembly gets a subdirectory named after its sample id')
+    parser.add_argument('-i', '--input', type=str, required=True,
+                        help='Directory of assembly fasta files or tab delimited sample sheet of sample id and fasta path')
+    add_search_arguments(parser)
+
+    return parser.parse_args()
+
+
+def check_sample_id(sample_id, source):
+    """Sample ids name the output subdirectory of each sample, so they must be a single path component"""
+    if sample_id == '' or os.sep in sample_id or (os.altsep is not None and os.altsep in sample_id) or \
+            '..' in sample_id:
+        ex_msg = 'Error, sample id "{}" in {} must be non-empty and must not contain "{}" or ".."'.format(
+            sample_id, source, os.sep)
+        logging.error(ex_msg)
+        raise Exception(ex_msg)
+
+
+def read_samples(input_path):
+    """Read the assemblies to process from a directory of fasta files or a sample sheet.
+    Sample sheets have one sample per line with the sample id and fasta path separated by a tab,
+    relative paths are resolved against the directory of the sheet.
+    Returns:
+        OrderedDict: fasta path of each sample id
+    """
+    samples = OrderedDict()
+    if os.path.isdir(input_path):
+        for file in sorted(os.listdir(input_path)):
+            name, ext = os.path.splitext(file)
+            if ext.lower() in FASTA_EXTENSIONS and os.path.isfile(os.path.join(input_path, file)):
+                if name in samples:
+                    ex_msg = 'Error, sample id {} is used by more than one fasta file in {}'.format(name, input_path)
+                    logging.error(ex_msg)
+                    raise Exception(ex_msg)
+                check_sample_id(name, input_path)
+                samples[name] = os.path.join(input_path, file)
+        return samples
+
+    sheet_dir = os.path.dirname(os.path.abspath(input_path))
+    with open(input_path, 'r') as fh:
+        for line in fh:
+            line = line.rstrip('\n')
+            if line.strip() == '' or line.startswith('#'):
+                continue
+            row = line.split('\t')
+            if len(row) < 2:
+                ex_msg = 'Error, sample sheet line "{}" does not have a sample id and fasta path'.format(line)
+                logging.error(ex_msg)
+                raise Exception(ex_msg)
+            sample_id, fasta_path = row[0].strip(), row[1].strip()
+            check_sample_id(sample_id, input_path)
+            if sample_id in samples:
+                ex_msg = 'Error, sample id {} is listed more than once in {}'.format(sample_id, input_path)
+                logging.error(ex_msg)
+                raise Exception(ex_msg)
+            samples[sample_id] = os.path.join(sheet_dir, fasta_path)
+    return samples
+
+
+def write_batch_query(sample_fastas, batch_fasta):
+    """Concatenate the cleaned assemblies of the batch into one query with namespaced contig ids
+    Args:
+        sample_fastas (OrderedDict): cleaned fasta path of each sample id
+        batch_fasta (str): path to write the concatenated query to
+    Returns:
+        dict: sample id and original contig id of each namespaced contig id
+    """
+    namespace = dict()
+    with open(batch_fasta, 'w') as out:
+        for index, sample_id in enumerate(sample_fastas):
+            for contig_id, seq in read_fasta_dict(sample_fastas[sample_id]).items():
+                batch_id = NAMESPACE_FORMAT.format(index, contig_id)
+                namespace[batch_id] = (sample_id, contig_id)
+                out.write(">{}\n{}\n".format(batch_id, seq))
+    return namespace
+
+
+def demultiplex_hits(blast_df, namespace):
+    """Split the hits of the batch query by sample, restoring the original contig ids
+    Returns:
+        dict: hits of each sample id with hits, in their original order
+    """
+    samples = dict()
+    if isinstance(blast_df, dict) or len(blast_df) == 0:
+        return samples
+    batch_ids = blast_df['qseqid'].astype(str)
+    owners = batch_ids.map(lambda batch_id: namespace[batch_id][0]).values
+    contig_ids = batch_ids.map(lambda batch_id: namespace[batch_id][1]).values
+    for sample_id in OrderedDict.fromkeys(owners):
+        rows = owners == sample_id
+        sample_df = blast_df.loc[rows].reset_index(drop=True)
+        sample_df['qseqid'] = contig_ids[rows]
+        sample_df['qseqid'] = sample_df['qseqid'].astype('category')
+        samples[sample_id] = sample_df
+    return samples
+
+
+def demultiplex_contigs(contigs, namespace):
+    """Split a dict keyed by namespaced contig id into one dict per sample keyed by original contig id"""
+    samples = dict()
+    for batch_id in contigs:
+        sample_id, contig_id = namespace[batch_id]
+        if sample_id not in samples:
+            samples[sample_id] = OrderedDict()
+        samples[sample_id][contig_id] = contigs[batch_id]
+    return samples
+
+
+def main():
+    args = parse_args()
+
+    if args.debug:
+        init_console_logger(3)
+    logging.info("MOB-recon batch v. {} ".format(__version__))
+
+    if not os.path.exists(args.input):
+        logging.error('Error, input directory or sample sheet does not exist: "{}"'.format(args.input))
+        sys.exit(-1)
+
+    samples = read_samples(args.input)
+    if len(samples) == 0:
+        logging.error('Error, no assemblies found in "{}"'.format(args.input))
+        sys.exit(-1)
+    for sample_id in samples:
+        if not os.path.isfile(samples[sample_id]):
+            logging.error('Error, input fasta file does not exist: "{}"'.format(samples[sample_id]))
+            sys.exit(-1)
+
+    logging.info('Processing {} assemblies from {}'.format(len(samples), args.input))
+    logging.info('Analysis directory {}'.format(args.outdir))
+
+    if not os.path.isdir(args.outdir):
+        os.mkdir(args.outdir, 0o755)
+
+    # Check that the needed databases have been initialized
+    verify_init(logging)
+    status_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'databases/status.txt')
+    if not os.path.isfile(status_file):
+        logging.error('Error needed databases have not been initialize please run mob_init and try again')
+        sys.exit(-1)
+
+    params = get_search_params(args)
+
+    plasmid_ref_db = args.plasmid_db
+    replicon_ref = args.plasmid_replicons
+    mob_ref = args.plasmid_mob
+    mash_db = args.plasmid_mash_db
+    repetitive_mask_file = args.repetitive_mask
+
+    check_dependencies(logging)
+
+    needed_dbs = [plasmid_ref_db, replicon_ref, mob_ref, mash_db, repetitive_mask_file,"{}.nin".format(repetitive_mask_file)]
+
+    for db in needed_dbs:
+        if (not os.path.isfile(db)):
+            logging.error('Error needed database missing "{}"'.format(db))
+            sys.exit(-1)
+
+    num_threads = args.num_threads
+    batch_tmp_dir = os.path.join(args.outdir, '__batch_tmp')
+    if not os.path.isdir(batch_tmp_dir):
+        os.mkdir(batch_tmp_dir, 0o755)
+
+    sample_dirs = OrderedDict()
+    sample_fastas = OrderedDict()
+    for sample_id in samples:
+        out_dir = os.path.join(args.outdir, sample_id)
+        tmp_dir = os.path.join(out_dir, '__tmp')
+        for directory in (out_dir, tmp_dir):
+            if not os.path.isdir(directory):
+                os.mkdir(directory, 0o755)
+        sample_dirs[sample_id] = (out_dir, tmp_dir)
+        sample_fastas[sample_id] = os.path.join(tmp_dir, 'fixed.input.fasta')
+        logging.info('Writing cleaned header input fasta file from {} to {}'.format(samples[sample_id],
+                                                                                   sample_fastas[sample_id]))
+        fix_fasta_header(samples[sample_id], sample_fastas[sample_id])
+
+    batch_fasta = os.path.join(batch_tmp_dir, 'batch.input.fasta')
+    namespace = write_batch_query(sample_fastas, batch_fasta)
+
+    hit_cache = None
+    if args.hit_cache is not None:
+        hit_cache = BlastHitCache(args.hit_cache, max_bytes=args.hit_cache_size * 1024 * 1024)
+
+    # The plasmid and repetitive databases are searched once with the contigs of every assembly, the
+    # marker searches use each assembly as the database so they are run per assembly
+    scheduler = StageScheduler(num_threads)
+
+    logging.info('Running contig blast of {} assemblies on {}'.format(len(samples), plasmid_ref_db))
+    scheduler.add_stage('contig', contig_blast, batch_fasta, plasmid_ref_db, params['min_con_ident'],
+                        params['min_con_cov'], params['min_con_evalue'], params['min_length'], batch_tmp_dir,
+                        hit_cache=hit_cache, weight=2)
+
+    logging.info('Running repetitive contig masking blast of {} assemblies on {}'.format(len(samples),
+                                                                                        repetitive_mask_file))
+    scheduler.add_stage('repetitive', repetitive_blast, batch_fasta, repetitive_mask_file, params['min_rpp_ident'],
+                        params['min_rpp_cov'], params['min_rpp_evalue'], params['min_length'], batch_tmp_dir,
+                        hit_cache=hit_cache)
+
+    batch_results = scheduler.run()
+    contig_hits = demultiplex_hits(batch_results['contig'], namespace)
+    repetitive_hits = demultiplex_contigs(batch_results['repetitive'], namespace)
+    del batch_results
+
+    # each sample's database, marker hits and temporary files are released before the next sample starts
+    for sample_id in samples:
+        out_dir, tmp_dir = sample_dirs[sample_id]
+        with SampleBlastDb(sample_fastas[sample_id], tmp_dir) as sample_db:
+            scheduler = StageScheduler(num_threads)
+            scheduler.add_stage('replicon', replicon_blast, replicon_ref, sample_db, params['min_rep_ident'],
+                                params['min_rep_cov'], params['min_rep_evalue'], tmp_dir)
+            scheduler.add_stage('relaxase', mob_blast, mob_ref, sample_db, params['min_mob_ident'],
+                                params['min_mob_cov'], params['min_mob_evalue'], tmp_dir)
+            if args.run_circlator:
+                scheduler.add_stage('circlator', circularize, sample_fastas[sample_id],
+                                    os.path.join(tmp_dir, 'minimus'), max_threads=1)
+            sample_results = scheduler.run()
+
+        sample_results['contig'] = contig_hits.pop(sample_id, empty_blast_table())
+        sample_results['repetitive'] = repetitive_hits.pop(sample_id, OrderedDict())
+        logging.info('Reconstructing plasmids of {} in {}'.format(sample_id, out_dir))
+        reconstruct_plasmids(sample_results, read_fasta_dict(sample_fastas[sample_id]),
+                             os.path.basename(samples[sample_id]), out_dir, tmp_dir, mash_db, params['min_overlap'],
+                             unicycler_contigs=args.unicycler_contigs, run_typer=args.run_typer,
+                             num_threads=num_threads, num_mash_neighbors=args.num_mash_neighbors)
+        del sample_results
+        if not args.keep_tmp:
+            shutil.rmtree(tmp_dir)
+
+    if not args.keep_tmp:
+        shutil.rmtree(batch_tmp_dir)
+
+
+# call main function
+if __name__ == '__main__':
+    main()
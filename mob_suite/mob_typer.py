@@ -8,8 +8,9 @@ from argparse import (ArgumentParser, FileType)
 from mob_suite.version import __version__
 from mob_suite.blast import BlastRunner
 from mob_suite.blast import BlastReader
+from mob_suite.blast.db_registry import SampleBlastDb
 from mob_suite.wrappers import circlator
-from mob_suite.wrappers import mash
+from mob_suite.wrappers.minhash import MashReference, mash_best_hit, format_mash_neighbors
 from mob_suite.classes.mcl import mcl
 from mob_suite.utils import \
     fixStart, \
@@ -20,7 +21,6 @@ from mob_suite.utils import \
     mob_blast, \
     getRepliconContigs, \
     fix_fasta_header, \
-    getMashBestHit, \
     calcFastaStats, \
     verify_init, \
     check_dependencies
@@ -97,6 +97,8 @@ def parse_args():
 
     parser.add_argument('--keep_tmp', required=False,help='Do not delete temporary file directory', action='store_true')
     parser.add_argument('--debug', required=False, help='Show debug information', action='store_true')
+    parser.add_argument('--num_mash_neighbors', type=int, required=False,
+                        help='Report this many nearest Mash neighbors with their clusters', default=0)
     parser.add_argument('--plasmid_mash_db', type=str, required=False,
                         help='Companion Mash database of reference database',
                         default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -177,8 +179,13 @@ def main():
     	os.remove(orit_blast_results)    
     if os.path.isfile(replicon_blast_results):
     	os.remove(replicon_blast_results)     	
+    if not args.debug:
+        # BLAST output is parsed as it streams, the raw tables are only written when debugging
+        replicon_blast_results = None
+        mob_blast_results = None
+        mpf_blast_results = None
+        orit_blast_results = None
     report_file = os.path.join(out_dir, 'mobtyper_' + file_id + '_report.txt')
-    mash_file = os.path.join(tmp_dir, 'mash_' + file_id + '.txt')
 
     # Input numeric params
 
@@ -254,11 +261,12 @@ def main():
         os.mkdir(tmp_dir, 0o755)
 
     fix_fasta_header(input_fasta, fixed_fasta)
+    sample_db = SampleBlastDb(fixed_fasta, tmp_dir)
 
     # run individual marker blasts
     logging.info('Running replicon blast on {}'.format(replicon_ref))
     replicon_contigs = getRepliconContigs(
-        replicon_blast(replicon_ref, fixed_fasta, min_rep_ident, min_rep_cov, min_rep_evalue, tmp_dir, replicon_blast_results,
+        replicon_blast(replicon_ref, sample_db, min_rep_ident, min_rep_cov, min_rep_evalue, tmp_dir, replicon_blast_results,
                        num_threads=num_threads))
     found_replicons = dict()
     for contig_id in replicon_contigs:
@@ -270,7 +278,7 @@ def main():
     logging.info('Running relaxase blast on {}'.format(mob_ref))
 
     mob_contigs = getRepliconContigs(
-        mob_blast(mob_ref, fixed_fasta, min_mob_ident, min_mob_cov, min_mob_evalue, tmp_dir, mob_blast_results, num_threads=num_threads))
+        mob_blast(mob_ref, sample_db, min_mob_ident, min_mob_cov, min_mob_evalue, tmp_dir, mob_blast_results, num_threads=num_threads))
     found_mob = dict()
     for contig_id in mob_contigs:
         for hit in mob_contigs[contig_id]:
@@ -281,7 +289,7 @@ def main():
 
     logging.info('Running mpf blast on {}'.format(mob_ref))
     mpf_contigs = getRepliconContigs(
-        mob_blast(mpf_ref, fixed_fasta, min_mpf_ident, min_mpf_cov, min_mpf_evalue, tmp_dir, mpf_blast_results, num_threads=num_threads))
+        mob_blast(mpf_ref, sample_db, min_mpf_ident, min_mpf_cov, min_mpf_evalue, tmp_dir, mpf_blast_results, num_threads=num_threads))
     found_mpf = dict()
     for contig_id in mpf_contigs:
         for hit in mpf_contigs[contig_id]:
@@ -292,7 +300,7 @@ def main():
 
     logging.info('Running orit blast on {}'.format(replicon_ref))
     orit_contigs = getRepliconContigs(
-        replicon_blast(orit_ref, fixed_fasta, min_ori_ident, min_ori_cov, min_ori_evalue, tmp_dir, orit_blast_results,
+        replicon_blast(orit_ref, sample_db, min_ori_ident, min_ori_cov, min_ori_evalue, tmp_dir, orit_blast_results,
                        num_threads=num_threads))
     found_orit = dict()
     for contig_id in orit_contigs:
@@ -301,13 +309,20 @@ def main():
             found_orit[acs] = type
 
 
+    sample_db.cleanup()
+
     # Get closest neighbor by mash distance
-    m = mash()
-    mash_distances = dict()
-    mashfile_handle = open(mash_file, 'w')
-    m.run_mash(mash_db, fixed_fasta, mashfile_handle)
-    mash_results = m.read_mash(mash_file)
-    mash_top_hit = getMashBestHit(mash_results)
+    mash_ref = MashReference.load(mash_db)
+    mash_hits = mash_ref.nearest_hits(mash_ref.sketch(list(read_fasta_dict(fixed_fasta).values())),
+                                      max(1, args.num_mash_neighbors))
+    mash_top_hit = mash_best_hit(mash_hits)
+
+    # the list of nearest neighbors is an extra last column, only present when asked for
+    neighbors_header = ''
+    neighbors_column = ''
+    if args.num_mash_neighbors > 0:
+        neighbors_header = "\tmash_nearest_neighbors"
+        neighbors_column = "\t{}".format(format_mash_neighbors(mash_hits))
 
     results_fh = open(report_file, 'w')
     results_fh.write("file_id\tnum_contigs\ttotal_length\tgc\t" \
@@ -315,7 +330,7 @@ def main():
                      "relaxase_type(s)\trelaxase_type_accession(s)\t" \
                      "mpf_type\tmpf_type_accession(s)\t" \
                      "orit_type(s)\torit_accession(s)\tPredictedMobility\t" \
-                     "mash_nearest_neighbor\tmash_neighbor_distance\tmash_neighbor_cluster\n")
+                     "mash_nearest_neighbor\tmash_neighbor_distance\tmash_neighbor_cluster{}\n".format(neighbors_header))
 
     if len(found_replicons) > 0:
         rep_types = ",".join(list(found_replicons.values()))
@@ -353,7 +368,7 @@ def main():
     if mob_acs != '-' and mpf_acs != '-':
         predicted_mobility = 'Conjugative'
 
-    string = "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}".format(file_id, stats['num_seq'],
+    string = "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}{}".format(file_id, stats['num_seq'],
                                                                                      stats['size'], stats['gc_content'],
                                                                                      rep_types, rep_acs, mob_types,
                                                                                      mob_acs, mpf_type, mpf_acs,
@@ -361,7 +376,8 @@ def main():
                                                                                      predicted_mobility,
                                                                                      mash_top_hit['top_hit'],
                                                                                      mash_top_hit['mash_hit_score'],
-                                                                                     mash_top_hit['clustid'])
+                                                                                     mash_top_hit['clustid'],
+                                                                                     neighbors_column)
     results_fh.write(string)
 
     if not keep_tmp:
@@ -2,9 +2,16 @@ from Bio import SeqIO
 from Bio.SeqUtils import GC
 from mob_suite.blast import BlastRunner
 from mob_suite.blast import BlastReader
+from mob_suite.blast import select_hits
+from mob_suite.blast.db_registry import BlastDbRegistry, SampleBlastDb, reference_blastdb
+from mob_suite.blast.kmer_index import prescreen_markers
+from mob_suite.wrappers.minhash import mash_best_hit
 import os
 from subprocess import Popen, PIPE
 import shutil,sys
+import heapq
+import numpy as np
+import pandas as pd
 
 
 def check_dependencies(logging):
@@ -25,20 +32,27 @@ def check_dependencies(logging):
 
 
 
-def fixStart(blast_df):
-    for index, row in blast_df.iterrows():
-        sstart = blast_df.at[index, 'sstart']
-        send = blast_df.at[index, 'send']
-        if send < sstart:
-            temp = sstart
-            blast_df.at[index, 'sstart'] = send
-            blast_df.at[index, 'send'] = temp
-        qstart = blast_df.at[index, 'qstart']
-        qend = blast_df.at[index, 'qend']
-        if qend < qstart:
-            temp = qstart
-            blast_df.at[index, 'qstart'] = qend
-            blast_df.at[index, 'qend'] = temp
+def fixStart(blast_df, strand_col=None):
+    """Normalize BLAST hit coordinates so that start <= end on both the query and the subject.
+    Operates on whole columns at once and returns the same DataFrame with the swapped coordinates.
+    Args:
+        blast_df (DataFrame): hits with qstart, qend, sstart and send columns
+        strand_col (str): optional column to record the strand of each hit in, '-' when exactly one
+            of the query or subject coordinates was reversed, '+' otherwise
+    """
+    sstart = blast_df['sstart'].values
+    send = blast_df['send'].values
+    qstart = blast_df['qstart'].values
+    qend = blast_df['qend'].values
+    subject_reversed = send < sstart
+    query_reversed = qend < qstart
+
+    blast_df['sstart'] = np.minimum(sstart, send)
+    blast_df['send'] = np.maximum(sstart, send)
+    blast_df['qstart'] = np.minimum(qstart, qend)
+    blast_df['qend'] = np.maximum(qstart, qend)
+    if strand_col is not None:
+        blast_df[strand_col] = np.where(subject_reversed != query_reversed, '-', '+')
     return blast_df
 
 
@@ -51,8 +65,8 @@ def read_fasta_dict(fasta_file):
     return seqs
 
 
-def write_fasta_dict(seqs, fasta_file):
-    with open(fasta_file, "w") as handle:
+def write_fasta_dict(seqs, fasta_file, mode="w"):
+    with open(fasta_file, mode) as handle:
         for id in seqs:
             handle.write(">{}\n{}\n".format(id, seqs[id]))
     handle.close()
@@ -75,147 +89,148 @@ def verify_init(logging):
 
 
 def filter_overlaping_records(blast_df, overlap_threshold,contig_id_col,contig_start_col,contig_end_col,bitscore_col):
-    prev_contig_id = ''
-    prev_index = -1
-    prev_contig_start = -1
-    prev_contig_end = -1
-    prev_score = -1
-    filter_indexes = list()
-    exclude_filter = dict()
-
-
-    for index, row in blast_df.iterrows():
-        contig_id = row['sseqid']
-        contig_start = row['sstart']
-        contig_end = row['send']
-        score = row['bitscore']
-
-        if prev_contig_id == '':
-            prev_index = index
-            prev_contig_id = contig_id
-            prev_contig_start = contig_start
-            prev_contig_end = contig_end
-            prev_score = score
-            continue
-
-        if contig_id != prev_contig_id:
-            prev_index = index
-            prev_contig_id = contig_id
-            prev_contig_start = contig_start
-            prev_contig_end = contig_end
-            prev_score = score
-            continue
-
-        if (contig_start >= prev_contig_start and contig_start <= prev_contig_end) or (contig_end >= prev_contig_start and contig_end <= prev_contig_end):
-            overlap = abs(contig_start - prev_contig_end)
-            if overlap > overlap_threshold:
-                if prev_score > score:
-                    filter_indexes.append(index)
-                else:
-                    filter_indexes.append(prev_index)
-
-
-        prev_index = index
-        prev_contig_id = contig_id
-        prev_contig_start = contig_start
-        prev_contig_end = contig_end
-        prev_score = score
+    """Resolve overlapping HSPs per sequence in a single sorted sweep.
+    Hits are sorted by sequence id, interval start, interval end and decreasing bitscore. Each hit
+    is compared against the stack of hits kept so far on the same sequence: while the most recently
+    kept hit overlaps it by more than overlap_threshold bases, the lower scoring of the two is
+    discarded, ties discarding the earlier hit. Kept hits never overlap each other by more than the
+    threshold, so only the top of the stack needs checking and the sweep is linear after sorting.
+    Args:
+        blast_df (DataFrame): BLAST hits
+        overlap_threshold (int): maximum number of overlapping bases tolerated between kept hits
+        contig_id_col (str): column holding the sequence the coordinates refer to
+        contig_start_col (str): column holding the hit start on that sequence
+        contig_end_col (str): column holding the hit end on that sequence
+        bitscore_col (str): column holding the hit score
+    Returns:
+        DataFrame: kept hits in sweep order with a fresh index
+    """
+    if len(blast_df) == 0:
+        return blast_df.reset_index(drop=True)
+
+    starts = blast_df[contig_start_col].values
+    ends = blast_df[contig_end_col].values
+    blast_df = blast_df.assign(interval_lo=np.minimum(starts, ends), interval_hi=np.maximum(starts, ends))
+    blast_df = blast_df.sort_values([contig_id_col, 'interval_lo', 'interval_hi', bitscore_col],
+                                    ascending=[True, True, True, False], kind='mergesort')
+
+    seq_ids = pd.factorize(blast_df[contig_id_col])[0].tolist()
+    los = blast_df['interval_lo'].values.tolist()
+    his = blast_df['interval_hi'].values.tolist()
+    scores = blast_df[bitscore_col].values.tolist()
+    keep = np.zeros(len(los), dtype=bool)
+    stack = list()
+    prev_seq_id = None
+
+    for i in range(len(los)):
+        if seq_ids[i] != prev_seq_id:
+            stack = list()
+            prev_seq_id = seq_ids[i]
+        discarded = False
+        while len(stack) > 0:
+            top = stack[-1]
+            if his[top] - los[i] <= overlap_threshold:
+                break
+            if scores[top] > scores[i]:
+                discarded = True
+                break
+            keep[top] = False
+            stack.pop()
+        if not discarded:
+            keep[i] = True
+            stack.append(i)
+
+    blast_df = blast_df.loc[keep].drop(['interval_lo', 'interval_hi'], axis=1)
+    return blast_df.reset_index(drop=True)
 
-    for index in exclude_filter:
-        filter_indexes.append(index)
-    indexes = dict()
-    for i in blast_df.iterrows():
-        indexes[i[0]] = ''
 
-    blast_df.drop(filter_indexes, inplace=True)
+def get_sample_db_path(sample_db, tmp_dir):
+    """Return the BLAST database prefix of a sample given either a SampleBlastDb handle or a FASTA path"""
+    if isinstance(sample_db, SampleBlastDb):
+        return sample_db.db_path
+    return BlastDbRegistry(os.path.join(tmp_dir, 'blastdb')).get_db(sample_db, 'nucl')
 
-    return blast_df.reset_index(drop=True)
 
+def get_sample_fasta(sample_db):
+    if isinstance(sample_db, SampleBlastDb):
+        return sample_db.fasta_path
+    return sample_db
 
 
+def prescreen_marker_queries(input_fasta, ref_db, min_ident, min_cov, tmp_dir):
+    """Restrict the marker references searched against the sample to those sharing enough k-mers with it"""
+    candidates_fasta = os.path.join(tmp_dir, os.path.basename(input_fasta) + '.candidates.fasta')
+    return prescreen_markers(input_fasta, get_sample_fasta(ref_db), min_ident, min_cov, candidates_fasta)
 
 
-def replicon_blast(input_fasta, ref_db, min_ident, min_cov, evalue, tmp_dir,blast_results_file,overlap=5,num_threads=1):
+def replicon_blast(input_fasta, ref_db, min_ident, min_cov, evalue, tmp_dir,blast_results_file=None,overlap=5,num_threads=1):
     blast_runner = BlastRunner(input_fasta, tmp_dir)
-    blast_runner.makeblastdb(ref_db, 'nucl')
-    blast_runner.run_blast(query_fasta_path=input_fasta, blast_task='megablast', db_path=ref_db,
-                             db_type='nucl', min_cov=min_cov, min_ident=min_ident, evalue=evalue,
-                             blast_outfile=blast_results_file,
-                              num_threads=num_threads)
-    if os.path.getsize(blast_results_file) == 0:
+    db_path = get_sample_db_path(ref_db, tmp_dir)
+    query_fasta = prescreen_marker_queries(input_fasta, ref_db, min_ident, min_cov, tmp_dir)
+    if query_fasta is None:
+        return dict()
+    # hits are parsed straight from blastn, blast_results_file is only written when debugging
+    blast_df = blast_runner.run_blast_stream(query_fasta_path=query_fasta, blast_task='megablast', db_path=db_path,
+                                             db_type='nucl', min_cov=min_cov, min_ident=min_ident, evalue=evalue,
+                                             blast_outfile=blast_results_file, num_threads=num_threads,
+                                             min_values={'pident': min_ident, 'qcovhsp': min_cov})
+    if len(blast_df) == 0:
         return dict()
-    blast_df = BlastReader(blast_results_file).df
-    blast_df = blast_df.loc[blast_df['pident'] >= min_ident]
-    blast_df = blast_df.loc[blast_df['qcovhsp'] >= min_cov]
     blast_df = fixStart(blast_df)
-    blast_df = blast_df.sort_values(['sseqid', 'sstart', 'send', 'bitscore'], ascending=[True, True, True, False])
-    blast_df = blast_df.reset_index(drop=True)
-    size = str(len(blast_df))
     blast_df = filter_overlaping_records(blast_df, overlap, 'sseqid', 'sstart', 'send', 'bitscore')
-    prev_size = 0
-    while size != prev_size:
-        blast_df = filter_overlaping_records(blast_df, overlap, 'sseqid', 'sstart', 'send', 'bitscore')
-        prev_size = size
-        size = str(len(blast_df))
 
     return blast_df
 
 
-def mob_blast(input_fasta, ref_db, min_ident, min_cov, evalue, tmp_dir,blast_results_file,overlap=5,num_threads=1):
-    num_threads=1
+def mob_blast(input_fasta, ref_db, min_ident, min_cov, evalue, tmp_dir,blast_results_file=None,overlap=5,num_threads=1):
     blast_runner = BlastRunner(input_fasta, tmp_dir)
-    blast_runner.makeblastdb(ref_db, 'nucl')
-    blast_runner.run_tblastn(query_fasta_path=input_fasta, blast_task='megablast', db_path=ref_db,
-                             db_type='nucl', min_cov=min_cov, min_ident=min_ident, evalue=evalue,
-                             blast_outfile=blast_results_file,
-                              num_threads=num_threads)
-    if os.path.getsize(blast_results_file) == 0:
+    db_path = get_sample_db_path(ref_db, tmp_dir)
+    query_fasta = prescreen_marker_queries(input_fasta, ref_db, min_ident, min_cov, tmp_dir)
+    if query_fasta is None:
+        return dict()
+    # tblastn is run on query shards in parallel rather than with its own threading
+    blast_df = blast_runner.run_tblastn_sharded(query_fasta_path=query_fasta, blast_task='megablast', db_path=db_path,
+                                                db_type='nucl', min_cov=min_cov, min_ident=min_ident, evalue=evalue,
+                                                blast_outfile=blast_results_file,
+                                                num_threads=num_threads, work_dir=tmp_dir,
+                                                min_values={'pident': min_ident, 'qcovhsp': min_cov})
+    if len(blast_df) == 0:
         return dict()
-    blast_df = BlastReader(blast_results_file).df
-    blast_df = blast_df.loc[blast_df['pident'] >= min_ident]
-    blast_df = blast_df.loc[blast_df['qcovhsp'] >= min_cov]
     blast_df = fixStart(blast_df)
-    blast_df = blast_df.sort_values(['sseqid', 'sstart', 'send', 'bitscore'], ascending=[True, True, True, False])
-    blast_df = blast_df.reset_index(drop=True)
     blast_df = filter_overlaping_records(blast_df, overlap, 'sseqid', 'sstart', 'send', 'bitscore')
-    prev_size = 0
-    size = str(len(blast_df))
-    while size != prev_size:
-        blast_df = filter_overlaping_records(blast_df, overlap, 'sseqid', 'sstart', 'send', 'bitscore')
-        prev_size = size
-        size = str(len(blast_df))
-    #print(blast_df)
+
     return blast_df
 
 
 
-def repetitive_blast(input_fasta, ref_db, min_ident, min_cov, evalue, min_length, tmp_dir, blast_results_file,num_threads=1):
+def repetitive_blast(input_fasta, ref_db, min_ident, min_cov, evalue, min_length, tmp_dir, blast_results_file=None,num_threads=1,hit_cache=None):
     blast_runner = BlastRunner(input_fasta, tmp_dir)
-    blast_runner.makeblastdb(ref_db, 'nucl')
-    blast_runner.run_blast(query_fasta_path=input_fasta, blast_task='megablast', db_path=ref_db,
-                           db_type='nucl', min_cov=min_cov, min_ident=min_ident, evalue=evalue,
-                           blast_outfile=blast_results_file,
-                              num_threads=num_threads)
-    if os.path.getsize(blast_results_file) == 0:
+    db_path = reference_blastdb(ref_db, 'nucl', os.path.join(tmp_dir, 'blastdb_registry'))
+    min_values = {'length': min_length, 'pident': min_ident, 'qcovs': min_cov}
+    if hit_cache is not None and blast_results_file is None:
+        blast_df = hit_cache.run_blast_stream(blast_runner, input_fasta, 'megablast', db_path, 'nucl', min_cov,
+                                              min_ident, evalue, tmp_dir, num_threads=num_threads,
+                                              min_values=min_values)
+    else:
+        blast_df = blast_runner.run_blast_stream(query_fasta_path=input_fasta, blast_task='megablast', db_path=db_path,
+                                                 db_type='nucl', min_cov=min_cov, min_ident=min_ident, evalue=evalue,
+                                                 blast_outfile=blast_results_file, num_threads=num_threads,
+                                                 min_values=min_values)
+    if len(blast_df) == 0:
         return dict()
 
-    blast_df = BlastReader(blast_results_file).df
-    blast_df = blast_df.loc[blast_df['length'] >= min_length]
-    blast_df = blast_df.loc[blast_df['pident'] >= min_ident]
-    blast_df = blast_df.loc[blast_df['qcovs'] >= min_cov]
     blast_df = fixStart(blast_df)
     blast_df = blast_df.sort_values(['sseqid', 'sstart', 'send', 'bitscore'], ascending=[True, True, True, False])
     blast_df = blast_df.reset_index(drop=True)
 
+    # the lowest scoring hit of each contig is kept, the first in sorted order when several share the score
     contig_list = dict()
-    for index, row in blast_df.iterrows():
-        if not row['qseqid'] in contig_list:
-            contig_list[row['qseqid']] = {'id': row['sseqid'], 'score': row['bitscore'], 'contig_start': row['sstart'],
-                                          'contig_end': row['send']}
-        else:
-            if contig_list[row['qseqid']]['score'] > row['bitscore']:
-                contig_list[row['qseqid']] = {'id': row['sseqid'], 'score': row['bitscore'],
-                                              'contig_start': row['sstart'], 'contig_end': row['send']}
+    selected = select_hits(blast_df['qseqid'].astype(str).values, blast_df['bitscore'].values)
+    hits = blast_df.iloc[selected]
+    for contig_id, hit_id, score, start, end in zip(hits['qseqid'].astype(str).tolist(), hits['sseqid'].tolist(),
+                                                    hits['bitscore'].tolist(), hits['sstart'].tolist(),
+                                                    hits['send'].tolist()):
+        contig_list[contig_id] = {'id': hit_id, 'score': score, 'contig_start': start, 'contig_end': end}
 
     return contig_list
 
@@ -224,13 +239,20 @@ def getRepliconContigs(blast_df):
     contigs = dict()
     if isinstance(blast_df,dict) or blast_df is None:
         return contigs
-    for index, row in blast_df.iterrows():
-        contig_id = row['sseqid']
-        ident = row['pident']
-        start = row['sstart']
-        end = row['send']
-        hit_id = row['qseqid']
-        coverage = row['qcovs']
+    if len(blast_df) == 0:
+        return contigs
+
+    # the last hit of each marker on a contig is kept, contigs and markers listed as they are first hit
+    contig_ids = blast_df['sseqid'].astype(str).values
+    hit_ids = blast_df['qseqid'].astype(str).values
+    contig_codes = pd.factorize(contig_ids)[0]
+    hit_codes = pd.factorize(hit_ids)[0]
+    selected = select_hits(contig_codes.astype(np.int64) * (hit_codes.max() + 1) + hit_codes, keep='last')
+    selected = selected[np.argsort(contig_codes[selected], kind='mergesort')]
+    hits = blast_df.iloc[selected]
+    for contig_id, hit_id, ident, start, end, coverage in zip(contig_ids[selected].tolist(), hit_ids[selected].tolist(),
+                                                              hits['pident'].tolist(), hits['sstart'].tolist(),
+                                                              hits['send'].tolist(), hits['qcovs'].tolist()):
         if not contig_id in contigs:
             contigs[contig_id] = dict()
         contigs[contig_id][hit_id] = {'id': hit_id, 'ident': ident, 'start': start, 'end': end, 'coverage': coverage,
@@ -249,28 +271,42 @@ def fix_fasta_header(in_fasta, out_fasta):
     fh.close()
 
 
-def getMashBestHit(mash_results):
-    score = 1
-    matches = 0
-    top_hit = ''
-    top_hit_size = 0
-    seqid = ''
-    mash_clustid = ''
-
-    for line in mash_results:
-        row = line.strip("\n").split("\t")
+def getMashTopHits(mash_results, k=1):
+    """Select the k nearest references from mash dist output.
+    Lines are read one at a time, so a file handle or the stdout of a running mash can be passed,
+    and only the distance column is parsed until a line makes it into the bounded heap of the k
+    best. References at the same distance are ranked in the order mash reported them, so reading
+    stops once k references at distance 0 have been seen.
+    Args:
+        mash_results (iterable): lines of mash dist output
+        k (int): number of references to keep
+    Returns:
+        list: top_hit, mash_hit_score and clustid of the nearest references, nearest first
+    """
+    heap = list()
+    for order, line in enumerate(mash_results):
+        row = line.split("\t", 3)
+        distance = float(row[2])
+        if distance >= 1:
+            continue
+        # the heap keeps the worst of the k best on top with keys that invert distance and order
+        key = (-distance, -order)
+        if len(heap) < k:
+            heapq.heappush(heap, (key, row[0], row[2]))
+        elif key > heap[0][0]:
+            heapq.heapreplace(heap, (key, row[0], row[2]))
+        if len(heap) == k and heap[0][0][0] == 0:
+            break
+
+    hits = list()
+    for key, ref_id, score in sorted(heap, reverse=True):
+        seqid, mash_clustid = ref_id.split('|')
+        hits.append({'top_hit': seqid, 'mash_hit_score': score, 'clustid': mash_clustid})
+    return hits
 
-        if float(score) > float(row[2]):
-            seqid, mash_clustid = row[0].split('|')
-            score = row[2]
-            matches = row[4]
 
-    return {
-        'top_hit': seqid,
-        'mash_hit_score': score,
-        'top_hit_size': top_hit_size,
-        'clustid': mash_clustid
-    }
+def getMashBestHit(mash_results):
+    return mash_best_hit(getMashTopHits(mash_results, 1))
 
 ''''
     Accepts fasta file and returns size, number of sequence records and gc %
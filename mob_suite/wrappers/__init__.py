@@ -55,7 +55,18 @@ class mash:
         fh = open(mashfile, 'r')
         return fh.readlines()
 
-    def mashsketch(self, input_fasta, output_path, sketch_ind=True, num_threads=1, kmer_size=21, sketch_size=1000):
+    def mashpaste(self, output_path, sketch_files):
+        p = Popen(['mash', "paste", output_path] + list(sketch_files),
+                  stdout=PIPE,
+                  stderr=PIPE)
+        (stdout, stderr) = p.communicate()
+        if p.returncode != 0:
+            ex_msg = 'mash paste into {} failed with return code {}: {}'.format(output_path, p.returncode, stderr)
+            logging.error(ex_msg)
+            raise Exception(ex_msg)
+
+    def mashsketch(self, input_fasta, output_path, sketch_ind=True, num_threads=1, kmer_size=21, sketch_size=1000,
+                   seed=42):
         if output_path == '':
             os.path.dirname(input_fasta)
         p = Popen(['mash', "sketch",
@@ -63,7 +74,8 @@ class mash:
                    "-i",
                    "-o", output_path,
                    "-k", str(kmer_size),
-                   "-s", str(sketch_size), input_fasta],
+                   "-s", str(sketch_size),
+                   "-S", str(seed), input_fasta],
                   stdout=PIPE,
                   stderr=PIPE)
         p.wait()
@@ -0,0 +1,640 @@
+import heapq
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE
+
+import numpy as np
+
+from mob_suite.blast.kmer_index import canonical_nucl_kmers, concatenate_sequences
+
+MASH_KMER_SIZE = 21
+MASH_SKETCH_SIZE = 1000
+MASH_SEED = 42
+
+C1 = np.uint64(0x87c37b91114253d5)
+C2 = np.uint64(0x4cf5ad432745937f)
+LETTERS = np.frombuffer(b'ACGT', dtype=np.uint8).astype(np.uint64)
+
+
+def rotl64(x, r):
+    return (x << np.uint64(r)) | (x >> np.uint64(64 - r))
+
+
+def fmix64(k):
+    k = k ^ (k >> np.uint64(33))
+    k = k * np.uint64(0xff51afd7ed558ccd)
+    k = k ^ (k >> np.uint64(33))
+    k = k * np.uint64(0xc4ceb9fe1a85ec53)
+    k = k ^ (k >> np.uint64(33))
+    return k
+
+
+def murmurhash3_x64_64(words, length, seed=MASH_SEED):
+    """First 64 bits of MurmurHash3_x64_128 for many keys of the same length at once, as used by Mash.
+    Args:
+        words (ndarray): (n, ceil(length / 8)) uint64 little endian words of each key, zero padded
+        length (int): key length in bytes
+        seed (int): hash seed
+    Returns:
+        ndarray: uint64 hash of each key
+    """
+    with np.errstate(over='ignore'):
+        h1 = np.full(len(words), seed, dtype=np.uint64)
+        h2 = np.full(len(words), seed, dtype=np.uint64)
+        num_blocks = length // 16
+        for block in range(num_blocks):
+            k1 = words[:, 2 * block] * C1
+            k1 = rotl64(k1, 31) * C2
+            h1 ^= k1
+            h1 = rotl64(h1, 27) + h2
+            h1 = h1 * np.uint64(5) + np.uint64(0x52dce729)
+            k2 = words[:, 2 * block + 1] * C2
+            k2 = rotl64(k2, 33) * C1
+            h2 ^= k2
+            h2 = rotl64(h2, 31) + h1
+            h2 = h2 * np.uint64(5) + np.uint64(0x38495ab5)
+
+        tail = length & 15
+        if tail > 8:
+            k2 = words[:, 2 * num_blocks + 1] * C2
+            k2 = rotl64(k2, 33) * C1
+            h2 ^= k2
+        if tail > 0:
+            k1 = words[:, 2 * num_blocks] * C1
+            k1 = rotl64(k1, 31) * C2
+            h1 ^= k1
+
+        h1 ^= np.uint64(length)
+        h2 ^= np.uint64(length)
+        h1 = h1 + h2
+        h2 = h2 + h1
+        h1 = fmix64(h1)
+        h2 = fmix64(h2)
+        return h1 + h2
+
+
+def kmer_words(kmers, k):
+    """Spell 2-bit encoded k-mers as ASCII and pack them into little endian uint64 words"""
+    words = np.zeros((len(kmers), (k + 7) // 8), dtype=np.uint64)
+    for j in range(k):
+        letter = LETTERS[(kmers >> np.uint64(2 * (k - 1 - j))) & np.uint64(3)]
+        words[:, j // 8] |= letter << np.uint64(8 * (j % 8))
+    return words
+
+
+def sketch_sequences(seqs, kmer_size=MASH_KMER_SIZE, sketch_size=MASH_SKETCH_SIZE, seed=MASH_SEED,
+                     chunk_size=1000000):
+    """Bottom-s MinHash sketch of a set of sequences as built by `mash sketch` without -i.
+    Canonical k-mers of every sequence are hashed with MurmurHash3, k-mers with characters other
+    than ACGT are skipped, and the sketch_size smallest distinct hashes are kept.
+    Args:
+        seqs (list): sequences as str or bytes
+    Returns:
+        ndarray: sorted uint64 hashes
+    """
+    seqs = [seq.encode('ascii', 'replace') if isinstance(seq, str) else seq for seq in seqs]
+    kmers, valid = canonical_nucl_kmers(concatenate_sequences(seqs), kmer_size)
+    kmers = kmers[valid]
+    sketch = np.zeros(0, dtype=np.uint64)
+    for start in range(0, len(kmers), chunk_size):
+        hashes = murmurhash3_x64_64(kmer_words(kmers[start:start + chunk_size], kmer_size), kmer_size, seed)
+        sketch = np.unique(np.concatenate([sketch, hashes]))[0:sketch_size]
+    return sketch
+
+
+def sketch_each_sequence(seqs, kmer_size=MASH_KMER_SIZE, sketch_size=MASH_SKETCH_SIZE, seed=MASH_SEED,
+                         chunk_size=1000000):
+    """Bottom-s MinHash sketch of every sequence, computed in one pass over all of them.
+    The sketch of a group of sequences is the merge_sketches of their sketches, so each
+    sequence only has to be hashed once however many groups it ends up in.
+    Args:
+        seqs (list): sequences as str or bytes
+    Returns:
+        list: sorted uint64 hashes of each sequence
+    """
+    seqs = [seq.encode('ascii', 'replace') if isinstance(seq, str) else seq for seq in seqs]
+    kmers, valid = canonical_nucl_kmers(concatenate_sequences(seqs), kmer_size)
+    # window i of the concatenation belongs to the sequence whose separator follows it
+    separators = np.cumsum([len(seq) + 1 for seq in seqs]) - 1
+    owners = np.searchsorted(separators, np.nonzero(valid)[0], side='left')
+    kmers = kmers[valid]
+    kept_hashes = np.zeros(0, dtype=np.uint64)
+    kept_owners = np.zeros(0, dtype=np.int64)
+    for start in range(0, len(kmers), chunk_size):
+        hashes = murmurhash3_x64_64(kmer_words(kmers[start:start + chunk_size], kmer_size), kmer_size, seed)
+        kept_hashes = np.concatenate([kept_hashes, hashes])
+        kept_owners = np.concatenate([kept_owners, owners[start:start + chunk_size]])
+        order = np.lexsort((kept_hashes, kept_owners))
+        kept_hashes, kept_owners = kept_hashes[order], kept_owners[order]
+        distinct = np.concatenate([[True], (kept_hashes[1:] != kept_hashes[:-1]) |
+                                   (kept_owners[1:] != kept_owners[:-1])])
+        kept_hashes, kept_owners = kept_hashes[distinct], kept_owners[distinct]
+        owner_starts = np.searchsorted(kept_owners, kept_owners, side='left')
+        in_sketch = np.arange(len(kept_owners)) - owner_starts < sketch_size
+        kept_hashes, kept_owners = kept_hashes[in_sketch], kept_owners[in_sketch]
+    bounds = np.searchsorted(kept_owners, np.arange(len(seqs) + 1), side='left')
+    return [kept_hashes[bounds[i]:bounds[i + 1]] for i in range(len(seqs))]
+
+
+def merge_sketches(sketches, sketch_size=MASH_SKETCH_SIZE):
+    """Bottom-s sketch of the union of the sequences behind several bottom-s sketches"""
+    if len(sketches) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    return np.unique(np.concatenate(sketches))[0:sketch_size]
+
+
+def format_distance(distance):
+    # mash writes distances with the default six significant digits of C++ streams
+    return '{:g}'.format(distance)
+
+
+# Compact sketch stores are written next to the .msh file they were built from
+SKETCH_STORE_SUFFIX = '.sketches'
+SKETCH_STORE_VERSION = 1
+SKETCH_STORE_ARRAYS = ('hashes', 'lengths', 'ids', 'clusters', 'index_hashes', 'index_refs', 'index_ranks')
+PAD_HASH = np.iinfo(np.uint64).max
+
+# Banded LSH over one permutation MinHash signatures of the sketches, see SketchLSH
+LSH_BINS = 128
+LSH_ROWS = 2
+LSH_ARRAYS = ('lsh_keys', 'lsh_refs')
+
+_reference_memo = dict()
+_reference_lock = threading.Lock()
+
+
+def sketch_store_path(msh_file):
+    return msh_file + SKETCH_STORE_SUFFIX
+
+
+def msh_signature(msh_file):
+    stat = os.stat(msh_file)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def split_reference_name(name):
+    """Split a reference sketch name of the form accession|cluster, names without a cluster get an empty one"""
+    row = name.split('|')
+    if len(row) == 1:
+        return row[0], ''
+    return row[0], row[1]
+
+
+def oph_signatures(hashes, lengths, bins=LSH_BINS):
+    """One permutation MinHash signatures of bottom-s sketches.
+    Hashes are split into bins on their low bits and the smallest hash of each bin is kept. Every
+    hash below the largest one of a bottom-s sketch is in the sketch, so the minimum of a bin found
+    in the sketch is the minimum of that bin over all the k-mers of the sequence. Bins without a
+    hash are left at PAD_HASH.
+    Args:
+        hashes (ndarray): (n, sketch_size) matrix of sorted sketches padded with PAD_HASH
+        lengths (ndarray): number of hashes in each sketch
+    Returns:
+        ndarray: (n, bins) uint64 signatures
+    """
+    signatures = np.full((len(lengths), bins), PAD_HASH, dtype=np.uint64)
+    filled = np.arange(hashes.shape[1]) < np.asarray(lengths)[:, np.newaxis]
+    refs = np.nonzero(filled)[0]
+    values = np.asarray(hashes)[filled]
+    keys = refs * bins + (values & np.uint64(bins - 1)).astype(np.int64)
+    # sketches are sorted, so the first hash of each reference and bin is its minimum
+    unique_keys, first = np.unique(keys, return_index=True)
+    signatures.reshape(-1)[unique_keys] = values[first]
+    return signatures
+
+
+def band_keys(signatures, rows=LSH_ROWS):
+    """Hash each band of rows consecutive signature values into one key, bands with empty bins are invalid
+    Returns:
+        tuple: (n, bands) uint64 keys and boolean mask of the valid bands
+    """
+    num_bands = signatures.shape[1] // rows
+    bands = signatures[:, 0:num_bands * rows].reshape(len(signatures), num_bands, rows)
+    valid = (bands != PAD_HASH).all(axis=2)
+    with np.errstate(over='ignore'):
+        keys = np.broadcast_to(np.arange(num_bands, dtype=np.uint64) * C1, (len(signatures), num_bands)).copy()
+        for row in range(rows):
+            keys = fmix64(rotl64(keys, 31) ^ bands[:, :, row])
+    return keys, valid
+
+
+class SketchLSH:
+    """Banded locality sensitive hashing index of the sketches of a reference.
+
+    Each sketch is summarised by a one permutation MinHash signature which is cut into bands of
+    LSH_ROWS values. Two sketches land in the same bucket of a band with a probability of about
+    their Jaccard similarity to the power LSH_ROWS, so with 64 bands of 2 a pair at a Mash distance
+    of 0.05 (Jaccard 0.21) shares a bucket with a probability of 0.94, and near identical pairs
+    almost always do. The buckets are a sorted array of band keys with the reference of each.
+    """
+
+    def __init__(self, lsh_keys, lsh_refs, bins=LSH_BINS, rows=LSH_ROWS):
+        self.lsh_keys = lsh_keys
+        self.lsh_refs = lsh_refs
+        self.bins = bins
+        self.rows = rows
+
+    @classmethod
+    def build(cls, reference, bins=LSH_BINS, rows=LSH_ROWS):
+        keys, valid = band_keys(oph_signatures(reference.hashes, reference.lengths, bins), rows)
+        refs = np.broadcast_to(np.arange(len(keys))[:, np.newaxis], keys.shape)[valid]
+        keys = keys[valid]
+        order = np.argsort(keys, kind='mergesort')
+        return cls(keys[order], refs[order].astype(np.min_scalar_type(max(len(reference) - 1, 0))), bins, rows)
+
+    def candidates(self, query):
+        """References sharing at least one bucket with a query sketch, in database order"""
+        query = np.asarray(query, dtype=np.uint64)
+        signature = oph_signatures(query[np.newaxis, :], np.array([len(query)]), self.bins)
+        keys, valid = band_keys(signature, self.rows)
+        keys = keys[valid]
+        starts = np.searchsorted(self.lsh_keys, keys, side='left')
+        ends = np.searchsorted(self.lsh_keys, keys, side='right')
+        if len(keys) == 0 or (ends - starts).sum() == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate([np.asarray(self.lsh_refs[start:end]) for start, end in zip(starts, ends)]))
+
+
+class MashReference:
+    """Sketches of a Mash reference database held as a compact matrix with an inverted index.
+
+    Row i of hashes holds the sorted sketch of reference i padded with PAD_HASH up to the sketch
+    size, with the reference accession and cluster in ids and clusters. The inverted index lists
+    every hash of the matrix in sorted order with the reference and rank within its sketch it
+    comes from, so the references sharing hashes with a query are found with a binary search
+    per query hash instead of a scan of every sketch. Both are written once as .npy files by
+    mob_init and mob_cluster and opened with mmap, so concurrent processes share one copy through
+    the page cache. Use MashReference.load to share one instance per database in a process.
+    """
+
+    def __init__(self, hashes, lengths, ids, clusters, index_hashes, index_refs, index_ranks,
+                 kmer_size=MASH_KMER_SIZE, sketch_size=MASH_SKETCH_SIZE, seed=MASH_SEED):
+        self.hashes = hashes
+        self.lengths = lengths
+        self.ids = ids
+        self.clusters = clusters
+        self.index_hashes = index_hashes
+        self.index_refs = index_refs
+        self.index_ranks = index_ranks
+        self.kmer_size = kmer_size
+        self.sketch_size = sketch_size
+        self.seed = seed
+        self.lsh = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_sketches(cls, names, sketches, kmer_size=MASH_KMER_SIZE, sketch_size=MASH_SKETCH_SIZE, seed=MASH_SEED):
+        """Build the matrix and inverted index from the sorted hash array of each named sketch"""
+        num_refs = len(names)
+        hashes = np.full((num_refs, sketch_size), PAD_HASH, dtype=np.uint64)
+        lengths = np.zeros(num_refs, dtype=np.int32)
+        for i, sketch in enumerate(sketches):
+            sketch = np.sort(sketch)[0:sketch_size]
+            hashes[i, 0:len(sketch)] = sketch
+            lengths[i] = len(sketch)
+        ids = list()
+        clusters = list()
+        for name in names:
+            seqid, clustid = split_reference_name(name)
+            ids.append(seqid)
+            clusters.append(clustid)
+
+        filled = np.arange(sketch_size) < lengths[:, np.newaxis]
+        refs, ranks = np.nonzero(filled)
+        flat = hashes[filled]
+        order = np.argsort(flat, kind='mergesort')
+        return cls(hashes, lengths, np.array(ids, dtype=str), np.array(clusters, dtype=str), flat[order],
+                   refs[order].astype(np.min_scalar_type(max(num_refs - 1, 0))),
+                   ranks[order].astype(np.min_scalar_type(max(sketch_size - 1, 0))),
+                   kmer_size, sketch_size, seed)
+
+    @classmethod
+    def from_msh(cls, msh_file):
+        """Read the sketches of a .msh file with `mash info -d`"""
+        p = Popen(['mash', 'info', '-d', msh_file],
+                  stdout=PIPE,
+                  stderr=PIPE)
+        (stdout, stderr) = p.communicate()
+        if p.returncode != 0:
+            ex_msg = 'mash info on {} failed with return code {}: {}'.format(msh_file, p.returncode, stderr)
+            logging.error(ex_msg)
+            raise Exception(ex_msg)
+        info = json.loads(stdout.decode('utf-8'))
+        if info.get('hashBits', 64) != 64 or not info.get('canonical', True):
+            ex_msg = 'Mash sketches in {} must be canonical with 64 bit hashes'.format(msh_file)
+            logging.error(ex_msg)
+            raise Exception(ex_msg)
+        names = list()
+        sketches = list()
+        for sketch in info['sketches']:
+            names.append(sketch['name'])
+            sketches.append(np.array([int(h) for h in sketch['hashes']], dtype=np.uint64))
+        return cls.from_sketches(names, sketches, int(info['kmer']), int(info['sketchSize']),
+                                 int(info.get('hashSeed', MASH_SEED)))
+
+    def save(self, store_dir, source_msh):
+        """Write the reference as a sketch store, the metadata is written last so partial stores are never loaded"""
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir, 0o755)
+        meta_file = os.path.join(store_dir, 'meta.json')
+        if os.path.isfile(meta_file):
+            os.remove(meta_file)
+        for name in SKETCH_STORE_ARRAYS:
+            np.save(os.path.join(store_dir, name + '.npy'), getattr(self, name))
+        lsh = self.lsh_index()
+        for name in LSH_ARRAYS:
+            np.save(os.path.join(store_dir, name + '.npy'), getattr(lsh, name))
+        meta = {'version': SKETCH_STORE_VERSION, 'kmer_size': self.kmer_size, 'sketch_size': self.sketch_size,
+                'seed': self.seed, 'source': msh_signature(source_msh),
+                'lsh': {'bins': lsh.bins, 'rows': lsh.rows}}
+        with open(meta_file, 'w') as fh:
+            json.dump(meta, fh)
+
+    @classmethod
+    def open_store(cls, store_dir, source_msh=None):
+        """Open a sketch store with every array memory mapped, returning None if it is missing or out of date"""
+        meta_file = os.path.join(store_dir, 'meta.json')
+        if not os.path.isfile(meta_file):
+            return None
+        with open(meta_file, 'r') as fh:
+            meta = json.load(fh)
+        if meta.get('version') != SKETCH_STORE_VERSION:
+            logging.warning('Sketch store {} has an unsupported version, ignoring it'.format(store_dir))
+            return None
+        if source_msh is not None and meta.get('source') != msh_signature(source_msh):
+            logging.warning('Sketch store {} is older than {}, ignoring it'.format(store_dir, source_msh))
+            return None
+        arrays = [np.load(os.path.join(store_dir, name + '.npy'), mmap_mode='r') for name in SKETCH_STORE_ARRAYS]
+        reference = cls(*arrays, kmer_size=meta['kmer_size'], sketch_size=meta['sketch_size'], seed=meta['seed'])
+        if 'lsh' in meta:
+            lsh_arrays = [np.load(os.path.join(store_dir, name + '.npy'), mmap_mode='r') for name in LSH_ARRAYS]
+            reference.lsh = SketchLSH(*lsh_arrays, bins=meta['lsh']['bins'], rows=meta['lsh']['rows'])
+        return reference
+
+    @classmethod
+    def load(cls, msh_file):
+        """Return the reference for msh_file, reading it only once per process.
+        The sketch store built by mob_init or mob_cluster is used when it is current, otherwise the
+        sketches are read from the .msh file.
+        """
+        stat = os.stat(msh_file)
+        memo_key = (os.path.realpath(msh_file), stat.st_size, stat.st_mtime_ns)
+        with _reference_lock:
+            if memo_key not in _reference_memo:
+                reference = cls.open_store(sketch_store_path(msh_file), msh_file)
+                if reference is None:
+                    logging.info('Loading Mash reference sketches from {}'.format(msh_file))
+                    reference = cls.from_msh(msh_file)
+                else:
+                    logging.info('Opened Mash reference sketch store {}'.format(sketch_store_path(msh_file)))
+                _reference_memo[memo_key] = reference
+            return _reference_memo[memo_key]
+
+    def sketch(self, seqs):
+        return sketch_sequences(seqs, self.kmer_size, self.sketch_size, self.seed)
+
+    def shared_hashes(self, queries):
+        """Count the hashes each reference shares with each query sketch within their bottom-s union, as mash dist does.
+        Only the (query, reference) pairs sharing at least one hash are reported, every other pair has a distance of 1.
+        Args:
+            queries (list): sorted uint64 sketch of each query
+        Returns:
+            tuple: query index, reference index, common hash count and union size (the Jaccard denominator) of each pair
+        """
+        query_lengths = np.array([len(query) for query in queries], dtype=np.int64)
+        empty = np.zeros(0, dtype=np.int64)
+        if len(queries) == 0 or query_lengths.sum() == 0 or len(self.index_hashes) == 0:
+            return empty, empty, empty, empty
+        query_hashes = np.concatenate(queries).astype(np.uint64)
+        query_ids = np.repeat(np.arange(len(queries)), query_lengths)
+        query_ranks = np.arange(len(query_hashes)) - np.repeat(np.cumsum(query_lengths) - query_lengths, query_lengths)
+
+        # every match of a query hash in the inverted index is one hash shared with one reference
+        starts = np.searchsorted(self.index_hashes, query_hashes, side='left')
+        match_counts = np.searchsorted(self.index_hashes, query_hashes, side='right') - starts
+        matched = np.repeat(np.arange(len(query_hashes)), match_counts)
+        if len(matched) == 0:
+            return empty, empty, empty, empty
+        match_starts = np.repeat(starts - np.cumsum(match_counts) + match_counts, match_counts)
+        positions = np.arange(len(matched)) + match_starts
+        pair_query = query_ids[matched]
+        pair_ref = np.asarray(self.index_refs[positions]).astype(np.int64)
+        query_rank = query_ranks[matched] + 1
+        ref_rank = np.asarray(self.index_ranks[positions]).astype(np.int64) + 1
+
+        order = np.lexsort((query_rank, pair_ref, pair_query))
+        pair_query, pair_ref, query_rank, ref_rank = pair_query[order], pair_ref[order], query_rank[order], ref_rank[order]
+        pair_key = pair_query * len(self) + pair_ref
+        new_pair = np.concatenate([[True], pair_key[1:] != pair_key[:-1]])
+        pair_starts = np.nonzero(new_pair)[0]
+        common_total = np.diff(np.append(pair_starts, len(pair_key)))
+
+        # a shared hash counts when fewer than sketch_size hashes of the union are below or equal to it
+        common_rank = np.arange(len(pair_key)) - np.repeat(pair_starts, common_total) + 1
+        counted = ref_rank + query_rank - common_rank <= self.sketch_size
+        common = np.add.reduceat(counted.astype(np.int64), pair_starts)
+
+        query_index = pair_query[pair_starts]
+        ref_index = pair_ref[pair_starts]
+        denominator = np.minimum(self.sketch_size,
+                                 self.lengths[ref_index].astype(np.int64) + query_lengths[query_index] - common_total)
+        return query_index, ref_index, common, denominator
+
+    def distances(self, common, denominator):
+        """Mash distance of each pair from its common hash count and union size"""
+        jaccard = np.where(denominator > 0, common / np.maximum(denominator, 1), 0)
+        with np.errstate(divide='ignore'):
+            distances = -np.log(2 * jaccard / (1. + jaccard)) / self.kmer_size
+        distances[common == denominator] = 0.0
+        distances[common == 0] = 1.0
+        return distances
+
+    def top_hits(self, queries, k=1):
+        """Nearest references of many query sketches in one call.
+        As in mash output distances are compared at six significant digits, and references at the
+        same distance are ranked in database order. References sharing no hash are never reported.
+        Args:
+            queries (list): sorted uint64 sketch of each query
+            k (int): maximum number of references to report per query
+        Returns:
+            list: for each query a list of (reference index, distance as written by mash) tuples, nearest first
+        """
+        hits = [list() for i in range(len(queries))]
+        query_index, ref_index, common, denominator = self.shared_hashes(queries)
+        distances = self.distances(common, denominator)
+        keep = distances < 1
+        query_index, ref_index, distances = query_index[keep], ref_index[keep], distances[keep]
+        if len(distances) == 0:
+            return hits
+
+        # a pair can only be in the top k of its query if fewer than k pairs are clearly nearer
+        order = np.lexsort((ref_index, distances, query_index))
+        query_index, ref_index, distances = query_index[order], ref_index[order], distances[order]
+        query_starts = np.searchsorted(query_index, query_index, side='left')
+        kth = np.minimum(query_starts + k - 1, np.searchsorted(query_index, query_index, side='right') - 1)
+        keep = distances <= distances[kth] * (1 + 1e-5)
+        for q, r, distance in zip(query_index[keep], ref_index[keep], distances[keep]):
+            hits[q].append((r, format_distance(distance)))
+        for q in range(len(hits)):
+            hits[q] = heapq.nsmallest(k, hits[q], key=lambda hit: (float(hit[1]), hit[0]))
+        return hits
+
+    def sketch_each(self, seqs):
+        return sketch_each_sequence(seqs, self.kmer_size, self.sketch_size, self.seed)
+
+    def merge(self, sketches):
+        return merge_sketches(sketches, self.sketch_size)
+
+    def names(self):
+        """Sketch names as in the .msh file, the accession and cluster joined when there is a cluster"""
+        return [seqid if clustid == '' else '{}|{}'.format(seqid, clustid)
+                for seqid, clustid in zip(self.ids, self.clusters)]
+
+    def reference_sketch(self, index):
+        return np.asarray(self.hashes[index, 0:self.lengths[index]])
+
+    def extend(self, names, sketches):
+        """Reference with the named sketches appended after the existing ones, as `mash paste` orders them"""
+        return MashReference.from_sketches(self.names() + list(names),
+                                           [self.reference_sketch(i) for i in range(len(self))] + list(sketches),
+                                           self.kmer_size, self.sketch_size, self.seed)
+
+    def pairwise_distances(self, max_distance, block_size=500, num_threads=1):
+        """Distances between the pairs of references no more than max_distance apart, as written by mash dist.
+        References are compared in blocks against the inverted index, so memory grows with the number
+        of close pairs rather than with the square of the number of references.
+        Args:
+            max_distance (float): largest distance kept
+            block_size (int): number of references compared at once
+            num_threads (int): number of blocks compared concurrently
+        Returns:
+            tuple: first reference index, second reference index (always greater) and distance of each pair
+        """
+        def compare_block(start):
+            end = min(start + block_size, len(self))
+            query_index, ref_index, common, denominator = self.shared_hashes(
+                [self.reference_sketch(i) for i in range(start, end)])
+            query_index = query_index + start
+            distances = self.distances(common, denominator)
+            close = (ref_index > query_index) & (distances <= max_distance * (1 + 1e-5))
+            # compare at the precision mash writes distances with, as when reading its output
+            printed = np.array([float(format_distance(distance)) for distance in distances[close]], dtype=np.float64)
+            keep = printed <= max_distance
+            return query_index[close][keep], ref_index[close][keep], printed[keep]
+
+        with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+            blocks = list(executor.map(compare_block, range(0, len(self), block_size)))
+        if len(blocks) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0, dtype=np.float64)
+        return tuple(np.concatenate(arrays) for arrays in zip(*blocks))
+
+    def lsh_index(self):
+        """The LSH index of the reference, built the first time it is needed when it was not stored"""
+        if self.lsh is None:
+            self.lsh = SketchLSH.build(self)
+        return self.lsh
+
+    def candidate_distances(self, query, refs):
+        """Mash distances as written by mash dist from a query sketch to a subset of the references"""
+        refs = np.asarray(refs, dtype=np.int64)
+        rows = np.asarray(self.hashes[refs])
+        lengths = np.asarray(self.lengths[refs]).astype(np.int64)
+        filled = np.arange(self.sketch_size) < lengths[:, np.newaxis]
+        position = np.searchsorted(query, rows)
+        in_query = filled & (query[np.minimum(position, max(len(query) - 1, 0))] == rows) if len(query) > 0 \
+            else np.zeros(rows.shape, dtype=bool)
+        common_total = in_query.sum(axis=1)
+        # same bottom-s union rule as shared_hashes, ranks are 1 based
+        ref_rank = np.arange(1, self.sketch_size + 1)[np.newaxis, :]
+        counted = in_query & (ref_rank + position + 1 - np.cumsum(in_query, axis=1) <= self.sketch_size)
+        denominator = np.minimum(self.sketch_size, lengths + len(query) - common_total)
+        distances = self.distances(counted.sum(axis=1), denominator)
+        return np.array([float(format_distance(distance)) for distance in distances], dtype=np.float64)
+
+    def nearest_within(self, queries, max_distance, use_lsh=True):
+        """Nearest reference no more than max_distance from each query sketch.
+        With use_lsh only the references sharing an LSH bucket with a query are compared, and the
+        query falls back to a search of every reference when none of them is within max_distance,
+        so a query is only reported without a neighbor when no reference is within max_distance.
+        Returns:
+            list: (reference index, distance) of each query, or None
+        """
+        nearest = [None] * len(queries)
+        exhaustive = list()
+        for i, query in enumerate(queries):
+            if not use_lsh:
+                exhaustive.append(i)
+                continue
+            refs = self.lsh_index().candidates(query)
+            if len(refs) > 0:
+                distances = self.candidate_distances(query, refs)
+                # candidates are in database order, so argmin keeps the first at the smallest distance
+                best = int(np.argmin(distances))
+                if distances[best] <= max_distance:
+                    nearest[i] = (int(refs[best]), float(distances[best]))
+                    continue
+            exhaustive.append(i)
+
+        if len(exhaustive) > 0:
+            if use_lsh:
+                logging.info('No LSH candidate within {} for {} of {} queries, comparing them to every reference'.format(
+                    max_distance, len(exhaustive), len(queries)))
+            for i, hits in zip(exhaustive, self.top_hits([queries[i] for i in exhaustive], 1)):
+                if len(hits) > 0 and float(hits[0][1]) <= max_distance:
+                    nearest[i] = (int(hits[0][0]), float(hits[0][1]))
+        return nearest
+
+    def nearest_hits(self, query, k=1):
+        """The k nearest references to a sketch, nearest first, in the form of getMashTopHits"""
+        return [{'top_hit': str(self.ids[ref_index]), 'mash_hit_score': score,
+                 'clustid': str(self.clusters[ref_index])} for ref_index, score in self.top_hits([query], k)[0]]
+
+    def best_hit(self, seqs):
+        """Nearest reference to the sequences sketched together, with the result of getMashBestHit on mash dist output.
+        Returns:
+            dict: top_hit, mash_hit_score, top_hit_size and clustid
+        """
+        return self.best_sketch_hit(self.sketch(seqs))
+
+    def best_sketch_hit(self, query):
+        """best_hit for an already computed sketch, such as the merge of the sketches of a group of contigs"""
+        return mash_best_hit(self.nearest_hits(query, 1))
+
+
+def mash_best_hit(hits):
+    """Best hit record of getMashBestHit from a list of nearest hits, with a distance of 1 when there are none"""
+    result = {'top_hit': '', 'mash_hit_score': 1, 'top_hit_size': 0, 'clustid': ''}
+    if len(hits) > 0:
+        result.update(hits[0])
+    return result
+
+
+def format_mash_neighbors(hits):
+    """Report column listing nearest hits as accession|cluster:distance"""
+    return ','.join('{}|{}:{}'.format(hit['top_hit'], hit['clustid'], hit['mash_hit_score']) for hit in hits)
+
+
+def build_sketch_store(msh_file, clusters=None, reference=None):
+    """Write the compact sketch store of a .msh file read by MashReference.load.
+    Args:
+        msh_file (str): mash sketch file
+        clusters (dict): optional cluster of each accession, replacing the cluster in the sketch names
+        reference (MashReference): the sketches of msh_file if they have already been read
+    Returns:
+        MashReference: the reference written
+    """
+    if reference is None:
+        reference = MashReference.from_msh(msh_file)
+    if clusters is not None:
+        reference.clusters = np.array([str(clusters.get(seqid, clustid))
+                                       for seqid, clustid in zip(reference.ids, reference.clusters)], dtype=str)
+    store_dir = sketch_store_path(msh_file)
+    logging.info('Writing Mash reference sketch store {}'.format(store_dir))
+    reference.save(store_dir, msh_file)
+    return reference
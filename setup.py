@@ -50,6 +50,7 @@ setup(
         'console_scripts': [
             'mob_init=mob_suite.mob_init:main',
             'mob_recon=mob_suite.mob_recon:main',
+            'mob_recon_batch=mob_suite.mob_recon_batch:main',
             'mob_cluster=mob_suite.mob_cluster:main',
             'mob_typer=mob_suite.mob_typer:main',
             'best_blast_hits=mob_suite.blast_best_hits:main',
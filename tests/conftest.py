@@ -0,0 +1,64 @@
+import os
+import stat
+import sys
+
+import pytest
+
+# Stand-in for blastn and tblastn reporting hits derived from the sequence of each query record, so
+# the hits of a contig do not depend on its id or on the other records of the query
+FAKE_BLAST = '''#!{python} -S
+import random
+import sys
+import zlib
+
+args = sys.argv[1:]
+records = list()
+with open(args[args.index('-query') + 1]) as fh:
+    for line in fh:
+        if line.startswith('>'):
+            records.append([line[1:].split()[0], ''])
+        elif len(records) > 0:
+            records[-1][1] += line.strip()
+out = sys.stdout
+if '-out' in args:
+    out = open(args[args.index('-out') + 1], 'w')
+for seq_id, seq in records:
+    rng = random.Random(zlib.crc32(seq.encode('ascii')))
+    for i in range(rng.randint(0, 5)):
+        length = rng.randint(50, max(50, len(seq)))
+        qstart = rng.randint(1, max(1, len(seq) - length + 1))
+        sstart = rng.randint(1, 3000)
+        send = sstart + length - 1
+        if rng.random() < 0.3:
+            sstart, send = send, sstart
+        out.write('\\t'.join(str(value) for value in (
+            seq_id, 'ref{{}}|{{}}'.format(rng.randint(0, 6), rng.randint(0, 2)), len(seq), 5000, qstart,
+            qstart + length - 1, sstart, send, length, rng.randint(0, 20), rng.choice([78.5, 85.0, 92.25, 100.0]),
+            rng.choice([40, 60, 80, 100]), rng.choice([40, 60, 80, 100]), rng.choice(['plus', 'minus']),
+            rng.choice([1e-180, 2.5e-40, 1e-5]), rng.choice([150.0, 200.5, 200.5, 380.0]))) + '\\n')
+'''
+
+
+@pytest.fixture
+def fake_blast(tmp_path, monkeypatch):
+    """Put fake blastn and tblastn programs first on the PATH, returning their directory"""
+    bin_dir = os.path.join(str(tmp_path), 'fake_bin')
+    os.mkdir(bin_dir)
+    for program in ('blastn', 'tblastn'):
+        path = os.path.join(bin_dir, program)
+        with open(path, 'w') as fh:
+            fh.write(FAKE_BLAST.format(python=sys.executable))
+        os.chmod(path, stat.S_IRWXU)
+    monkeypatch.setenv('PATH', bin_dir + os.pathsep + os.environ.get('PATH', ''))
+    return bin_dir
+
+
+def write_random_fasta(path, rng, num_records, min_length=100, max_length=3000, prefix='contig'):
+    """Write records of random sequence, returning their ids"""
+    ids = list()
+    with open(path, 'w') as fh:
+        for i in range(num_records):
+            ids.append('{}{}'.format(prefix, i))
+            fh.write('>{}\n{}\n'.format(ids[-1], ''.join(rng.choice(list('ACGT'), size=int(rng.integers(
+                min_length, max_length))))))
+    return ids
@@ -0,0 +1,83 @@
+import os
+import time
+
+import pytest
+
+from mob_suite.classes.cluster_store import ClusterStore, cluster_store_path, open_cluster_store
+
+HEADER = ('id', 0.05, 0.0001)
+
+
+def write_cluster_file(path, rows):
+    with open(path, 'w') as fh:
+        fh.write('id\t0.05\t0.0001\n')
+        for row in rows:
+            fh.write('\t'.join(map(str, row)) + '\n')
+    return path
+
+
+def test_add_get_members(tmp_path):
+    store = ClusterStore(os.path.join(str(tmp_path), 'clusters.sqlite'))
+    with pytest.raises(Exception, match='no distance thresholds'):
+        store.add({'a': [1, 1]})
+    store.add({'b': [2, 5], 'a': ['1', '7']}, HEADER[1:])
+    assert store.thresholds() == ['0.05', '0.0001']
+    assert store.next_ids() == [3, 8]
+    assert store.get('a') == [1, 7]
+    assert store.get('missing') is None
+    assert 'b' in store and 'missing' not in store
+
+    store.add({'c': [2, 9], 'a': [2, 7]})
+    assert len(store) == 3
+    assert store.members(0, 2) == ['b', 'a', 'c']
+    assert store.members(1, '7') == ['a']
+    assert store.members(0, 1) == []
+    assert store.next_ids() == [3, 10]
+    with pytest.raises(Exception, match='has 1 clusters'):
+        store.add({'d': [1]})
+
+
+def test_export_import_round_trip(tmp_path):
+    tmp_dir = str(tmp_path)
+    rows = [('NC_1|x', 1, 1), ('NC_3', 2, 4), ('NC_2', 1, 3)]
+    cluster_file = write_cluster_file(os.path.join(tmp_dir, 'clusters.txt'), rows)
+    store = ClusterStore(os.path.join(tmp_dir, 'imported.sqlite'))
+    store.import_file(cluster_file)
+    assert list(store.assignments().items()) == [('NC_1|x', [1, 1]), ('NC_3', [2, 4]), ('NC_2', [1, 3])]
+
+    exported = os.path.join(tmp_dir, 'exported.txt')
+    store.export_file(exported, HEADER)
+    with open(exported) as fh, open(cluster_file) as original:
+        assert fh.read() == original.read()
+    assert os.path.getmtime(store.store_path) >= os.path.getmtime(exported)
+
+
+def test_open_reimports_changed_file(tmp_path):
+    tmp_dir = str(tmp_path)
+    cluster_file = write_cluster_file(os.path.join(tmp_dir, 'clusters.txt'), [('a', 1, 1), ('b', 1, 2)])
+    store = open_cluster_store(cluster_file)
+    assert store.store_path == cluster_store_path(cluster_file) == os.path.join(tmp_dir, 'clusters.sqlite')
+    assert len(store) == 2
+
+    # an unchanged file is not imported again
+    store.add({'c': [2, 3]})
+    assert len(open_cluster_store(cluster_file)) == 3
+
+    write_cluster_file(cluster_file, [('a', 1, 1), ('d', 3, 3)])
+    later = time.time() + 10
+    os.utime(cluster_file, (later, later))
+    store = open_cluster_store(cluster_file)
+    assert list(store.assignments().items()) == [('a', [1, 1]), ('d', [3, 3])]
+    assert store.next_ids() == [4, 4]
+
+    other_path = os.path.join(tmp_dir, 'out', 'copy.sqlite')
+    os.mkdir(os.path.dirname(other_path))
+    assert open_cluster_store(cluster_file, other_path).get('d') == [3, 3]
+
+
+def test_open_empty_file(tmp_path):
+    cluster_file = os.path.join(str(tmp_path), 'clusters.txt')
+    open(cluster_file, 'w').close()
+    store = open_cluster_store(cluster_file)
+    assert len(store) == 0
+    assert store.thresholds() == []
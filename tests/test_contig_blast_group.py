@@ -0,0 +1,76 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from mob_suite.blast import BLAST_TABLE_COLS
+from mob_suite.mob_recon import contig_blast_group
+from mob_suite.utils import filter_overlaping_records
+
+
+def baseline_group(blast_df):
+    """Cluster assignment loop of the previous contig_blast_group, run on hits already filtered for overlaps"""
+    cluster_scores = dict()
+    contigs = dict()
+    for index, row in blast_df.iterrows():
+        pID, clust_id = row['sseqid'].split('|')
+        score = row['bitscore']
+        contig_id = row['qseqid']
+        if not clust_id in cluster_scores:
+            cluster_scores[clust_id] = score
+        elif score > cluster_scores[clust_id]:
+            cluster_scores[clust_id] = score
+        if not contig_id in contigs:
+            contigs[contig_id] = dict()
+        if not clust_id in contigs[contig_id]:
+            contigs[contig_id][clust_id] = 0
+        if contigs[contig_id][clust_id] < score:
+            contigs[contig_id][clust_id] = score
+
+    sorted_d = OrderedDict(sorted(iter(list(cluster_scores.items())), key=lambda x: x[1], reverse=True))
+    for clust_id in sorted_d:
+        for contig_id in contigs:
+            if clust_id in contigs[contig_id]:
+                contigs[contig_id] = {clust_id: contigs[contig_id][clust_id]}
+    return contigs
+
+
+def random_hits(rng, num_hits):
+    rows = list()
+    for i in range(num_hits):
+        sstart = int(rng.integers(1, 20000))
+        length = int(rng.integers(100, 3000))
+        rows.append(('contig{}'.format(rng.integers(0, 12)),
+                     'ref{}|AA{:03d}'.format(rng.integers(0, 40), rng.integers(0, 8)),
+                     int(rng.integers(1000, 50000)), 60000, 1, length, sstart, sstart + length, length, 0, 99.0, 90.0,
+                     90.0, 'plus', 0.0, float(rng.choice([500.0, 812.5, 1200.0, 1200.0, 3000.0]))))
+    return pd.DataFrame(rows, columns=BLAST_TABLE_COLS)
+
+
+def test_matches_baseline_assignment(tmp_path):
+    rng = np.random.default_rng(23)
+    for trial in range(60):
+        blast_df = filter_overlaping_records(random_hits(rng, int(rng.integers(1, 150))), 5, 'sseqid', 'sstart',
+                                             'send', 'bitscore')
+        expected = baseline_group(blast_df)
+        result = contig_blast_group(blast_df, 5)
+        assert result == expected
+        assert list(result) == list(expected)
+
+    blast_file = os.path.join(str(tmp_path), 'hits.txt')
+    blast_df.to_csv(blast_file, sep='\t', header=False, index=False)
+    assert contig_blast_group(blast_file, 5) == expected
+
+
+def test_highest_ranked_cluster_wins():
+    # A and B tie on score and B is hit first, the weaker hit of c2 to A still beats its hit to C
+    rows = [('c1', 'r1|B', 1000, 60000, 1, 500, 1, 500, 500, 0, 99.0, 90.0, 90.0, 'plus', 0.0, 900.0),
+            ('c1', 'r2|A', 1000, 60000, 1, 500, 1000, 1500, 500, 0, 99.0, 90.0, 90.0, 'plus', 0.0, 900.0),
+            ('c2', 'r3|A', 1000, 60000, 1, 500, 1, 500, 500, 0, 99.0, 90.0, 90.0, 'plus', 0.0, 100.0),
+            ('c2', 'r4|C', 1000, 60000, 1, 500, 1, 500, 500, 0, 99.0, 90.0, 90.0, 'plus', 0.0, 400.0)]
+    blast_df = pd.DataFrame(rows, columns=BLAST_TABLE_COLS)
+    assert contig_blast_group(blast_df, 5) == {'c1': {'B': 900.0}, 'c2': {'A': 100.0}}
+    assert contig_blast_group(blast_df, 5) == baseline_group(filter_overlaping_records(
+        blast_df, 5, 'sseqid', 'sstart', 'send', 'bitscore'))
+    assert contig_blast_group(blast_df.iloc[0:0], 5) == dict()
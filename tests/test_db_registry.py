@@ -0,0 +1,103 @@
+import os
+import stat
+
+import pytest
+
+from mob_suite.blast import BlastRunner
+from mob_suite.blast import db_registry
+from mob_suite.blast.db_registry import BLASTDB_INDEX_EXTENSIONS, IncrementalBlastDb, file_digest, reference_blastdb
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    """Replace makeblastdb with one writing placeholder index files, recording the prefixes built"""
+    built = list()
+
+    def makeblastdb(self, fasta_path, dbtype, out_path=None, extra_args=()):
+        out_path = fasta_path if out_path is None else out_path
+        for ext in BLASTDB_INDEX_EXTENSIONS[dbtype]:
+            with open(out_path + ext, 'w') as fh:
+                fh.write(fasta_path)
+        built.append(out_path)
+        return out_path
+
+    monkeypatch.setattr(BlastRunner, 'makeblastdb', makeblastdb)
+    return built
+
+
+def write_fasta(path, seq='ACGTACGT'):
+    with open(path, 'w') as fh:
+        fh.write('>seq1\n{}\n'.format(seq))
+    return path
+
+
+def test_reference_blastdb_uses_current_prebuilt_index(tmp_path, builds):
+    tmp_dir = str(tmp_path)
+    fasta = write_fasta(os.path.join(tmp_dir, 'repetitive.dna.fas'))
+    BlastRunner(fasta, tmp_dir).makeblastdb(fasta, 'nucl')
+    del builds[:]
+    registry_dir = os.path.join(tmp_dir, 'registry')
+    assert reference_blastdb(fasta, 'nucl', os.path.join(tmp_dir, 'fallback'), registry_dir) == fasta
+    assert builds == []
+
+    # a FASTA newer than its index is built in the registry instead
+    os.utime(fasta, (os.path.getmtime(fasta) + 10, os.path.getmtime(fasta) + 10))
+    db_path = reference_blastdb(fasta, 'nucl', os.path.join(tmp_dir, 'fallback'), registry_dir)
+    assert os.path.dirname(os.path.dirname(db_path)) == registry_dir
+    assert len(builds) == 1
+    assert reference_blastdb(fasta, 'nucl', os.path.join(tmp_dir, 'fallback'), registry_dir) == db_path
+    assert len(builds) == 1
+
+
+@pytest.mark.skipif(os.geteuid() == 0, reason='permissions are not enforced for root')
+def test_reference_blastdb_read_only_registry(tmp_path, builds):
+    tmp_dir = str(tmp_path)
+    read_only = os.path.join(tmp_dir, 'install')
+    os.mkdir(read_only)
+    fasta = write_fasta(os.path.join(read_only, 'repetitive.dna.fas'))
+    os.chmod(read_only, stat.S_IRUSR | stat.S_IXUSR)
+    try:
+        db_path = reference_blastdb(fasta, 'nucl', os.path.join(tmp_dir, 'fallback'),
+                                    os.path.join(read_only, 'blastdb_registry'))
+    finally:
+        os.chmod(read_only, stat.S_IRWXU)
+    assert db_path.startswith(os.path.join(tmp_dir, 'fallback') + os.sep)
+
+
+def test_reference_blastdb_unwritable_registry_falls_back(tmp_path, builds, monkeypatch):
+    tmp_dir = str(tmp_path)
+    fasta = write_fasta(os.path.join(tmp_dir, 'repetitive.dna.fas'))
+    monkeypatch.setattr(db_registry, 'dir_is_writable', lambda path: False)
+    db_path = reference_blastdb(fasta, 'nucl', os.path.join(tmp_dir, 'fallback'),
+                                os.path.join(tmp_dir, 'registry'))
+    assert db_path.startswith(os.path.join(tmp_dir, 'fallback') + os.sep)
+    assert not os.path.exists(os.path.join(tmp_dir, 'registry'))
+
+
+def test_file_digest_memo_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_registry, 'DIGEST_MEMO_SIZE', 3)
+    monkeypatch.setattr(db_registry, '_digest_memo', db_registry.OrderedDict())
+    paths = [write_fasta(os.path.join(str(tmp_path), 'seq{}.fasta'.format(i)), 'ACGT' * (i + 1)) for i in range(6)]
+    digests = [file_digest(path) for path in paths]
+    assert len(set(digests)) == 6
+    assert len(db_registry._digest_memo) == 3
+    assert [key[0] for key in db_registry._digest_memo] == [os.path.realpath(path) for path in paths[3:]]
+    assert file_digest(paths[0]) == digests[0]
+
+
+def test_incremental_db_appends_with_relative_path(tmp_path, builds, monkeypatch):
+    monkeypatch.chdir(str(tmp_path))
+    os.mkdir('db')
+    fasta = write_fasta(os.path.join('db', 'ref.fas'))
+    blast_db = IncrementalBlastDb(fasta, max_volumes=3)
+    for i in range(4):
+        delta = write_fasta(os.path.join('db', 'delta{}.fasta'.format(i)))
+        blast_db.append(delta)
+        # a fresh handle reads the alias written by the previous one
+        blast_db = IncrementalBlastDb(fasta, max_volumes=3)
+    volumes = [os.path.basename(volume) for volume in blast_db.volumes()]
+    assert volumes == ['ref.fas.vol5']
+    assert sorted(path for path in os.listdir('db') if path.startswith('ref.fas.')) == \
+        ['ref.fas.nal', 'ref.fas.vol5.nhr', 'ref.fas.vol5.nin', 'ref.fas.vol5.nsq']
+    assert [os.path.basename(path) for path in builds] == ['ref.fas.vol1', 'ref.fas.vol2', 'ref.fas.vol3',
+                                                           'ref.fas.vol4', 'ref.fas.vol5']
@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+from mob_suite.utils import filter_overlaping_records
+
+
+def baseline_filter_pass(blast_df, overlap_threshold):
+    """One pass of the previous implementation, comparing every hit with the row before it"""
+    prev_contig_id = ''
+    prev_index = -1
+    prev_contig_start = -1
+    prev_contig_end = -1
+    prev_score = -1
+    filter_indexes = list()
+    for index, row in blast_df.iterrows():
+        contig_id = row['sseqid']
+        contig_start = row['sstart']
+        contig_end = row['send']
+        score = row['bitscore']
+        if contig_id == prev_contig_id:
+            if (contig_start >= prev_contig_start and contig_start <= prev_contig_end) or \
+                    (contig_end >= prev_contig_start and contig_end <= prev_contig_end):
+                if abs(contig_start - prev_contig_end) > overlap_threshold:
+                    if prev_score > score:
+                        filter_indexes.append(index)
+                    else:
+                        filter_indexes.append(prev_index)
+        prev_index = index
+        prev_contig_id = contig_id
+        prev_contig_start = contig_start
+        prev_contig_end = contig_end
+        prev_score = score
+    blast_df = blast_df.drop(filter_indexes)
+    return blast_df.reset_index(drop=True)
+
+
+def baseline_filter(blast_df, overlap_threshold):
+    """The previous implementation as its callers ran it, sorted and repeated until nothing changes"""
+    blast_df = blast_df.sort_values(['sseqid', 'sstart', 'send', 'bitscore'], ascending=[True, True, True, False])
+    blast_df = baseline_filter_pass(blast_df.reset_index(drop=True), overlap_threshold)
+    prev_size = 0
+    size = len(blast_df)
+    while size != prev_size:
+        blast_df = baseline_filter_pass(blast_df, overlap_threshold)
+        prev_size = size
+        size = len(blast_df)
+    return blast_df
+
+
+def sorted_hits(blast_df):
+    return blast_df.sort_values(['sseqid', 'sstart', 'send', 'qseqid']).reset_index(drop=True)
+
+
+def hit_table(rows):
+    return pd.DataFrame(rows, columns=['qseqid', 'sseqid', 'sstart', 'send', 'bitscore'])
+
+
+def test_isolated_overlaps_match_baseline():
+    rng = np.random.default_rng(3)
+    rows = list()
+    for contig in range(5):
+        for locus in range(20):
+            start = locus * 1000 + int(rng.integers(1, 100))
+            length = int(rng.integers(100, 400))
+            rows.append(('q{}_{}a'.format(contig, locus), 'contig{}'.format(contig), start, start + length,
+                         float(rng.integers(50, 60))))
+            # the second hit of a locus either clears the first or overlaps it by up to its whole length
+            shift = int(rng.integers(0, length + 20))
+            rows.append(('q{}_{}b'.format(contig, locus), 'contig{}'.format(contig), start + shift,
+                         start + shift + int(rng.integers(50, 400)), float(rng.integers(50, 60))))
+    blast_df = hit_table(rows)
+
+    for overlap_threshold in (0, 5, 50):
+        expected = sorted_hits(baseline_filter(blast_df, overlap_threshold))
+        result = sorted_hits(filter_overlaping_records(blast_df, overlap_threshold, 'sseqid', 'sstart', 'send',
+                                                       'bitscore'))
+        assert len(expected) < len(blast_df)
+        pd.testing.assert_frame_equal(result, expected)
+
+
+def test_ties_drop_earlier_hit():
+    blast_df = hit_table([('a', 'contig1', 1, 100, 50.0), ('b', 'contig1', 20, 150, 50.0),
+                          ('c', 'contig2', 1, 100, 50.0), ('d', 'contig2', 98, 200, 40.0)])
+    result = filter_overlaping_records(blast_df, 5, 'sseqid', 'sstart', 'send', 'bitscore')
+    assert result['qseqid'].tolist() == ['b', 'c', 'd']
+    assert sorted_hits(result).equals(sorted_hits(baseline_filter(blast_df, 5)))
+
+
+def test_kept_hits_do_not_overlap():
+    rng = np.random.default_rng(11)
+    starts = rng.integers(1, 5000, size=500)
+    blast_df = hit_table([('q{}'.format(i), 'contig{}'.format(i % 3), int(start), int(start + rng.integers(20, 600)),
+                           float(rng.integers(20, 200))) for i, start in enumerate(starts)])
+    result = filter_overlaping_records(blast_df, 5, 'sseqid', 'sstart', 'send', 'bitscore')
+    for contig_id, hits in result.groupby('sseqid'):
+        hits = hits.sort_values(['sstart', 'send'])
+        assert (np.maximum.accumulate(hits['send'].values)[:-1] - hits['sstart'].values[1:] <= 5).all()
+    again = filter_overlaping_records(result, 5, 'sseqid', 'sstart', 'send', 'bitscore')
+    pd.testing.assert_frame_equal(again, result)
@@ -0,0 +1,91 @@
+import io
+import os
+
+import pandas as pd
+
+from mob_suite.blast import BLAST_TABLE_COLS, read_blast_table
+from mob_suite.blast import hit_cache
+from mob_suite.blast.hit_cache import BlastHitCache
+
+
+class FakeBlastRunner:
+    """Reports one hit for every query sequence containing GATTACA"""
+
+    def __init__(self):
+        self.searched = list()
+
+    def run_blast_stream(self, query_fasta_path, blast_task, db_path, db_type, min_cov, min_ident, evalue,
+                         num_threads=1, word_size=11, min_values=None, max_values=None):
+        lines = list()
+        with open(query_fasta_path) as fh:
+            records = fh.read().split('>')[1:]
+        for record in records:
+            seq_id, seq = record.strip().split('\n')
+            self.searched.append(seq_id)
+            if 'GATTACA' in seq:
+                start = seq.index('GATTACA') + 1
+                lines.append('\t'.join(str(value) for value in (
+                    seq_id, 'marker|1', len(seq), 7, start, start + 6, 1, 7, 7, 0, 100.0, 100.0, 100.0,
+                    'plus', 1e-3, 14.4)))
+        return read_blast_table(io.StringIO('\n'.join(lines) + '\n'))
+
+
+def write_fasta(path, records):
+    with open(path, 'w') as fh:
+        for seq_id, seq in records:
+            fh.write('>{}\n{}\n'.format(seq_id, seq))
+    return path
+
+
+def run(cache, runner, query_fasta, db_path, work_dir):
+    return cache.run_blast_stream(runner, query_fasta, 'megablast', db_path, 'nucl', 80, 80, 1e-5, work_dir)
+
+
+def test_cached_hits_match_search(tmp_path, monkeypatch):
+    tmp_dir = str(tmp_path)
+    monkeypatch.setitem(hit_cache._blast_version_memo, 'blastn', 'blastn: 2.9.0+')
+    db_path = write_fasta(os.path.join(tmp_dir, 'sample.fasta'), [('s1', 'ACGT')])
+    cache = BlastHitCache(os.path.join(tmp_dir, 'cache', 'hits.sqlite'))
+    first = write_fasta(os.path.join(tmp_dir, 'first.fasta'),
+                        [('c1', 'AAGATTACAA'), ('c2', 'CCCCCCCC'), ('c3', 'TGATTACAGT')])
+
+    runner = FakeBlastRunner()
+    expected = run(cache, runner, first, db_path, tmp_dir)
+    assert runner.searched == ['c1', 'c2', 'c3']
+    assert list(expected.columns) == BLAST_TABLE_COLS
+    assert expected['qseqid'].astype(str).tolist() == ['c1', 'c3']
+
+    runner = FakeBlastRunner()
+    pd.testing.assert_frame_equal(run(cache, runner, first, db_path, tmp_dir), expected)
+    assert runner.searched == []
+
+    # sequences are cached under their contents, whatever they are called
+    second = write_fasta(os.path.join(tmp_dir, 'second.fasta'),
+                         [('n1', 'GGGATTACAG'), ('n2', 'AAGATTACAA'), ('n3', 'CCCCCCCC')])
+    runner = FakeBlastRunner()
+    result = run(cache, runner, second, db_path, tmp_dir)
+    assert runner.searched == ['n1']
+    assert result['qseqid'].astype(str).tolist() == ['n1', 'n2']
+    assert result['qstart'].tolist() == [3, 3]
+    assert sorted(os.listdir(tmp_dir)) == ['cache', 'first.fasta', 'sample.fasta', 'second.fasta']
+
+
+def test_key_changes_with_version_and_database(tmp_path, monkeypatch):
+    tmp_dir = str(tmp_path)
+    monkeypatch.setitem(hit_cache._blast_version_memo, 'blastn', 'blastn: 2.9.0+')
+    db_path = write_fasta(os.path.join(tmp_dir, 'sample.fasta'), [('s1', 'ACGT')])
+    cache = BlastHitCache(os.path.join(tmp_dir, 'hits.sqlite'))
+    query = write_fasta(os.path.join(tmp_dir, 'query.fasta'), [('c1', 'AAGATTACAA')])
+    run(cache, FakeBlastRunner(), query, db_path, tmp_dir)
+
+    monkeypatch.setitem(hit_cache._blast_version_memo, 'blastn', 'blastn: 2.10.1+')
+    runner = FakeBlastRunner()
+    run(cache, runner, query, db_path, tmp_dir)
+    assert runner.searched == ['c1']
+
+    write_fasta(db_path, [('s1', 'ACGTT')])
+    assert cache.invalidate(db_path) == 0
+    runner = FakeBlastRunner()
+    run(cache, runner, query, db_path, tmp_dir)
+    assert runner.searched == ['c1']
+    assert cache.invalidate(db_path) == 1
@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+
+from mob_suite.blast.kmer_index import (AMINO_ACIDS, STANDARD_CODE, TCAG_RANK, MarkerKmerIndex,
+                                        build_marker_index, prescreen_markers)
+
+# one codon for each amino acid
+CODONS = dict()
+for b1 in 'TCAG':
+    for b2 in 'TCAG':
+        for b3 in 'TCAG':
+            CODONS.setdefault(STANDARD_CODE[16 * TCAG_RANK[b1] + 4 * TCAG_RANK[b2] + TCAG_RANK[b3]], b1 + b2 + b3)
+
+
+def write_fasta(path, seqs):
+    with open(path, 'w') as fh:
+        for i, seq in enumerate(seqs):
+            fh.write('>seq{}\n{}\n'.format(i, seq))
+    return path
+
+
+def worst_case_variant(rng, protein, min_ident, k):
+    """Protein at the lowest identity allowed with its substitutions k apart, destroying the most shared windows"""
+    num_mismatches = int(len(protein) * (1 - min_ident / 100.0))
+    variant = list(protein)
+    for position in range(k - 1, len(protein), k)[0:num_mismatches]:
+        variant[position] = rng.choice([aa for aa in AMINO_ACIDS if aa != protein[position]])
+    return ''.join(variant)
+
+
+def test_protein_bound_keeps_worst_case_hit(tmp_path):
+    tmp_dir = str(tmp_path)
+    rng = np.random.default_rng(5)
+    proteins = [''.join(rng.choice(list(AMINO_ACIDS), size=length)) for length in (60, 150, 300)]
+    ref_fasta = write_fasta(os.path.join(tmp_dir, 'markers.faa'), proteins)
+    build_marker_index(ref_fasta, 'prot')
+    index = MarkerKmerIndex.load(ref_fasta)
+
+    for min_ident, min_cov in ((80, 80), (90, 60), (95, 95)):
+        assert (index.min_shared_kmers(min_ident, min_cov) > 0).any()
+        for i, protein in enumerate(proteins):
+            variant = worst_case_variant(rng, protein, min_ident, index.k)
+            flank = ''.join(rng.choice(list('ACGT'), size=50))
+            sample_fasta = write_fasta(os.path.join(tmp_dir, 'sample{}.fasta'.format(i)),
+                                       [flank + ''.join(CODONS[aa] for aa in variant) + flank])
+            assert index.candidates(sample_fasta, min_ident, min_cov)[i]
+
+
+def test_prescreen_drops_absent_markers(tmp_path):
+    tmp_dir = str(tmp_path)
+    rng = np.random.default_rng(9)
+    markers = [''.join(rng.choice(list('ACGT'), size=500)) for i in range(3)]
+    ref_fasta = write_fasta(os.path.join(tmp_dir, 'markers.fasta'), markers)
+    out_fasta = os.path.join(tmp_dir, 'candidates.fasta')
+    # without an index every marker is searched
+    assert prescreen_markers(ref_fasta, ref_fasta, 80, 80, out_fasta) == ref_fasta
+
+    build_marker_index(ref_fasta, 'nucl')
+    sample = ''.join(rng.choice(list('ACGT'), size=300)) + markers[1][100:400]
+    sample_fasta = write_fasta(os.path.join(tmp_dir, 'sample.fasta'), [sample])
+    assert prescreen_markers(ref_fasta, sample_fasta, 80, 80, out_fasta) == out_fasta
+    with open(out_fasta) as fh:
+        assert fh.read() == '>seq1\n{}\n'.format(markers[1])
+
+    empty_fasta = write_fasta(os.path.join(tmp_dir, 'empty.fasta'), [''.join(rng.choice(list('ACGT'), size=300))])
+    assert prescreen_markers(ref_fasta, empty_fasta, 80, 80, out_fasta) is None
+
+
+def test_short_reference_does_not_hide_last_window(tmp_path):
+    tmp_dir = str(tmp_path)
+    rng = np.random.default_rng(13)
+    marker = ''.join(rng.choice(list('ACGT'), size=200))
+    sample_fasta = write_fasta(os.path.join(tmp_dir, 'sample.fasta'),
+                               [''.join(rng.choice(list('ACGT'), size=100)) + marker[-21:]])
+    for others in ([], ['ACGT'], ['ACGT', 'TTGCA']):
+        ref_fasta = write_fasta(os.path.join(tmp_dir, 'markers{}.fasta'.format(len(others))), [marker] + others)
+        build_marker_index(ref_fasta, 'nucl')
+        candidates = MarkerKmerIndex.load(ref_fasta).candidates(sample_fasta, 80, 80)
+        assert candidates.tolist() == [True] + [True] * len(others)
@@ -0,0 +1,130 @@
+import os
+import shutil
+import subprocess
+from itertools import combinations
+
+import pandas as pd
+import pytest
+
+from mob_suite.classes.mcl import mcl
+from mob_suite.mob_recon import mcl_predict
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# Hits between plasmids planted in groups, with some edges inside groups missing and weak edges between them.
+# The expected clusters, one per line largest first in the format written by mcl, are those of the MCL process
+# run to convergence on the dense matrix without pruning
+FIXTURE_BLAST = os.path.join(DATA_DIR, 'mcl_blast.txt')
+FIXTURE_CLUSTERS = os.path.join(DATA_DIR, 'mcl_clusters.txt')
+GROUPS = [['a{}'.format(i) for i in range(6)], ['b{}'.format(i) for i in range(4)], ['c0', 'c1']]
+
+
+def hit_pairs():
+    pairs = list()
+    for group in GROUPS:
+        for query, subject in combinations(group, 2):
+            pairs.append((query, subject, 1e-50))
+    # weak links between the groups and a self hit that carries no information
+    pairs.extend([('a0', 'b0', 1e-3), ('b3', 'c0', 1e-2), ('a1', 'a1', 0.0), ('c1', 'c0', 0.0)])
+    return pairs
+
+
+def blast_rows():
+    """Tabular BLAST hits with the query, subject and evalue in columns 0, 1 and 14"""
+    return [[query, subject] + ['0'] * 12 + [str(evalue)] for query, subject, evalue in hit_pairs()]
+
+
+def write_blast(rows, path):
+    with open(path, 'w') as fh:
+        for row in rows:
+            fh.write('\t'.join(row) + '\n')
+    return path
+
+
+def read_clusters(clust_file):
+    """Cluster number of each member of an mcl output file, as the mcl class used to parse it"""
+    clusters = dict()
+    with open(clust_file) as fh:
+        for count, line in enumerate(fh):
+            for member in line.strip().split('\t'):
+                clusters[member] = count
+    return clusters
+
+
+def partition(clusters):
+    members = dict()
+    for label, cluster in clusters.items():
+        members.setdefault(cluster, set()).add(label)
+    return sorted(sorted(group) for group in members.values())
+
+
+def test_clusters_toy_graph(tmp_path):
+    blast_file = write_blast(blast_rows(), os.path.join(str(tmp_path), 'hits.txt'))
+    clusters = mcl(blast_file).getclusters()
+    assert partition(clusters) == sorted(sorted(group) for group in GROUPS)
+    # clusters are numbered largest first
+    assert [clusters[group[0]] for group in GROUPS] == [0, 1, 2]
+
+
+def test_dataframe_and_threads_agree(tmp_path):
+    rows = blast_rows()
+    blast_file = write_blast(rows, os.path.join(str(tmp_path), 'hits.txt'))
+    blast_df = pd.DataFrame([(row[0], row[1], float(row[14])) for row in rows], columns=['qseqid', 'sseqid', 'evalue'])
+    expected = mcl(blast_file).getclusters()
+    assert mcl(blast_df).getclusters() == expected
+    assert mcl(blast_file, num_threads=4).getclusters() == expected
+
+
+def test_matches_fixture():
+    expected = read_clusters(FIXTURE_CLUSTERS)
+    assert len(set(expected.values())) == 8
+    assert mcl(FIXTURE_BLAST).getclusters() == expected
+    assert mcl(FIXTURE_BLAST, num_threads=3).getclusters() == expected
+    edges = pd.read_csv(FIXTURE_BLAST, sep='\t', header=None, usecols=[0, 1, 14])
+    edges.columns = ['qseqid', 'sseqid', 'evalue']
+    assert mcl(edges).getclusters() == expected
+
+
+def test_mcl_predict(tmp_path):
+    rows = list()
+    for query, subject, evalue in hit_pairs():
+        # mcl_predict clusters the contigs with the cluster field of the reference ids
+        rows.append([query, 'ref_{}|{}'.format(subject, subject), 5000, 5000, 1, 4000, 1, 4000, 4000, 0, 99.0,
+                     80.0, 80.0, 'plus', evalue, 100.0])
+    rows.append(['short', 'ref_a0|a0', 500, 5000, 1, 500, 1, 500, 500, 0, 99.0, 100.0, 100.0, 'plus', 1e-50, 100.0])
+    blast_file = write_blast([[str(value) for value in row] for row in rows], os.path.join(str(tmp_path), 'hits.txt'))
+    clusters = mcl_predict(blast_file, 80, 60, 1e-5, 1000, num_threads=2)
+    assert 'short' not in clusters
+    assert partition(clusters) == sorted(sorted(group) for group in GROUPS)
+
+    empty = os.path.join(str(tmp_path), 'empty.txt')
+    open(empty, 'w').close()
+    assert mcl_predict(empty, 80, 60, 1e-5, 1000) == dict()
+
+
+def test_empty_input():
+    assert mcl(pd.DataFrame(columns=['qseqid', 'sseqid', 'evalue'])).getclusters() == dict()
+
+
+@pytest.mark.skipif(shutil.which('mcl') is None or shutil.which('mcxload') is None,
+                    reason='mcl is not installed')
+@pytest.mark.parametrize('blast_file', ['toy', FIXTURE_BLAST])
+def test_matches_mcl(tmp_path, blast_file):
+    tmp_dir = str(tmp_path)
+    if blast_file == 'toy':
+        blast_file = write_blast(blast_rows(), os.path.join(tmp_dir, 'hits.txt'))
+    # the command chain the mcl class used to run
+    with open(blast_file) as fh:
+        rows = [line.rstrip('\n').split('\t') for line in fh]
+    abc_file = write_blast([[row[0], row[1], row[14]] for row in rows], os.path.join(tmp_dir, 'seq.abc'))
+    mci_file = os.path.join(tmp_dir, 'seq.mci')
+    tab_file = os.path.join(tmp_dir, 'seq.tab')
+    clust_file = os.path.join(tmp_dir, 'seq.clust')
+    subprocess.check_call(['mcxload', '-abc', abc_file, '--stream-mirror', '--stream-neg-log10',
+                           '-o', mci_file, '-write-tab', tab_file])
+    subprocess.check_call(['mcl', mci_file, '-I', '1.5', '-use-tab', tab_file, '-o', clust_file])
+    expected = read_clusters(clust_file)
+
+    clusters = mcl(blast_file).getclusters()
+    assert partition(clusters) == partition(expected)
+    assert clusters == expected
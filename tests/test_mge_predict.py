@@ -0,0 +1,82 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from mob_suite.blast import BLAST_TABLE_COLS
+from mob_suite.classes.mge_predict import covered_bases, mge_predict
+
+
+def per_base_coverage(seq_ids, starts, ends):
+    """Covered bases counted one base at a time. The merge the module used before dropped the
+    interval following each gap, so bases are counted directly rather than compared against it"""
+    covered = dict()
+    for seq_id, start, end in zip(seq_ids, starts, ends):
+        covered.setdefault(seq_id, set()).update(range(start, end + 1))
+    return dict((seq_id, len(bases)) for seq_id, bases in covered.items())
+
+
+def test_covered_bases_matches_per_base_count():
+    rng = np.random.default_rng(25)
+    for trial in range(100):
+        num_hits = int(rng.integers(1, 60))
+        seq_ids = rng.choice(['s{}'.format(i) for i in range(6)], size=num_hits)
+        starts = rng.integers(1, 2000, size=num_hits)
+        ends = starts + rng.integers(0, 400, size=num_hits)
+        expected = per_base_coverage(seq_ids, starts, ends)
+        result = covered_bases(seq_ids, starts, ends)
+        assert dict(result) == expected
+        assert list(result) == list(pd.unique(seq_ids))
+    assert covered_bases([], [], []) == dict()
+    # nested, touching and separate intervals
+    assert covered_bases(['a'] * 4 + ['b'], [1, 5, 101, 300, 1], [200, 50, 250, 300, 1]) == {'a': 251, 'b': 1}
+
+
+def hit(contig_id, match_id, qlen, slen, qstart, qend, sstart, send, score):
+    return (contig_id, match_id, qlen, slen, qstart, qend, sstart, send, qend - qstart + 1, 0, 99.0, 90.0, 90.0,
+            'plus', 0.0, score)
+
+
+def sample_hits():
+    return pd.DataFrame([
+        hit('c1', 'p1|AA001', 5000, 6000, 1, 5000, 1, 5000, 9000.0),
+        hit('c1', 'p2|AA002', 5000, 6000, 1, 4800, 1, 4800, 8500.0),
+        hit('c1', 'p4|AA004', 5000, 6000, 1, 1000, 1, 1000, 1000.0),
+        hit('c2', 'p1|AA001', 2000, 6000, 1, 2000, 4001, 6000, 3600.0),
+        hit('c2', 'p2|AA002', 2000, 6000, 1, 1200, 4801, 6000, 3500.0),
+        # p3 is covered by the assembly too little to be kept
+        hit('c3', 'p3|AA003', 3000, 90000, 1, 3000, 1, 3000, 5400.0),
+        # too short a contig
+        hit('c4', 'p1|AA001', 500, 6000, 1, 500, 1, 500, 900.0),
+    ], columns=BLAST_TABLE_COLS)
+
+
+def test_predicts_plasmid_contigs(tmp_path):
+    blast_df = sample_hits()
+    contigs = mge_predict(blast_df).get_plasmid_contigs()
+    assert contigs == {
+        'c1': {'contig_length': 5000, 'plasmid_membership': 'multiple', 'plasmid_cluster_ids': 'AA001,AA002',
+               'contig_cov': 100.0, 'cluster_size_range': 6000},
+        'c2': {'contig_length': 2000, 'plasmid_membership': 'multiple', 'plasmid_cluster_ids': 'AA001,AA002',
+               'contig_cov': 100.0, 'cluster_size_range': 6000}}
+    # the input table is left as it was
+    pd.testing.assert_frame_equal(blast_df, sample_hits())
+
+    blast_file = str(tmp_path / 'hits.txt')
+    blast_df.to_csv(blast_file, sep='\t', header=False, index=False)
+    assert mge_predict(blast_file).get_plasmid_contigs() == contigs
+    empty = str(tmp_path / 'empty.txt')
+    open(empty, 'w').close()
+    assert mge_predict(empty).get_plasmid_contigs() == dict()
+
+
+def test_instances_do_not_share_state():
+    samples = list()
+    for i in range(8):
+        blast_df = sample_hits()
+        blast_df['qseqid'] = blast_df['qseqid'] + '_{}'.format(i)
+        samples.append(blast_df.iloc[:i % 4 + 2])
+    expected = [mge_predict(blast_df).get_plasmid_contigs() for blast_df in samples]
+    assert expected[0] != expected[2]
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        assert list(pool.map(lambda blast_df: mge_predict(blast_df).get_plasmid_contigs(), samples)) == expected
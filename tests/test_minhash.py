@@ -0,0 +1,122 @@
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+from mob_suite.wrappers.minhash import MashReference, murmurhash3_x64_64, sketch_each_sequence, sketch_sequences
+
+mmh3 = pytest.importorskip('mmh3')
+
+COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+
+def random_sequence(rng, length):
+    return ''.join(rng.choice(list('ACGT'), size=length))
+
+
+def mutate(rng, seq, rate):
+    seq = list(seq)
+    for i in np.nonzero(rng.random(len(seq)) < rate)[0]:
+        seq[i] = rng.choice([base for base in 'ACGT' if base != seq[i]])
+    return ''.join(seq)
+
+
+def mash_hash(kmer, seed=42):
+    return mmh3.hash64(kmer.encode('ascii'), seed, signed=False)[0]
+
+
+def reference_sketch(seqs, k=21, s=1000, seed=42):
+    """Bottom-s sketch of the canonical k-mers of the sequences hashed one at a time as mash does"""
+    hashes = set()
+    for seq in seqs:
+        for i in range(len(seq) - k + 1):
+            kmer = seq[i:i + k]
+            if set(kmer) - set('ACGT'):
+                continue
+            hashes.add(mash_hash(min(kmer, kmer.translate(COMPLEMENT)[::-1]), seed))
+    return np.array(sorted(hashes)[0:s], dtype=np.uint64)
+
+
+def mash_distance(a, b, k=21, s=1000):
+    union = np.unique(np.concatenate([a, b]))[0:s]
+    common = len(np.intersect1d(np.intersect1d(a, b), union))
+    jaccard = float(common) / len(union)
+    if common == len(union):
+        return '0'
+    if common == 0:
+        return '1'
+    return '{:g}'.format(-np.log(2 * jaccard / (1 + jaccard)) / k)
+
+
+@pytest.fixture
+def sequences():
+    rng = np.random.default_rng(7)
+    base = random_sequence(rng, 5000)
+    return [base, mutate(rng, base, 0.01), mutate(rng, base, 0.05), random_sequence(rng, 3000),
+            base[0:1200] + 'NNNN' + base[1300:2600]]
+
+
+def test_murmurhash_matches_reference_implementation():
+    rng = np.random.default_rng(1)
+    for length in range(1, 41):
+        keys = [bytes(rng.integers(0, 256, size=length, dtype=np.uint8)) for i in range(20)]
+        words = np.zeros((len(keys), (length + 7) // 8), dtype=np.uint64)
+        for i, key in enumerate(keys):
+            padded = key + b'\0' * (8 * words.shape[1] - length)
+            words[i] = np.frombuffer(padded, dtype='<u8')
+        for seed in (42, 0, 7):
+            expected = [mmh3.hash64(key, seed, signed=False)[0] for key in keys]
+            assert murmurhash3_x64_64(words, length, seed).tolist() == expected
+
+
+def test_sketch_sequences(sequences):
+    for k, s in ((21, 1000), (15, 200)):
+        assert sketch_sequences(sequences, k, s).tolist() == reference_sketch(sequences, k, s).tolist()
+        assert sketch_sequences(sequences[0:1], k, s, seed=3).tolist() == \
+            reference_sketch(sequences[0:1], k, s, seed=3).tolist()
+
+
+def test_sketch_each_sequence(sequences):
+    sketches = sketch_each_sequence(sequences, 21, 500, chunk_size=1000)
+    for seq, sketch in zip(sequences, sketches):
+        assert sketch.tolist() == reference_sketch([seq], 21, 500).tolist()
+
+
+def test_distances(sequences):
+    sketches = [reference_sketch([seq]) for seq in sequences]
+    names = ['ref{}|cluster{}'.format(i, i) for i in range(len(sequences))]
+    reference = MashReference.from_sketches(names, sketches)
+    hits = reference.top_hits(sketches, k=len(sequences))
+    for q, query in enumerate(sketches):
+        expected = [(r, mash_distance(query, sketch)) for r, sketch in enumerate(sketches)]
+        expected = sorted([hit for hit in expected if hit[1] != '1'], key=lambda hit: (float(hit[1]), hit[0]))
+        assert [(int(r), distance) for r, distance in hits[q]] == expected
+    assert hits[0][0] == (0, '0')
+    assert 3 not in [r for r, distance in hits[0]]
+
+
+@pytest.mark.skipif(shutil.which('mash') is None, reason='mash is not installed')
+def test_matches_mash(sequences, tmp_path):
+    fasta = os.path.join(str(tmp_path), 'seqs.fasta')
+    with open(fasta, 'w') as fh:
+        for i, seq in enumerate(sequences):
+            fh.write('>ref{}|cluster{}\n{}\n'.format(i, i, seq))
+    msh = os.path.join(str(tmp_path), 'seqs.msh')
+    subprocess.check_call(['mash', 'sketch', '-i', '-k', '21', '-s', '1000', '-o', msh, fasta])
+
+    reference = MashReference.from_msh(msh)
+    sketches = sketch_each_sequence(sequences)
+    for i, sketch in enumerate(sketches):
+        assert reference.reference_sketch(i).tolist() == sketch.tolist()
+
+    output = subprocess.check_output(['mash', 'dist', msh, msh]).decode('utf-8')
+    expected = dict()
+    for line in output.splitlines():
+        row = line.split('\t')
+        expected[(row[1], row[0])] = row[2]
+    names = reference.names()
+    for q, hits in enumerate(reference.top_hits(sketches, k=len(sequences))):
+        for r, distance in hits:
+            assert expected[(names[q], names[r])] == distance
@@ -0,0 +1,108 @@
+import os
+from argparse import Namespace
+
+import numpy as np
+import scipy.cluster.hierarchy
+import scipy.spatial.distance
+
+from mob_suite import mob_cluster
+from mob_suite.classes.cluster_store import open_cluster_store
+from mob_suite.mob_cluster import build_cluster_db
+
+THRESHOLDS = (0.02, 0.05, 0.1)
+
+
+def partition(labels):
+    groups = dict()
+    for index, label in enumerate(labels):
+        groups.setdefault(label, list()).append(index)
+    return sorted(groups.values())
+
+
+def random_distance_matrix(rng, num_seqs):
+    """Distances between points scattered around a few centres, so there are close pairs and separate components"""
+    centres = rng.random((6, 3))
+    points = centres[rng.integers(0, len(centres), size=num_seqs)] + rng.normal(0, 0.02, size=(num_seqs, 3))
+    return np.round(scipy.spatial.distance.squareform(scipy.spatial.distance.pdist(points)), 6)
+
+
+def test_partition_matches_full_complete_linkage():
+    rng = np.random.default_rng(17)
+    for num_seqs in (1, 2, 40, 150):
+        matrix = random_distance_matrix(rng, num_seqs)
+        ids = ['seq{}|x'.format(i) for i in range(num_seqs)]
+        rows, cols = np.triu_indices(num_seqs, k=1)
+        close = matrix[rows, cols] <= max(THRESHOLDS)
+        assignments = build_cluster_db(ids, (rows[close], cols[close], matrix[rows, cols][close]), THRESHOLDS)
+
+        Z = None
+        if num_seqs > 1:
+            Z = scipy.cluster.hierarchy.linkage(scipy.spatial.distance.squareform(matrix), method='complete')
+        for i, threshold in enumerate(THRESHOLDS):
+            labels = [assignments[id][i] for id in ids]
+            expected = [1] * num_seqs
+            if Z is not None:
+                expected = scipy.cluster.hierarchy.fcluster(Z, threshold, criterion='distance')
+            assert partition(labels) == partition(expected)
+            # clusters are numbered from 1 in the order of their first sequence
+            first_seen = list()
+            for label in labels:
+                if label not in first_seen:
+                    first_seen.append(label)
+            assert first_seen == [str(number) for number in range(1, len(first_seen) + 1)]
+
+
+def test_pairs_at_threshold_are_clustered():
+    ids = ['a', 'b', 'c', 'd']
+    neighbor_distances = (np.array([0, 0, 1, 2]), np.array([1, 2, 2, 3]), np.array([0.05, 0.02, 0.05, 0.1]))
+    assignments = build_cluster_db(ids, neighbor_distances, (0.02, 0.05))
+    assert [assignments[id] for id in ids] == [['1', '1'], ['2', '1'], ['1', '1'], ['3', '2']]
+
+
+def run_update(tmp_path, monkeypatch, overwrite):
+    """Run mob_cluster update on a read only style reference directory with the clustering itself replaced"""
+    tmp_dir = str(tmp_path)
+    ref_dir = os.path.join(tmp_dir, 'ref')
+    os.mkdir(ref_dir)
+    paths = dict((name, os.path.join(ref_dir, name)) for name in ('refs.fasta', 'clusters.txt', 'refs.msh'))
+    for path in paths.values():
+        with open(path, 'w') as fh:
+            fh.write('id\t0.05\t0.0001\nNC_1\t1\t1\n' if path.endswith('.txt') else '>NC_1\nACGT\n')
+    infile = os.path.join(tmp_dir, 'new.fasta')
+    with open(infile, 'w') as fh:
+        fh.write('>NC_2\nACGT\n')
+    args = Namespace(mode='update', outdir=os.path.join(tmp_dir, 'out'), infile=infile,
+                     ref_cluster_file=paths['clusters.txt'], ref_fasta_file=paths['refs.fasta'],
+                     ref_mash_db=paths['refs.msh'], num_threads=1, overwrite=overwrite, compact=False,
+                     exhaustive_search=False)
+    updated = list()
+
+    def update_existing(input_fasta, tmp_dir, ref_mash_db, tmp_cluster_file, header, tmp_ref_fasta_file,
+                        update_fasta, delta_fasta, num_threads=1, use_lsh=True):
+        store = mob_cluster.ClusterStore(mob_cluster.cluster_store_path(tmp_cluster_file))
+        updated.append(store.assignments())
+        store.add({'NC_2': [2, 2]})
+        store.export_file(tmp_cluster_file, header)
+        for path in (update_fasta, delta_fasta):
+            with open(path, 'w') as fh:
+                fh.write('>NC_2|2\nACGT\n')
+
+    monkeypatch.setattr(mob_cluster, 'parse_args', lambda: args)
+    monkeypatch.setattr(mob_cluster, 'update_existing', update_existing)
+    monkeypatch.setattr(mob_cluster, 'grow_reference_db', lambda *args, **kwargs: None)
+    mob_cluster.main()
+    return ref_dir, args.outdir, updated
+
+
+def test_update_leaves_reference_directory_untouched(tmp_path, monkeypatch):
+    ref_dir, out_dir, updated = run_update(tmp_path, monkeypatch, overwrite=False)
+    assert sorted(os.listdir(ref_dir)) == ['clusters.txt', 'refs.fasta', 'refs.msh']
+    assert list(updated[0].items()) == [('NC_1', [1, 1])]
+    with open(os.path.join(out_dir, 'clusters.txt')) as fh:
+        assert fh.read() == 'id\t0.05\t0.0001\nNC_1\t1\t1\nNC_2\t2\t2\n'
+
+
+def test_update_overwrite_keeps_store_with_reference(tmp_path, monkeypatch):
+    ref_dir, out_dir, updated = run_update(tmp_path, monkeypatch, overwrite=True)
+    assert sorted(os.listdir(ref_dir)) == ['clusters.sqlite', 'clusters.txt', 'refs.fasta', 'refs.msh']
+    assert open_cluster_store(os.path.join(ref_dir, 'clusters.txt')).get('NC_2') == [2, 2]
@@ -0,0 +1,110 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from mob_suite.blast.db_registry import BLASTDB_INDEX_EXTENSIONS
+from mob_suite.mob_recon import contig_blast
+from mob_suite.mob_recon_batch import demultiplex_contigs, demultiplex_hits, read_samples, write_batch_query
+from mob_suite.utils import fix_fasta_header, repetitive_blast
+
+from tests.conftest import write_random_fasta
+
+
+def write_sheet(path, lines):
+    with open(path, 'w') as fh:
+        fh.write('\n'.join(lines) + '\n')
+    return path
+
+
+def test_read_samples_directory(tmp_path):
+    input_dir = str(tmp_path)
+    for name in ('b.fasta', 'a.fna', 'c.FA', 'notes.txt'):
+        open(os.path.join(input_dir, name), 'w').close()
+    os.mkdir(os.path.join(input_dir, 'd.fasta'))
+    samples = read_samples(input_dir)
+    assert list(samples.items()) == [('a', os.path.join(input_dir, 'a.fna')), ('b', os.path.join(input_dir, 'b.fasta')),
+                                     ('c', os.path.join(input_dir, 'c.FA'))]
+
+    open(os.path.join(input_dir, 'a.fasta'), 'w').close()
+    with pytest.raises(Exception, match='more than one fasta'):
+        read_samples(input_dir)
+
+
+def test_read_samples_sheet(tmp_path):
+    sheet_dir = str(tmp_path)
+    sheet = write_sheet(os.path.join(sheet_dir, 'samples.tsv'),
+                        ['# sample\tfasta', 'S2\tassemblies/s2.fasta', '', 'S1\t/data/s1.fasta\textra'])
+    assert list(read_samples(sheet).items()) == [('S2', os.path.join(sheet_dir, 'assemblies/s2.fasta')),
+                                                 ('S1', '/data/s1.fasta')]
+
+    for lines, message in ((['S1\ta.fasta', 'S1\tb.fasta'], 'more than once'),
+                           (['S1 a.fasta'], 'does not have a sample id'),
+                           (['../S1\ta.fasta'], 'must be non-empty'),
+                           (['runs/S1\ta.fasta'], 'must be non-empty'),
+                           ([' \ta.fasta'], 'must be non-empty')):
+        with pytest.raises(Exception, match=message):
+            read_samples(write_sheet(os.path.join(sheet_dir, 'bad.tsv'), lines))
+
+
+def comparable(blast_df):
+    blast_df = blast_df.copy()
+    for col in ('qseqid', 'sseqid', 'sstrand'):
+        blast_df[col] = blast_df[col].astype(str)
+    return blast_df
+
+
+@pytest.fixture
+def samples(tmp_path):
+    """Cleaned assemblies of three samples, the contigs of one named like namespaced batch ids"""
+    rng = np.random.default_rng(21)
+    sample_fastas = OrderedDict()
+    for index, sample_id in enumerate(('S1', 'S2', 'S3')):
+        sample_dir = os.path.join(str(tmp_path), sample_id)
+        os.mkdir(sample_dir)
+        name = 'sample0__assembly' if sample_id == 'S2' else 'assembly'
+        raw_fasta = os.path.join(sample_dir, name + '.fasta')
+        write_random_fasta(raw_fasta, rng, 12, min_length=500, max_length=5000, prefix=name + '__contig')
+        sample_fastas[sample_id] = os.path.join(sample_dir, 'fixed.input.fasta')
+        fix_fasta_header(raw_fasta, sample_fastas[sample_id])
+    return sample_fastas
+
+
+def test_batch_hits_match_single_sample_searches(tmp_path, samples, fake_blast):
+    tmp_dir = str(tmp_path)
+    batch_dir = os.path.join(tmp_dir, 'batch')
+    os.mkdir(batch_dir)
+    repetitive_fasta = os.path.join(tmp_dir, 'repetitive.dna.fas')
+    with open(repetitive_fasta, 'w') as fh:
+        fh.write('>rep1|IS1\nACGT\n')
+    for ext in BLASTDB_INDEX_EXTENSIONS['nucl']:
+        with open(repetitive_fasta + ext, 'w') as fh:
+            fh.write('index')
+
+    batch_fasta = os.path.join(batch_dir, 'batch.input.fasta')
+    namespace = write_batch_query(samples, batch_fasta)
+    assert namespace['sample1__sample0__assembly.fasta|sample0__assembly__contig0'] == \
+        ('S2', 'sample0__assembly.fasta|sample0__assembly__contig0')
+    contig_hits = demultiplex_hits(contig_blast(batch_fasta, 'plasmid_db', 80, 60, 1e-5, 1000, batch_dir), namespace)
+    repetitive_hits = demultiplex_contigs(repetitive_blast(batch_fasta, repetitive_fasta, 80, 60, 1e-5, 1000,
+                                                           batch_dir), namespace)
+
+    for sample_id, sample_fasta in samples.items():
+        sample_dir = os.path.dirname(sample_fasta)
+        expected = contig_blast(sample_fasta, 'plasmid_db', 80, 60, 1e-5, 1000, sample_dir)
+        assert len(expected) > 0
+        pd.testing.assert_frame_equal(comparable(contig_hits[sample_id]), comparable(expected))
+        assert set(expected['qseqid'].astype(str)).issubset(set(contig_hits[sample_id]['qseqid'].cat.categories))
+
+        expected = repetitive_blast(sample_fasta, repetitive_fasta, 80, 60, 1e-5, 1000, sample_dir)
+        assert len(expected) > 0
+        assert dict(repetitive_hits[sample_id]) == expected
+    assert all(contig_id.startswith('sample0__') for contig_id in repetitive_hits['S2'])
+
+
+def test_demultiplex_without_hits():
+    namespace = {'sample0__c1': ('S1', 'c1')}
+    assert demultiplex_hits(dict(), namespace) == dict()
+    assert demultiplex_contigs(dict(), namespace) == dict()
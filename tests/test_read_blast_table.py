@@ -0,0 +1,76 @@
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+from mob_suite.blast import BLAST_TABLE_COLS, BlastReader, empty_blast_table, read_blast_file, read_blast_table
+
+
+def random_blast_lines(rng, num_hits):
+    lines = list()
+    for i in range(num_hits):
+        qlen = int(rng.integers(100, 500000))
+        length = int(rng.integers(20, 5000))
+        lines.append('\t'.join(str(value) for value in (
+            'contig{}'.format(rng.integers(0, 30)), 'ref{}|{}'.format(rng.integers(0, 50), rng.integers(0, 5)),
+            qlen, int(rng.integers(1000, 300000)), 1, length, int(rng.integers(1, 9000)), int(rng.integers(1, 9000)),
+            length, int(rng.integers(0, 40)), rng.choice([79.999, 80.0, 80.001, 95.5, 100.0]),
+            int(rng.integers(0, 101)), int(rng.integers(0, 101)), rng.choice(['plus', 'minus']),
+            rng.choice([0.0, 1e-250, 3.2e-45, 0.001]), rng.choice([52.8, 1203.0, 18.3, 3.5e4]))))
+    return '\n'.join(lines) + '\n'
+
+
+def baseline_filtered(path, min_values, max_values):
+    """The whole table read at once and filtered afterwards, as the readers did before streaming"""
+    blast_df = pd.read_table(path, header=None)
+    blast_df.columns = BLAST_TABLE_COLS
+    for col in min_values:
+        blast_df = blast_df.loc[blast_df[col] >= min_values[col]]
+    for col in max_values:
+        blast_df = blast_df.loc[blast_df[col] <= max_values[col]]
+    return blast_df.reset_index(drop=True)
+
+
+def comparable(blast_df):
+    blast_df = blast_df.copy()
+    for col in ('qseqid', 'sseqid', 'sstrand'):
+        blast_df[col] = blast_df[col].astype(str)
+    for col in ('qlen', 'slen', 'qstart', 'qend', 'sstart', 'send', 'length', 'mismatch'):
+        blast_df[col] = blast_df[col].astype('int64')
+    for col in ('pident', 'qcovhsp', 'qcovs', 'evalue', 'bitscore'):
+        blast_df[col] = blast_df[col].astype('float64')
+    return blast_df
+
+
+def test_chunked_filtering_matches_full_read(tmp_path):
+    path = os.path.join(str(tmp_path), 'hits.txt')
+    with open(path, 'w') as fh:
+        fh.write(random_blast_lines(np.random.default_rng(2), 301))
+
+    for min_values, max_values in (({}, {}), ({'pident': 80, 'qcovhsp': 60}, {}),
+                                   ({'length': 1000, 'qlen': 1000, 'qcovs': 60}, {'qlen': 400000})):
+        expected = comparable(baseline_filtered(path, min_values, max_values))
+        assert 0 < len(expected)
+        for chunksize in (7, 100, 100000):
+            result = read_blast_table(path, min_values=min_values, max_values=max_values, chunksize=chunksize)
+            assert list(result.columns) == BLAST_TABLE_COLS
+            assert result['evalue'].dtype == 'float64' and result['bitscore'].dtype == 'float64'
+            pd.testing.assert_frame_equal(comparable(result), expected)
+        reader = BlastReader(path, streaming=True, min_values=min_values, max_values=max_values, chunksize=13)
+        pd.testing.assert_frame_equal(comparable(reader.df), expected)
+
+
+def test_all_hits_filtered_or_empty(tmp_path):
+    path = os.path.join(str(tmp_path), 'hits.txt')
+    with open(path, 'w') as fh:
+        fh.write(random_blast_lines(np.random.default_rng(3), 20))
+    result = read_blast_table(path, min_values={'pident': 101}, chunksize=3)
+    assert len(result) == 0
+    assert list(result.dtypes) == list(empty_blast_table().dtypes)
+
+    empty = os.path.join(str(tmp_path), 'empty.txt')
+    open(empty, 'w').close()
+    assert len(read_blast_file(empty)) == 0
+    assert len(read_blast_table(io.StringIO(random_blast_lines(np.random.default_rng(3), 20)),
+                                min_values={'pident': 101})) == 0
@@ -0,0 +1,123 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from mob_suite.blast import BLAST_TABLE_COLS, BlastReader, select_hits
+from mob_suite.blast.db_registry import BLASTDB_INDEX_EXTENSIONS
+from mob_suite.utils import fixStart, getRepliconContigs, repetitive_blast
+
+from tests.conftest import write_random_fasta
+
+
+def baseline_lowest(blast_df):
+    """Hit selection loop repetitive_blast ran over its sorted hits"""
+    contig_list = dict()
+    for index, row in blast_df.iterrows():
+        if not row['qseqid'] in contig_list:
+            contig_list[row['qseqid']] = {'id': row['sseqid'], 'score': row['bitscore'], 'contig_start': row['sstart'],
+                                          'contig_end': row['send']}
+        else:
+            if contig_list[row['qseqid']]['score'] > row['bitscore']:
+                contig_list[row['qseqid']] = {'id': row['sseqid'], 'score': row['bitscore'],
+                                              'contig_start': row['sstart'], 'contig_end': row['send']}
+    return contig_list
+
+
+def baseline_replicon_contigs(blast_df):
+    """Previous row loop of getRepliconContigs"""
+    contigs = dict()
+    for index, row in blast_df.iterrows():
+        contig_id = row['sseqid']
+        hit_id = row['qseqid']
+        if not contig_id in contigs:
+            contigs[contig_id] = dict()
+        contigs[contig_id][hit_id] = {'id': hit_id, 'ident': row['pident'], 'start': row['sstart'],
+                                      'end': row['send'], 'coverage': row['qcovs'],
+                                      'length': abs(row['send'] - row['sstart'])}
+    return contigs
+
+
+def random_hits(rng, num_hits):
+    rows = list()
+    for i in range(num_hits):
+        sstart = int(rng.integers(1, 500))
+        length = int(rng.integers(100, 300))
+        # few distinct scores so that contigs often have several hits sharing the lowest one
+        rows.append(('q{}'.format(rng.integers(0, 10)), 'contig{}'.format(rng.integers(0, 8)), 1000, 60000, 1, length,
+                     sstart, sstart + length, length, 0, float(rng.integers(80, 101)), 90.0, float(rng.integers(60, 101)),
+                     'plus', 0.0, float(rng.choice([100.0, 250.5, 250.5, 400.0]))))
+    return pd.DataFrame(rows, columns=BLAST_TABLE_COLS)
+
+
+def as_lists(nested):
+    return [(key, list(value.items())) for key, value in nested.items()]
+
+
+def test_select_hits_matches_loops():
+    rng = np.random.default_rng(24)
+    for trial in range(50):
+        keys = rng.integers(0, 15, size=int(rng.integers(1, 80))).astype(str)
+        scores = rng.choice([1.0, 2.0, 2.0, 3.5], size=len(keys))
+        lowest = dict()
+        first = dict()
+        last = dict()
+        for position, (key, score) in enumerate(zip(keys, scores)):
+            if not key in lowest or scores[lowest[key]] > score:
+                lowest[key] = position
+            first.setdefault(key, position)
+            last[key] = position
+        assert select_hits(keys, scores).tolist() == list(lowest.values())
+        assert select_hits(keys).tolist() == list(first.values())
+        assert select_hits(keys, keep='last').tolist() == list(last.values())
+    assert len(select_hits(np.array([], dtype=str))) == 0
+
+
+def test_repetitive_selection_matches_loop():
+    rng = np.random.default_rng(240)
+    for trial in range(40):
+        blast_df = random_hits(rng, int(rng.integers(1, 60)))
+        blast_df = blast_df.sort_values(['sseqid', 'sstart', 'send', 'bitscore'], ascending=[True, True, True, False])
+        blast_df = blast_df.reset_index(drop=True)
+        hits = blast_df.iloc[select_hits(blast_df['qseqid'].values, blast_df['bitscore'].values)]
+        selected = {contig_id: {'id': hit_id, 'score': score, 'contig_start': start, 'contig_end': end}
+                    for contig_id, hit_id, score, start, end in zip(hits['qseqid'], hits['sseqid'], hits['bitscore'],
+                                                                    hits['sstart'], hits['send'])}
+        assert selected == baseline_lowest(blast_df)
+
+
+def test_replicon_contigs_match_loop():
+    rng = np.random.default_rng(2400)
+    for trial in range(40):
+        blast_df = random_hits(rng, int(rng.integers(1, 60)))
+        expected = baseline_replicon_contigs(blast_df)
+        result = getRepliconContigs(blast_df)
+        assert result == expected
+        assert as_lists(result) == as_lists(expected)
+    assert getRepliconContigs(dict()) == dict()
+    assert getRepliconContigs(blast_df.iloc[0:0]) == dict()
+
+
+def test_repetitive_blast_matches_loop(tmp_path, fake_blast):
+    tmp_dir = str(tmp_path)
+    input_fasta = os.path.join(tmp_dir, 'contigs.fasta')
+    write_random_fasta(input_fasta, np.random.default_rng(7), 40)
+    repetitive_fasta = os.path.join(tmp_dir, 'repetitive.dna.fas')
+    with open(repetitive_fasta, 'w') as fh:
+        fh.write('>rep1|IS1\nACGT\n')
+    for ext in BLASTDB_INDEX_EXTENSIONS['nucl']:
+        with open(repetitive_fasta + ext, 'w') as fh:
+            fh.write('index')
+
+    blast_file = os.path.join(tmp_dir, 'repetitive_blast.txt')
+    result = repetitive_blast(input_fasta, repetitive_fasta, 80, 60, 1e-5, 1000, tmp_dir, blast_results_file=blast_file)
+    assert len(result) > 0
+
+    blast_df = BlastReader(blast_file).df
+    blast_df = blast_df.loc[blast_df['length'] >= 1000]
+    blast_df = blast_df.loc[blast_df['pident'] >= 80]
+    blast_df = blast_df.loc[blast_df['qcovs'] >= 60]
+    blast_df = fixStart(blast_df)
+    blast_df = blast_df.sort_values(['sseqid', 'sstart', 'send', 'bitscore'], ascending=[True, True, True, False])
+    blast_df = blast_df.reset_index(drop=True)
+    assert result == baseline_lowest(blast_df)
@@ -0,0 +1,95 @@
+import threading
+import time
+
+import pytest
+
+from mob_suite.classes.stage_scheduler import StageScheduler, ThreadBudget
+
+
+class GrantMonitor:
+    """Stage callable recording the largest number of threads held at once across stages"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.peak = 0
+        self.grants = dict()
+
+    def __call__(self, name, num_threads=1):
+        with self.lock:
+            self.in_use += num_threads
+            self.peak = max(self.peak, self.in_use)
+            self.grants[name] = num_threads
+        time.sleep(0.02)
+        with self.lock:
+            self.in_use -= num_threads
+        return name
+
+
+def test_thread_budget_grants_at_least_one_and_at_most_free():
+    budget = ThreadBudget(4)
+    assert budget.acquire(3) == 3
+    assert budget.acquire(3) == 1
+    budget.release(3)
+    assert budget.acquire(0) == 1
+    assert budget.available == 2
+
+
+@pytest.mark.parametrize('num_threads', [1, 3, 8])
+def test_grants_never_exceed_budget(num_threads):
+    monitor = GrantMonitor()
+    scheduler = StageScheduler(num_threads)
+    for i in range(6):
+        scheduler.add_stage('stage{}'.format(i), monitor, 'stage{}'.format(i), weight=i % 3 + 1)
+    scheduler.add_stage('capped', monitor, 'capped', max_threads=1)
+    scheduler.run()
+    assert monitor.peak <= num_threads
+    assert monitor.grants['capped'] == 1
+    assert all(1 <= granted <= num_threads for granted in monitor.grants.values())
+
+
+def test_shares_follow_weights_and_caps():
+    scheduler = StageScheduler(8)
+    scheduler.add_stage('contig', None, weight=2)
+    scheduler.add_stage('replicon', None)
+    scheduler.add_stage('relaxase', None)
+    scheduler.add_stage('circlator', None, max_threads=1)
+    shares = scheduler.allocate_shares()
+    assert shares['circlator'] == 1
+    assert sum(shares.values()) == 8
+    assert shares['contig'] > shares['replicon']
+
+
+def test_results_keyed_by_stage_in_order_added():
+    scheduler = StageScheduler(4)
+    for name in ('replicon', 'relaxase', 'contig', 'repetitive'):
+        scheduler.add_stage(name, lambda value, num_threads=1: value * 2, name)
+    results = scheduler.run()
+    assert list(results.items()) == [('replicon', 'repliconreplicon'), ('relaxase', 'relaxaserelaxase'),
+                                     ('contig', 'contigcontig'), ('repetitive', 'repetitiverepetitive')]
+
+
+def test_stage_error_propagates_after_other_stages_finish():
+    finished = list()
+
+    def fail(num_threads=1):
+        raise Exception('stage failed')
+
+    def succeed(num_threads=1):
+        time.sleep(0.02)
+        finished.append(True)
+
+    scheduler = StageScheduler(2)
+    scheduler.add_stage('fail', fail)
+    scheduler.add_stage('succeed', succeed)
+    with pytest.raises(Exception, match='stage failed'):
+        scheduler.run()
+    assert finished == [True]
+    assert scheduler.budget.available == 2
+
+
+def test_duplicate_stage_rejected():
+    scheduler = StageScheduler(2)
+    scheduler.add_stage('contig', None)
+    with pytest.raises(ValueError):
+        scheduler.add_stage('contig', None)
@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from mob_suite.blast import BlastRunner
+
+from tests.conftest import write_random_fasta
+
+
+@pytest.fixture
+def proteins(tmp_path):
+    path = os.path.join(str(tmp_path), 'proteins.faa')
+    write_random_fasta(path, np.random.default_rng(4), 23, min_length=30, max_length=900, prefix='protein')
+    return path
+
+
+def test_split_fasta_keeps_records_in_order(tmp_path, proteins):
+    runner = BlastRunner(proteins, str(tmp_path))
+    with open(proteins) as fh:
+        expected = fh.read()
+    for num_chunks in (1, 2, 5, 23, 40):
+        chunks = runner.split_fasta(proteins, os.path.join(str(tmp_path), 'chunk{}'.format(num_chunks)), num_chunks)
+        assert 1 <= len(chunks) <= min(num_chunks, 23)
+        contents = list()
+        for chunk in chunks:
+            with open(chunk) as fh:
+                contents.append(fh.read())
+        assert all(content.startswith('>') for content in contents)
+        assert ''.join(contents) == expected
+
+
+def test_shard_outputs_concatenated_in_order(tmp_path, proteins, fake_blast):
+    tmp_dir = str(tmp_path)
+    runner = BlastRunner(proteins, tmp_dir)
+    min_values = {'pident': 80, 'qcovhsp': 60}
+    single_out = os.path.join(tmp_dir, 'single.txt')
+    expected = runner.run_tblastn_sharded(proteins, 'megablast', 'sample', 'nucl', 60, 80, 1e-5, single_out,
+                                          num_threads=1, min_values=min_values)
+    assert len(expected) > 0
+
+    work_dir = os.path.join(tmp_dir, 'work')
+    os.mkdir(work_dir)
+    for num_threads, blast_outfile, shard_dir in ((3, None, None), (4, os.path.join(tmp_dir, 'sharded.txt'), None),
+                                                  (8, None, work_dir)):
+        result = runner.run_tblastn_sharded(proteins, 'megablast', 'sample', 'nucl', 60, 80, 1e-5, blast_outfile,
+                                            num_threads=num_threads, work_dir=shard_dir, min_values=min_values)
+        pd.testing.assert_frame_equal(result, expected)
+        if blast_outfile is not None:
+            with open(blast_outfile) as fh, open(single_out) as single:
+                assert fh.read() == single.read()
+    assert os.listdir(work_dir) == []
+    assert sorted(os.listdir(tmp_dir)) == ['fake_bin', 'proteins.faa', 'sharded.txt', 'single.txt', 'work']